@@ -0,0 +1,222 @@
+# Scaling benchmarks of the pipeline stages on synthetic inputs
+#   python -m benchmarks.run_benchmarks --scales 1 100 10000 --compare benchmarks/results/previous.json
+import os
+import gc
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils import cache, sinks
+from utils.bce_areas import generate_bce_data, compute_rates
+from utils.adding_eco_data import add_eco_data
+from utils.functions import correct_kiribati
+from utils.compute_bcw import gscc_computer, bcw_computer
+from utils.identity import build_identity_index
+from benchmarks.synthetic import AREA_COLUMNS, SELECT, write_inputs
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+CMOL = 44 / 12
+
+parser = argparse.ArgumentParser(description='Time and memory-profile the pipeline stages on synthetic inputs')
+parser.add_argument('--scales', type=float, nargs='+', default=[1, 100, 10000],
+                    help='sizes of the inputs, as multiples of the real data (10000 needs several GB of disk)')
+parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic inputs')
+parser.add_argument('--repeat', type=int, default=3, help='number of timed runs, the fastest one is kept')
+parser.add_argument('--excel', action='store_true', help='write the .xlsx inputs of main.py as .xlsx when they fit')
+parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+parser.add_argument('--output', default=None, help='JSON file of the results (default: benchmarks/results/<date>.json)')
+parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+parser.add_argument('--tolerance', type=float, default=0.25,
+                    help='a stage is flagged when its time grows faster than rows ** (1 + tolerance)')
+parser.add_argument('--regression', type=float, default=0.2,
+                    help='a stage is flagged when it is this much slower than in --compare')
+parser.add_argument('--min-seconds', type=float, default=0.05,
+                    help='timings under this duration are too noisy to be flagged')
+parser.add_argument('--workdir', default=None, help='directory of the synthetic inputs (a temporary one by default)')
+
+
+def pipeline_stages(paths: Dict[str, str]) -> List[Tuple[str, str, Callable]]:
+    """
+    This function returns the stages of main.py as (name, input driving its size, function of the
+    previous outputs), in execution order
+    """
+    bce_columns = [AREA_COLUMNS['saltmarshes'], AREA_COLUMNS['seagrasses'], AREA_COLUMNS['mangroves']]
+    return [
+        ('generate_bce_data', 'eez', lambda out: generate_bce_data(
+            paths['eez'], paths['saltmarshes'], bce_columns[0], paths['seagrasses'], bce_columns[1],
+            paths['mangroves'], bce_columns[2], SELECT)),
+        ('add_eco_data', 'eez', lambda out: add_eco_data(
+            out['generate_bce_data'], paths['country_classification'], paths['population'], paths['gdp'],
+            paths['annual-co2-emissions-per-country'], paths['TotalExternalDebt'])),
+        ('compute_rates', 'eez', lambda out: compute_rates(out['add_eco_data'], paths['rates'], bce_columns)),
+        ('identity_index', 'eez', lambda out: build_identity_index(paths['eez_full'])),
+        ('correct_kiribati', 'eez', lambda out: correct_kiribati(out['compute_rates'], out['identity_index'])),
+        ('gscc_computer', 'cscc_db', lambda out: gscc_computer(paths['cscc_db'])),
+        ('bcw_computer', 'eez', lambda out: bcw_computer(
+            out['correct_kiribati'].copy(), CMOL, out['gscc_computer'], paths['bcp'], out['identity_index'])),
+    ]
+
+
+def _rows(value) -> int:
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else None
+
+
+def run_stages(stages, memory: bool) -> Dict[str, Dict]:
+    """
+    This function executes the stages once and returns their wall and CPU times, or their peak
+    traced memory when memory=True (tracemalloc slows the stages down, so both are never measured
+    in the same run)
+    """
+    outputs, records = {}, {}
+    for name, _, func in stages:
+        gc.collect()
+        if memory:
+            tracemalloc.start()
+            outputs[name] = func(outputs)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            records[name] = {'peak_mb': peak / 1024 ** 2}
+        else:
+            wall, cpu = time.perf_counter(), time.process_time()
+            outputs[name] = func(outputs)
+            records[name] = {'wall_s': time.perf_counter() - wall, 'cpu_s': time.process_time() - cpu,
+                             'rows_out': _rows(outputs[name])}
+    return records
+
+
+def benchmark_scale(scale: float, args) -> Dict:
+    """
+    This function generates the inputs at a scale and measures every stage on them
+    """
+    workdir = args.workdir or tempfile.mkdtemp(prefix=f'bcw-bench-{scale:g}-')
+    workdir = os.path.join(workdir, f'scale-{scale:g}') if args.workdir else workdir
+    start = time.perf_counter()
+    inputs = write_inputs(workdir, scale, args.seed, excel=args.excel)
+    generation = time.perf_counter() - start
+    paths = {name: os.path.abspath(path) for name, path in inputs['paths'].items()}
+    paths['rates'] = os.path.abspath(os.path.join('data_source', 'shp', 'sequestration_rates.json'))
+    stages = pipeline_stages(paths)
+
+    # stages write their outputs relative to the working directory, and parse the inputs every time;
+    # the tables are written within the stages, so no write is left over when the workdir is left
+    cwd, enabled, cache_dir = os.getcwd(), cache.ENABLED, cache.CACHE_DIR
+    background = sinks.BACKGROUND
+    os.chdir(workdir)
+    cache.configure(enabled=False, cache_dir=os.path.join(workdir, '.bcw_cache'))
+    sinks.configure(background=False)
+    try:
+        runs = [run_stages(stages, memory=False) for _ in range(args.repeat)]
+        memory = None if args.no_memory else run_stages(stages, memory=True)
+    finally:
+        try:
+            sinks.flush()
+        finally:
+            os.chdir(cwd)
+            cache.configure(enabled=enabled, cache_dir=cache_dir)
+            sinks.configure(background=background)
+            if not args.workdir:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {}
+    for name, driver, _ in stages:
+        best = min(runs, key=lambda run: run[name]['wall_s'])[name]
+        results[name] = dict(best, rows_in=inputs['rows'][driver])
+        if memory is not None:
+            results[name].update(memory[name])
+        print(f"  {name:<20} {best['wall_s']:>9.3f}s wall {best['cpu_s']:>9.3f}s cpu"
+              + (f" {memory[name]['peak_mb']:>10.1f} MB" if memory is not None else ''))
+    return {'rows': inputs['rows'], 'generation_s': generation, 'stages': results}
+
+
+def scaling_report(scales: Dict[str, Dict], tolerance: float, min_seconds: float) -> Dict[str, List[Dict]]:
+    """
+    This function estimates, for every stage and pair of consecutive scales, the exponent k of
+    time ~ rows ** k (and of memory), and flags the stages whose time grows worse than linearly
+    """
+    report = {}
+    keys = sorted(scales, key=float)
+    for small, large in zip(keys, keys[1:]):
+        for name, stage in scales[large]['stages'].items():
+            before = scales[small]['stages'].get(name)
+            if before is None or stage['rows_in'] <= before['rows_in']:
+                continue
+            growth = math.log(stage['rows_in'] / before['rows_in'])
+            entry = {'from': float(small), 'to': float(large),
+                     'time_exponent': math.log(max(stage['wall_s'], 1e-9) / max(before['wall_s'], 1e-9)) / growth}
+            if 'peak_mb' in stage and 'peak_mb' in before:
+                entry['memory_exponent'] = math.log(max(stage['peak_mb'], 1e-6) / max(before['peak_mb'], 1e-6)) / growth
+            entry['superlinear'] = bool(entry['time_exponent'] > 1 + tolerance and stage['wall_s'] >= min_seconds)
+            report.setdefault(name, []).append(entry)
+    return report
+
+
+def compare(current: Dict, previous: Dict, threshold: float, min_seconds: float) -> List[Dict]:
+    """
+    This function returns the stages that are more than `threshold` slower than in a previous run,
+    at the same scale
+    """
+    regressions = []
+    if previous.get('excel') != current['excel']:
+        return regressions # parsing .xlsx and .csv inputs are not comparable
+    for scale, result in current['scales'].items():
+        before = previous.get('scales', {}).get(scale)
+        if before is None or before['rows'] != result['rows']:
+            continue
+        for name, stage in result['stages'].items():
+            old = before['stages'].get(name)
+            if old is None:
+                continue
+            ratio = stage['wall_s'] / max(old['wall_s'], 1e-9)
+            if ratio > 1 + threshold and stage['wall_s'] >= min_seconds:
+                regressions.append({'scale': float(scale), 'stage': name, 'ratio': ratio,
+                                    'wall_s': stage['wall_s'], 'previous_wall_s': old['wall_s']})
+    return regressions
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'seed': args.seed, 'repeat': args.repeat, 'excel': args.excel,
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'numpy': np.__version__, 'pandas': pd.__version__},
+        'scales': {},
+    }
+    for scale in args.scales:
+        print(f"scale {scale:g}x")
+        results['scales'][f'{scale:g}'] = benchmark_scale(scale, args)
+
+    results['scaling'] = scaling_report(results['scales'], args.tolerance, args.min_seconds)
+    flagged = [(name, entry) for name, entries in results['scaling'].items() for entry in entries if entry['superlinear']]
+    for name, entry in flagged:
+        print(f"WORSE THAN LINEAR: {name} from {entry['from']:g}x to {entry['to']:g}x "
+              f"(time ~ rows^{entry['time_exponent']:.2f})")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        results['compared_with'] = os.path.abspath(args.compare)
+        results['regressions'] = compare(results, previous, args.regression, args.min_seconds)
+        for reg in results['regressions']:
+            print(f"REGRESSION: {reg['stage']} at {reg['scale']:g}x is {reg['ratio']:.2f}x slower "
+                  f"({reg['previous_wall_s']:.3f}s -> {reg['wall_s']:.3f}s)")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {output}")
+
+    sys.exit(1 if flagged or results.get('regressions') else 0)
@@ -0,0 +1,230 @@
+# Seedable synthetic inputs with the schemas of the real data files, at any multiple of their size
+import os
+import string
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+
+# number of rows of the real files, i.e. the inputs at scale 1
+BASE_ROWS = {
+    'eez': 328,
+    'saltmarshes': 49,
+    'seagrasses': 131,
+    'mangroves': 128,
+    'bcp': 127,
+    'countries': 170, # countries of cscc_db, each repeated for every scenario of CSCC_SCENARIOS
+}
+EXCEL_MAX_ROWS = 1_048_575
+
+# share of each POL_TYPE in data_EEZ_areas_by_zone.xlsx
+POL_TYPES = {'Union EEZ and country': 0.713, 'Landlocked country': 0.125,
+             'Overlapping claim': 0.098, 'Joint regime (EEZ)': 0.064}
+KIRIBATI_GROUPS = ["Line Group", "Gilbert Islands", "Phoenix Group"]
+SELECT = ['UNION', 'TERRITORY1', 'ISO_TER1', 'SOVEREIGN1']
+AREA_COLUMNS = {'saltmarshes': 'saltmarshes_area_km2', 'seagrasses': 'seagrasses_area_km2',
+                'mangroves': 'mangroves_area_km2'}
+
+# scenarios of the cscc_db rows, the default scenario of compute_bcw being one of them
+CSCC_SCENARIOS = pd.DataFrame(
+    [(run, dmg, climate, prtp, eta, dr)
+     for run in ['bhm_sr', 'bhm_richpoor_sr', 'bhm_lr', 'bhm_richpoor_lr', 'djo']
+     for dmg in ['bootstrap', 'estimates']
+     for climate in ['uncertain', 'expected']
+     for prtp, eta, dr in [(np.nan, np.nan, 3.), (2., 1.5, np.nan)]],
+    columns=['run', 'dmgfuncpar', 'climate', 'prtp', 'eta', 'dr']
+)
+
+
+def iso_codes(n: int) -> np.ndarray:
+    """
+    This function returns n three-letter codes (AAA, AAB, ...), repeating them after the 17,576th
+    as grid cells of the same country share its code
+    """
+    letters = np.array(list(string.ascii_uppercase))
+    i = np.arange(n) % 26 ** 3
+    return np.char.add(np.char.add(letters[i // 676], letters[i // 26 % 26]), letters[i % 26])
+
+
+def eez_table(scale: float, seed: int = 0) -> pd.DataFrame:
+    """
+    This function generates the EEZ table (columns of EEZ_full.csv and data_EEZ_areas_by_zone.xlsx)
+    with BASE_ROWS['eez'] * scale rows: main territories, overseas territories, landlocked
+    countries, overlapping claims, joint regimes and the island groups of Kiribati.
+    """
+    rng = np.random.default_rng(seed)
+    n = max(int(BASE_ROWS['eez'] * scale), 8)
+    kinds = rng.choice(list(POL_TYPES), size=n, p=np.array(list(POL_TYPES.values())) / sum(POL_TYPES.values()))
+    ids = np.char.zfill(np.arange(n).astype(str), 7)
+    names = np.char.add('Territory ', ids)
+    codes = iso_codes(n)
+
+    union = names.astype(object)
+    territory = names.astype(object)
+    sovereign = names.astype(object)
+    iso = codes.astype(object)
+    # about 13% of the EEZ unions are territories of another sovereign state
+    overseas = (kinds == 'Union EEZ and country') & (rng.random(n) < 0.13)
+    owners = rng.integers(0, n, size=n)
+    territory[overseas] = np.char.add('Island of ', ids[overseas])
+    sovereign[overseas] = names[owners[overseas]]
+    claims = kinds == 'Overlapping claim'
+    union[claims] = np.char.add('Overlapping claim ', ids[claims])
+    territory[claims] = union[claims]
+    iso[claims] = None
+    joint = kinds == 'Joint regime (EEZ)'
+    union[joint] = np.char.add('Joint regime area ', ids[joint])
+    territory[joint] = union[joint]
+    iso[joint] = None
+
+    union[:3] = territory[:3] = KIRIBATI_GROUPS
+    sovereign[:3] = 'Kiribati'
+    iso[:3] = 'KIR'
+    kinds[:3] = 'Union EEZ and country'
+
+    area = rng.lognormal(mean=11, sigma=1.5, size=n)
+    return pd.DataFrame({
+        'UNION': union, 'MRGID_EEZ': np.arange(n) + 8000, 'TERRITORY1': territory,
+        'MRGID_TER1': np.arange(n) + 2000, 'ISO_TER1': iso, 'SOVEREIGN1': sovereign,
+        'MRGID_SOV1': np.arange(n) + 2000, 'ISO_SOV1': codes, 'POL_TYPE': kinds,
+        'AREA_KM2': area.round().astype(np.int64), 'a': area,
+    })
+
+
+def habitat_table(eez: pd.DataFrame, ecosystem: str, scale: float, seed: int = 0) -> pd.DataFrame:
+    """
+    This function generates the areas of an ecosystem (columns of data_*_areas_by_country.xlsx)
+    in BASE_ROWS[ecosystem] * scale EEZs drawn from `eez`
+    """
+    rng = np.random.default_rng([seed, list(AREA_COLUMNS).index(ecosystem)])
+    n = min(max(int(BASE_ROWS[ecosystem] * scale), 1), len(eez))
+    rows = eez.iloc[np.sort(rng.choice(len(eez), size=n, replace=False))]
+    table = rows[['UNION', 'MRGID_EEZ', 'TERRITORY1', 'MRGID_TER1', 'ISO_TER1', 'SOVEREIGN1', 'a']].copy()
+    table[AREA_COLUMNS[ecosystem]] = rng.lognormal(mean=4, sigma=2, size=n)
+    return table.reset_index(drop=True)
+
+
+def economy_tables(eez: pd.DataFrame, seed: int = 0) -> Dict[str, pd.DataFrame]:
+    """
+    This function generates the country-level files of data_source/economy, one row (or one row
+    per year) per ISO3 code of `eez`
+    """
+    rng = np.random.default_rng([seed, 10])
+    codes = eez['ISO_TER1'].dropna().unique()
+    names = eez.drop_duplicates('ISO_TER1').set_index('ISO_TER1').loc[codes, 'TERRITORY1'].to_numpy()
+    n = len(codes)
+    years = np.arange(2000, 2024)
+    return {
+        'country_classification': pd.DataFrame({
+            'World': names, 'ISO': codes,
+            'Continent': rng.choice(['Africa', 'Americas', 'Asia', 'Europe', 'Oceania'], size=n),
+            'Groups': rng.choice(['Developed economies', 'LDCs', 'SIDS', 'Developing economies'], size=n),
+        }),
+        'population': pd.DataFrame({
+            'Region, subregion, country or area *': names, 'ISO3 Alpha-code': codes,
+            'Total Population, as of 1 January (thousands)': rng.lognormal(8, 2, size=n),
+            'Total Population, as of 1 July (thousands)': rng.lognormal(8, 2, size=n),
+        }),
+        'gdp': pd.DataFrame({
+            'Country Name': names, 'Country Code': codes,
+            'GDP per capita (constant 2015 US$)': rng.lognormal(9, 1, size=n), 'Year': 2023,
+            'GDP (constant 2015 US$)': rng.lognormal(24, 2, size=n), 'Year.1': 2023,
+        }),
+        'annual-co2-emissions-per-country': pd.DataFrame({
+            'Entity': np.repeat(names, len(years)), 'Code': np.repeat(codes, len(years)),
+            'Year': np.tile(years, n), 'Annual CO₂ emissions': rng.lognormal(16, 2, size=n * len(years)),
+        }),
+        'TotalExternalDebt': pd.DataFrame({
+            'economy': codes, 'YR2023_2015US$': rng.lognormal(22, 2, size=n),
+        }),
+    }
+
+
+def bcp_table(eez: pd.DataFrame, scale: float, seed: int = 0) -> pd.DataFrame:
+    """
+    This function generates BCP_dta.csv for BASE_ROWS['bcp'] * scale main territories of `eez`
+    """
+    rng = np.random.default_rng([seed, 20])
+    main = eez[(eez['POL_TYPE'] == 'Union EEZ and country') & (eez['UNION'] == eez['TERRITORY1'])]
+    main = main.drop_duplicates('ISO_TER1')
+    n = min(max(int(BASE_ROWS['bcp'] * scale), 1), len(main))
+    rows = main.iloc[np.sort(rng.choice(len(main), size=n, replace=False))]
+    return pd.DataFrame({
+        'ISO3': rows['ISO_TER1'].to_numpy(), 'Country': rows['UNION'].to_numpy(),
+        'BCP sequestration in EEZ (GtC/year)': rng.lognormal(-8, 2, size=n),
+        'Area.EEZ (km2)': rows['a'].to_numpy(),
+        'Continent': rng.choice(['Africa', 'Americas', 'Asia', 'Europe', 'Oceania'], size=n),
+    })
+
+
+def write_cscc_db(path: str, eez: pd.DataFrame, scale: float, seed: int = 0,
+                  chunk_rows: int = 2_000_000) -> int:
+    """
+    This function writes a cscc_db_v2 file with BASE_ROWS['countries'] * scale country rows (plus
+    'WLD') for every scenario of CSCC_SCENARIOS, by chunks of about `chunk_rows` rows so that
+    large scales are never held in memory. Returns the number of rows written.
+    """
+    rng = np.random.default_rng([seed, 30])
+    codes = eez['ISO_TER1'].dropna().unique()
+    n = max(int(BASE_ROWS['countries'] * scale), 1)
+    countries = np.append(codes[np.arange(n) % len(codes)], 'WLD')
+
+    per_chunk = max(chunk_rows // len(countries), 1)
+    written = 0
+    for start in range(0, len(CSCC_SCENARIOS), per_chunk):
+        scenarios = CSCC_SCENARIOS.iloc[start:start + per_chunk]
+        k, m = len(scenarios), len(countries)
+        median = rng.normal(1, 3, size=k * m)
+        chunk = pd.DataFrame({
+            'run': scenarios['run'].to_numpy().repeat(m), 'dmgfuncpar': scenarios['dmgfuncpar'].to_numpy().repeat(m),
+            'climate': scenarios['climate'].to_numpy().repeat(m), 'SSP': 'SSP2', 'RCP': 'rcp60', 'N': 1000,
+            'ISO3': np.tile(countries, k),
+            'prtp': scenarios['prtp'].to_numpy().repeat(m), 'eta': scenarios['eta'].to_numpy().repeat(m),
+            'dr': scenarios['dr'].to_numpy().repeat(m),
+            '16.7%': median - np.abs(rng.normal(0, 2, size=k * m)), '50%': median,
+            '83.3%': median + np.abs(rng.normal(0, 2, size=k * m)),
+        })
+        chunk.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False)
+        written += len(chunk)
+    return written
+
+
+def write_inputs(directory: str, scale: float, seed: int = 0, excel: bool = False) -> Dict:
+    """
+    This function writes every input of main.py, generated at `scale` times the size of the real
+    data, under `directory` with the layout of data_source/, and returns their paths and row counts.
+    With excel=True, the files read from .xlsx by main.py are written as .xlsx when they fit in a
+    sheet (they are written as .csv otherwise, which every loader also accepts).
+    """
+    shp = os.path.join(directory, 'data_source', 'shp')
+    economy = os.path.join(directory, 'data_source', 'economy')
+    for sub in ['shp', 'economy', 'bcp', 'gscc', 'summary']:
+        os.makedirs(os.path.join(directory, 'data_source', sub), exist_ok=True)
+
+    def write(table, folder, name, xlsx, sheet_name='Sheet1'):
+        if xlsx and excel and len(table) <= EXCEL_MAX_ROWS:
+            path = os.path.join(folder, f'{name}.xlsx')
+            table.to_excel(path, sheet_name=sheet_name, index=False)
+        else:
+            path = os.path.join(folder, f'{name}.csv')
+            table.to_csv(path, index=False)
+        return path
+
+    eez = eez_table(scale, seed)
+    paths = {'eez': write(eez, shp, 'data_EEZ_areas_by_zone', True),
+             'eez_full': write(eez, shp, 'EEZ_full', False)}
+    rows = {'eez': len(eez)}
+    for ecosystem in AREA_COLUMNS:
+        table = habitat_table(eez, ecosystem, scale, seed)
+        paths[ecosystem] = write(table, shp, f'data_{ecosystem}_areas_by_country', True)
+        rows[ecosystem] = len(table)
+    for name, table in economy_tables(eez, seed).items():
+        paths[name] = write(table, economy, name, name in ('population', 'gdp'),
+                            sheet_name='GDP' if name == 'gdp' else 'Sheet1')
+        rows[name] = len(table)
+    bcp = bcp_table(eez, scale, seed)
+    paths['bcp'] = write(bcp, os.path.join(directory, 'data_source', 'bcp'), 'BCP_dta', False)
+    rows['bcp'] = len(bcp)
+    paths['cscc_db'] = os.path.join(directory, 'data_source', 'gscc', 'cscc_db_v2.csv')
+    rows['cscc_db'] = write_cscc_db(paths['cscc_db'], eez, scale, seed)
+    return {'paths': paths, 'rows': rows}
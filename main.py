@@ -1,9 +1,53 @@
-from utils.bce_areas import generate_bce_data, compute_rates
+from utils.bce_areas import bce_load_tasks, combine_bce_data, compute_rates
 from utils.compute_bcw import gscc_computer, bcw_computer
-from utils.adding_eco_data import add_eco_data
+from utils.identity import load_identity_index
+from utils.adding_eco_data import add_eco_data, default_sources, source_load_tasks
 from utils.functions import correct_kiribati, per_capita
-# import pandas as pd
+from utils.monte_carlo import bcw_monte_carlo
+from utils.panel import bcw_panel, write_panel
+from utils.summaries import summary_tables
+from utils.maps import render_maps
+from utils.delta import build_baseline
+from utils.partitioned import partitioned_bce_data
+from utils import cache, compact, instrument, loader, partitioned, pipeline, sinks
+from utils.pipeline import Stage
+import argparse
+import os
+import pandas as pd
 
+parser = argparse.ArgumentParser(description='Compute the Blue Carbon Wealth of nations')
+parser.add_argument('--no-cache', action='store_true', help='parse the Excel inputs without using the cache')
+parser.add_argument('--clear-cache', action='store_true', help='delete the cached Excel sheets before running')
+parser.add_argument('--monte-carlo', type=int, default=0, metavar='N',
+                    help='also estimate BCW confidence intervals from N Monte Carlo samples')
+parser.add_argument('--seed', type=int, default=None, help='seed of the Monte Carlo samples')
+parser.add_argument('--force', action='store_true', help='execute every stage even if its output is memoized')
+parser.add_argument('--dry-run', action='store_true', help='only report the stages that would be executed')
+parser.add_argument('--workers', type=int, default=None, help='number of processes used by the Monte Carlo mode and the maps')
+parser.add_argument('--panel', nargs='?', const='data_source/summary/bcw_panel.csv', default=None, metavar='PATH',
+                    help='also save the (territory x year) panel of the BCW ratios to PATH (.csv or .parquet)')
+parser.add_argument('--summaries', action='store_true',
+                    help='also rebuild the summary tables of data_source/summary/ from the aggregation cube, in summaries/')
+parser.add_argument('--maps', nargs='?', const='figures', default=None, metavar='DIR',
+                    help='also render the choropleth maps of the BCW to DIR (default: figures), '
+                         'with --workers processes')
+parser.add_argument('--grid', default=None, metavar='DIR',
+                    help='compute the BCE areas from the grid-cell habitat files of DIR (<area column>.parquet or .csv), '
+                         'streamed by partitions of EEZs summed by --workers processes')
+parser.add_argument('--partitions', type=int, default=partitioned.PARTITIONS,
+                    help='number of partitions of the --grid inputs (a partition must fit in memory)')
+parser.add_argument('--output-format', choices=list(sinks.FORMATS), default='csv',
+                    help='format of the output tables (csv.gz, parquet and feather files are compressed)')
+parser.add_argument('--no-intermediate', action='store_true',
+                    help='do not write the intermediate tables (bce_data, bcw_data_before_grouping)')
+parser.add_argument('--sequential-load', action='store_true',
+                    help='read the input files one after another instead of concurrently (for debugging)')
+parser.add_argument('--compact', action='store_true',
+                    help='store the stage outputs with categorical and Arrow string columns, downcast integers '
+                         'and copy-on-write (also enabled by BCW_COMPACT=1) and report their memory')
+parser.add_argument('--profile', nargs='?', const='bcw_profile.json', default=None, metavar='PATH',
+                    help='record the time, memory, rows and bytes read of every step (also enabled by BCW_PROFILE=1) '
+                         'and save the trace to PATH (default: bcw_profile.json) with a .folded flame graph')
 
 # ==========================
 # CONSTANTS AND PATHS
@@ -29,45 +73,188 @@ cb_path = r'data_source\economy\annual-co2-emissions-per-country.csv'
 debt_path = r'data_source\economy\TotalExternalDebt.csv'
 
 bcp_path = r'data_source\bcp\BCP_dta.csv'
+eez_full_path = r'data_source\shp\EEZ_full.csv'
 
 # ==========================
-# PREPARING THE DATA
+# PIPELINE STAGES
 # ==========================
-# BCEs areas by EEZs
-bce_areas_df = generate_bce_data(eez_path,
-                                 saltmarshes_path, saltmarshes_area_col,
-                                 seagrasses_path, seagrasses_area_col, 
-                                 mangroves_path, mangroves_area_col, select)
+def load_inputs_stage(eez_path, saltmarshes_path, seagrasses_path, mangroves_path,
+                      group_path, pop_path, gdp_path, cb_path, debt_path, area_cols, select):
+    # the BCE and economic files are independent, so they are all read at once (the uncached
+    # .xlsx files in processes, main.py being guarded by __name__ == '__main__')
+    bce_tasks = bce_load_tasks(eez_path, dict(zip(area_cols, [saltmarshes_path, seagrasses_path, mangroves_path])), select)
+    eco_tasks = source_load_tasks(default_sources(group_path, pop_path, gdp_path, cb_path, debt_path))
+    frames = loader.load_all(bce_tasks + eco_tasks, processes=True)
+    return {'bce': {task.name: frames[task.name] for task in bce_tasks},
+            'eco': [frames[task.name] for task in eco_tasks]}
 
-# Adding other data
-bce_areas_df = add_eco_data(bce_areas_df, group_path, pop_path, gdp_path, cb_path, debt_path)
+def bce_areas_stage(inputs, area_cols):
+    return combine_bce_data(inputs['bce'], area_cols)
 
-# Compute BCEs sequestration rates
-bce_columns = [saltmarshes_area_col, seagrasses_area_col, mangroves_area_col]
-bce_df = compute_rates(bce_areas_df, json_path, bce_columns)
-bce_df = correct_kiribati(bce_df)
-bce_df.to_csv('data_source/summary/bce_data.csv', index=False)
+def kiribati_stage(df, eez_full_path):
+    # the island groups of Kiribati are found through the identity index of EEZ_full.csv
+    return correct_kiribati(df, load_identity_index(eez_full_path))
 
-# ==========================
-# COMPUTE BCW
-# ==========================
-# GSCC value
-gscc_value = gscc_computer(gscc_path)
+def bcw_stage(df, gscc, bcp_path, eez_full_path, cmol):
+    # the BCP data and the claims are joined through the identity index of EEZ_full.csv
+    return bcw_computer(df, cmol, gscc, bcp_path, load_identity_index(eez_full_path))
+
+def grid_bce_areas_stage(eez_path, saltmarshes_path, seagrasses_path, mangroves_path, area_cols, select):
+    # grid-cell inputs do not fit in memory, they are streamed and summed by partitions of EEZs
+    return partitioned_bce_data(eez_path, dict(zip(area_cols, [saltmarshes_path, seagrasses_path, mangroves_path])), select)
+
+def grid_paths(directory, area_cols):
+    paths = [os.path.join(directory, f'{col}.parquet') for col in area_cols]
+    return [path if os.path.exists(path) else path[:-len('.parquet')] + '.csv' for path in paths]
+
+def eco_data_stage(df, inputs, group_path, pop_path, gdp_path, cb_path, debt_path):
+    return add_eco_data(df, group_path, pop_path, gdp_path, cb_path, debt_path, tables=inputs['eco'])
 
 # Carbon to CO2 convertion
 cmol = 44 / 12
 
-# BCW computation
-data = bcw_computer(bce_df, cmol, gscc_value, bcp_path)
+bce_columns = [saltmarshes_area_col, seagrasses_area_col, mangroves_area_col]
 pcap_cols = ['Area_EEZ_KM2', 'GDP', 'CO2_emissions_2023', 'Debt (2015 US$)', 'Total BCW']
-data = per_capita(data, pcap_cols, 'Population')
 
-print("========================")
-print("SUMMARY")
-print("========================")
-print(f"Global Social Cost of Carbon (GSCC): {gscc_value:.2f} US$/tCO2")
-print(f"number of countries/territories: {data.shape[0]}")
-print(f"Global BCW : {(data['Total BCW'].sum() / 1e12):.3f} trillion US$")
+stages = [
+    # Concurrent reading of the BCE areas and economic data files
+    Stage('inputs', load_inputs_stage,
+          inputs={'eez_path': eez_path, 'saltmarshes_path': saltmarshes_path,
+                  'seagrasses_path': seagrasses_path, 'mangroves_path': mangroves_path,
+                  'group_path': group_path, 'pop_path': pop_path, 'gdp_path': gdp_path,
+                  'cb_path': cb_path, 'debt_path': debt_path},
+          params={'area_cols': bce_columns, 'select': select}),
+    # BCEs areas by EEZs
+    Stage('bce_areas', bce_areas_stage, deps={'inputs': 'inputs'}, params={'area_cols': bce_columns}),
+    # Adding other data
+    Stage('eco_data', eco_data_stage,
+          inputs={'group_path': group_path, 'pop_path': pop_path, 'gdp_path': gdp_path,
+                  'cb_path': cb_path, 'debt_path': debt_path},
+          deps={'df': 'bce_areas', 'inputs': 'inputs'}),
+    # Compute BCEs sequestration rates
+    Stage('rates', compute_rates, inputs={'json_path': json_path}, deps={'df': 'eco_data'},
+          params={'bce_columns': bce_columns}),
+    Stage('kiribati', kiribati_stage, inputs={'eez_full_path': eez_full_path}, deps={'df': 'rates'}),
+    # GSCC value
+    Stage('gscc', gscc_computer, inputs={'path': gscc_path}),
+    # BCW computation
+    Stage('bcw', bcw_stage, inputs={'bcp_path': bcp_path, 'eez_full_path': eez_full_path}, deps={'df': 'kiribati', 'gscc': 'gscc'},
+          params={'cmol': cmol}),
+    Stage('per_capita', per_capita, deps={'df': 'bcw'},
+          params={'columns': pcap_cols, 'pop_columns': 'Population'}),
+    # Year panel of the BCW ratios (only computed with --panel)
+    Stage('panel', bcw_panel,
+          inputs={'pop_path': pop_path, 'gdp_path': gdp_path, 'cb_path': cb_path, 'debt_path': debt_path},
+          deps={'df': 'bcw'}),
+    # Summary tables by continent, development group and ecosystem (only computed with --summaries)
+    Stage('summaries', summary_tables, deps={'df': 'per_capita'}),
+    # Tables of the overrides delta recomputation (see utils/delta.py), never a target of main.py
+    Stage('baseline', build_baseline,
+          inputs={'json_path': json_path, 'bcp_path': bcp_path, 'eez_full_path': eez_full_path},
+          deps={'eco_data': 'eco_data', 'rates': 'rates', 'kiribati': 'kiribati', 'bcw': 'bcw',
+                'per_capita': 'per_capita', 'gscc': 'gscc'},
+          params={'bce_columns': bce_columns, 'cmol': cmol, 'pcap_cols': pcap_cols, 'pop_column': 'Population'}),
+]
+targets = ['kiribati', 'gscc', 'per_capita']
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if args.clear_cache:
+        cache.clear_cache()
+        pipeline.clear()
+    cache.configure(enabled=not args.no_cache)
+    if args.compact or compact.ENABLED:
+        compact.configure(enabled=True)
+    sinks.configure(sink=args.output_format, intermediate=not args.no_intermediate)
+    if args.sequential_load:
+        loader.configure(sequential=True)
+    if args.profile or instrument.ENABLED:
+        instrument.configure(enabled=True)
+        args.profile = args.profile or 'bcw_profile.json'
+
+    if args.grid:
+        partitioned.configure(partitions=args.partitions, workers=args.workers)
+        salt, seag, mang = grid_paths(args.grid, bce_columns)
+        grid = Stage('bce_areas', grid_bce_areas_stage,
+                     inputs={'eez_path': eez_path, 'saltmarshes_path': salt, 'seagrasses_path': seag, 'mangroves_path': mang},
+                     params={'area_cols': bce_columns, 'select': select})
+        stages = [grid if stage.name == 'bce_areas' else stage for stage in stages]
+
+    if args.panel:
+        targets = targets + ['panel']
+    if args.summaries:
+        targets = targets + ['summaries']
+
+    if args.dry_run:
+        to_run = pipeline.plan(stages, targets, force=args.force)
+        needed = pipeline.plan(stages, targets, force=True)
+        for stage in [stage for stage in stages if stage.name in needed]:
+            print(f"[{stage.name}] {'would execute' if stage.name in to_run else 'cached'}")
+        raise SystemExit(0)
+
+    # ==========================
+    # RUNNING THE PIPELINE
+    # ==========================
+    results = pipeline.run(stages, targets, force=args.force)
+
+    bce_df = results['kiribati']
+    sinks.publish('bce_data', bce_df, intermediate=True)
+    gscc_value = results['gscc']
+    data = results['per_capita']
+
+    print("========================")
+    print("SUMMARY")
+    print("========================")
+    print(f"Global Social Cost of Carbon (GSCC): {gscc_value:.2f} US$/tCO2")
+    print(f"number of countries/territories: {data.shape[0]}")
+    print(f"Global BCW : {(data['Total BCW'].sum() / 1e12):.3f} trillion US$")
+
+    output_path = sinks.publish('country_level_bcw', data)
+    print(f'\nData saved to {output_path}')
+
+    if args.panel:
+        panel = results['panel']
+        write_panel(panel, args.panel)
+        print(f"Panel of {panel['year'].nunique()} years saved to {args.panel}")
+
+    if args.summaries:
+        for name, table in results['summaries'].items():
+            sinks.publish(name, table)
+        print(f"{len(results['summaries'])} summary tables saved to summaries/")
+
+    if args.maps:
+        map_paths = render_maps(data, output_dir=args.maps, workers=args.workers)
+        print(f"{len(map_paths)} maps saved to {args.maps}/")
+
+    # ==========================
+    # MONTE CARLO UNCERTAINTY
+    # ==========================
+    if args.monte_carlo > 0:
+        cscc = sinks.read('country_level_gscc')
+        rate_columns = {'saltmarshes': saltmarshes_area_col, 'seagrass': seagrasses_area_col, 'mangroves': mangroves_area_col}
+        country_ci, global_ci = bcw_monte_carlo(data, json_path, rate_columns, cscc, cmol,
+                                                n_samples=args.monte_carlo, seed=args.seed, workers=args.workers)
+        print(f"Global BCW 95% interval : {(global_ci.iloc[0] / 1e12):.3f} - {(global_ci.iloc[-1] / 1e12):.3f} trillion US$")
+        ci_path = sinks.publish('bcw_confidence_intervals', country_ci)
+        print(f'Confidence intervals saved to {ci_path}')
+
+    sinks.flush()
+
+    # ==========================
+    # MEMORY REPORT
+    # ==========================
+    report = compact.memory_report()
+    if compact.ENABLED and not report.empty:
+        print(report.to_string(index=False, float_format='{:.3f}'.format))
+        saved = 1 - report['compact_MB'].sum() / report['standard_MB'].sum()
+        print(f"Memory of the stage outputs reduced by {saved:.0%} in compact mode")
 
-data.to_csv('country_level_bcw.csv', index=False)
-print('\nData saved to country_level_bcw.csv')
\ No newline at end of file
+    # ==========================
+    # PROFILE
+    # ==========================
+    if args.profile:
+        instrument.write_trace(args.profile)
+        with pd.option_context('display.width', 200, 'display.max_colwidth', 60):
+            print(instrument.summary().head(20).to_string(float_format='{:.3f}'.format))
+        print(f'\nProfile saved to {args.profile}')
\ No newline at end of file
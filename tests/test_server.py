@@ -0,0 +1,135 @@
+# Localhost tests of the query server over the published BCW results
+#   python -m unittest tests.test_server
+import os
+import json
+import asyncio
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from utils import sinks
+from utils.server import QueryService, serve
+
+
+def results_table(n: int = 12) -> pd.DataFrame:
+    """A small country-level table with the key columns of the server and a few missing values"""
+    rng = np.random.default_rng(0)
+    codes = [f'C{i:02d}' for i in range(n)]
+    df = pd.DataFrame({
+        'country_name': [f'Country {i}' for i in range(n)],
+        'TERRITORY1': [f'Country {i}' for i in range(n)],
+        'ISO': codes,
+        'Continent': np.array(['Europe', 'Asia', 'Africa'])[np.arange(n) % 3],
+        'Groups': np.array(['SIDS', 'LDCs'])[np.arange(n) % 2],
+        'Total BCW': rng.lognormal(20, 2, size=n),
+        'Population': rng.integers(10_000, 10_000_000, size=n).astype(float),
+    })
+    df.loc[3, 'Total BCW'] = np.nan
+    df.loc[5, 'ISO'] = None
+    return df
+
+
+async def get(port: int, target: str):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode('latin-1'))
+    await writer.drain()
+    data = await reader.read()
+    writer.close()
+    head, body = data.split(b'\r\n\r\n', 1)
+    return int(head.split(b' ')[1]), json.loads(body)
+
+
+def publish(df: pd.DataFrame, path: str) -> None:
+    """Replaces the table atomically, as the sinks do"""
+    tmp = f'{path}.tmp'
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+
+class ServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'country_level_bcw.csv')
+        self.df = results_table()
+        publish(self.df, self.path)
+        self.service = QueryService(self.path, sinks.CsvSink())
+        self.server, self.watcher = await serve(self.service, port=0, poll=0.05)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.watcher.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        self.directory.cleanup()
+
+    async def test_territory(self):
+        status, rows = await get(self.port, '/territory/c04')
+        self.assertEqual(status, 200)
+        self.assertEqual([row['country_name'] for row in rows], ['Country 4'])
+        # territories without ISO3 code are found by name
+        status, rows = await get(self.port, '/territory/Country%205')
+        self.assertEqual((status, rows[0]['ISO']), (200, None))
+        status, _ = await get(self.port, '/territory/nowhere')
+        self.assertEqual(status, 404)
+
+    async def test_top(self):
+        status, rows = await get(self.port, '/top?column=Total%20BCW&n=3&continent=europe')
+        expected = self.df[self.df['Continent'] == 'Europe'].dropna(subset='Total BCW').nlargest(3, 'Total BCW')
+        self.assertEqual(status, 200)
+        self.assertEqual([row['country_name'] for row in rows], expected['country_name'].tolist())
+
+        status, rows = await get(self.port, '/top?column=Total%20BCW&n=2&ascending=1&group=LDCs')
+        expected = self.df[self.df['Groups'] == 'LDCs'].nsmallest(2, 'Total BCW')
+        self.assertEqual([row['country_name'] for row in rows], expected['country_name'].tolist())
+
+        status, rows = await get(self.port, '/top?column=Total%20BCW&iso=C07')
+        self.assertEqual([row['country_name'] for row in rows], ['Country 7'])
+
+    async def test_range(self):
+        low, high = self.df['Total BCW'].quantile([.25, .75])
+        status, rows = await get(self.port, f'/range?column=Total%20BCW&min={low}&max={high}')
+        expected = self.df[self.df['Total BCW'].between(low, high)].sort_values('Total BCW', ascending=False)
+        self.assertEqual(status, 200)
+        self.assertEqual([row['country_name'] for row in rows], expected['country_name'].tolist())
+
+    async def test_aggregate(self):
+        status, result = await get(self.port, '/aggregate?column=Total%20BCW&by=continent&stat=sum')
+        expected = self.df.groupby('Continent')['Total BCW'].sum()
+        self.assertEqual(status, 200)
+        self.assertEqual(set(result), set(expected.index))
+        for continent, value in expected.items():
+            self.assertAlmostEqual(result[continent], value, delta=1e-9 * value)
+
+        status, result = await get(self.port, '/aggregate?column=Total%20BCW')
+        self.assertEqual(result['count'], int(self.df['Total BCW'].notna().sum()))
+        self.assertAlmostEqual(result['mean'], self.df['Total BCW'].mean(), delta=1e-9 * result['mean'])
+
+    async def test_invalid_queries(self):
+        for target, status in [('/top?column=Total%20BCW&n=-1', 400), ('/top?column=Total%20BCW&n=x', 400),
+                               ('/range?column=Total%20BCW&min=nan', 400), ('/range?column=Total%20BCW&max=NaN', 400),
+                               ('/top?column=Total%20BCW&country=C01', 400), ('/aggregate?column=Total%20BCW&continent=Asia', 400),
+                               ('/aggregate?column=Total%20BCW&by=iso', 400), ('/top?column=nope', 400),
+                               ('/health?verbose=1', 400), ('/metrics/all', 404), ('/nowhere', 404)]:
+            with self.subTest(target=target):
+                self.assertEqual((await get(self.port, target))[0], status)
+
+    async def test_reload(self):
+        status, health = await get(self.port, '/health')
+        self.assertEqual((status, health['rows'], health['reloads']), (200, len(self.df), 1))
+
+        publish(results_table(20), self.path)
+        for _ in range(100):
+            await asyncio.sleep(0.05)
+            _, health = await get(self.port, '/health')
+            if health['reloads'] > 1:
+                break
+        self.assertEqual((health['reloads'], health['rows']), (2, 20))
+        _, rows = await get(self.port, '/territory/C19')
+        self.assertEqual(rows[0]['country_name'], 'Country 19')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,98 +1,158 @@
 # This script add economic social and environmental factors to the rest of data
+from dataclasses import dataclass, field
+from functools import reduce
+from typing import Any, Dict, List, Union
+
+import numpy as np
 import pandas as pd
+from utils import cache
+from utils.compact import lazy_copy
+from utils.loader import LoadTask, load_all
+from utils.instrument import traced
 
-def _add_groups(group_path: str, df: pd.DataFrame) -> pd.DataFrame:
+@dataclass
+class IndicatorSource:
     """
-    Adding informations on continents and development level categories to the dataset
+    Declaration of a country-level data file joined to the BCE areas on the ISO3 code.
+    - path : Path to the .csv/.xlsx file
+    - key : Column of the file holding the ISO3 code
+    - columns : Column of the file -> name of the column added to the dataset
+    - filters : Column of the file -> value of the rows to keep (e.g. {'Year': 2023})
+    - sheet_name : Sheet to read for .xlsx files
+    - scale : Name of an added column -> factor it is multiplied by
+    - main_territory_only : If True, values are only kept for main territories (UNION == TERRITORY1),
+      e.g. the population of France is not given to French Guiana
+    - header : Row holding the column names for .xlsx files
+    - year : For the year panel (see utils/panel.py), the year of the values of a single-year
+      source (int), or the column holding the year of files with one row per country and year (str)
+    - wide : For the year panel, the file has one column per year (e.g. the World Development
+      Indicators layout), the single entry of columns naming the indicator
     """
-    group = pd.read_csv(group_path).drop(columns='World')
-    group = group.dropna(subset='ISO')
-    merged = df.merge(
-        group, how='left', left_on='ISO_TER1', right_on='ISO'
-    ).drop(columns=['ISO'])
-    
-    return merged
+    path: str
+    key: str
+    columns: Dict[str, str]
+    filters: Dict[str, Any] = field(default_factory=dict)
+    sheet_name: Union[str, int] = 0
+    scale: Dict[str, float] = field(default_factory=dict)
+    main_territory_only: bool = True
+    header: int = 0
+    year: Union[int, str] = None
+    wide: bool = False
 
-def _add_population(pop_path: str, df: pd.DataFrame) -> pd.DataFrame:
+def default_sources(group_path: str, pop_path: str, gdp_path: str, cb_path: str,
+                    debt_path: str) -> List[IndicatorSource]:
     """
-    Adding informations on populaitons to the dataset
+    This function returns the sources joined by add_eco_data
     """
-    # import and processing the population data
-    pop = pd.read_excel(pop_path)
-    pop = pop.rename(columns={
-        'ISO3 Alpha-code': 'ISO_TER1',
-        'Total Population, as of 1 July (thousands)': 'pop_thousands'
-    })[['ISO_TER1', 'pop_thousands']]
-    pop = pop.dropna(subset='ISO_TER1')
-
-    merged = df.merge(pop, on='ISO_TER1', how='left')
-    same_territory = merged['UNION'] == merged['TERRITORY1'] # ensuring the pop correspond to the main territory
-    merged['Population'] = merged['pop_thousands'] * 1000
-    merged.loc[~same_territory, 'Population'] = pd.NA
-    merged = merged.drop(columns=['pop_thousands'])
-    
-    return merged
+    return [
+        # continents and development level categories
+        IndicatorSource(group_path, 'ISO', {'Continent': 'Continent', 'Groups': 'Groups'},
+                        main_territory_only=False),
+        IndicatorSource(pop_path, 'ISO3 Alpha-code',
+                        {'Total Population, as of 1 July (thousands)': 'Population'},
+                        scale={'Population': 1000}),
+        # we just use GDP of the last year for each country
+        IndicatorSource(gdp_path, 'Country Code', {'GDP (constant 2015 US$)': 'GDP'}, sheet_name='GDP'),
+        IndicatorSource(cb_path, 'Code', {'Annual CO₂ emissions': 'CO2_emissions_2023'}, filters={'Year': 2023}),
+        # Total external debt of 2023 (in 2015 US$)
+        IndicatorSource(debt_path, 'economy', {'YR2023_2015US$': 'Debt (2015 US$)'}),
+    ]
 
-def _add_gdp(gdp_path: str, df: pd.DataFrame) -> pd.DataFrame:
+@traced()
+def load_source(source: IndicatorSource) -> pd.DataFrame:
     """
-    Adding informations on GDP to the dataset
+    This function reads a source and returns its added columns with the ISO3 code as 'ISO_TER1'
     """
-    gdp = pd.read_excel(gdp_path, sheet_name='GDP')
-    gdp = gdp[['Country Code', 'GDP (constant 2015 US$)']] # we just use GDP of the last year for each country
-    gdp = gdp.rename(columns={
-        'Country Code': 'ISO_TER1',
-        'GDP (constant 2015 US$)': 'GDP'
-    }).dropna(subset='ISO_TER1')
-    
-    merged = df.merge(gdp, on='ISO_TER1', how='left')
-    same_territory = merged['UNION'] == merged['TERRITORY1']
-    merged.loc[~same_territory, 'GDP'] = pd.NA
+    usecols = [source.key] + [col for col in list(source.columns) + list(source.filters) if col != source.key]
+    if source.path.endswith('.csv'):
+        data = pd.read_csv(source.path, usecols=usecols)
+    elif source.path.endswith('.xlsx'):
+        data = cache.read_excel(source.path, sheet_name=source.sheet_name, usecols=usecols, header=source.header)
+    else:
+        raise ValueError("Unsupported file format. Please provide a .csv or .xlsx file.")
 
-    return merged
+    for col, value in source.filters.items():
+        data = data[data[col] == value]
+    data = data[[source.key] + list(source.columns)]
+    data.columns = ['ISO_TER1'] + list(source.columns.values())
+    data = data.dropna(subset='ISO_TER1')
+    for col, factor in source.scale.items():
+        data[col] = data[col] * factor
 
-def _add_carbon_emissions(cb_path: str, df: pd.DataFrame) -> pd.DataFrame:
+    return data
+
+def source_load_tasks(sources: List[IndicatorSource]) -> List[LoadTask]:
     """
-    Adding informations on CO2 emissions to the dataset
+    This function returns the reads of the sources, to be executed by load_all
+    (the tasks are named after the position of the source)
     """
-    cb = pd.read_csv(cb_path)
-    cb = cb[cb['Year'] == 2023][['Code', 'Annual CO₂ emissions']]
-    cb = cb.rename(columns={
-        'Code': 'ISO_TER1',
-        'Annual CO₂ emissions': 'CO2_emissions_2023'
-    }).dropna(subset='ISO_TER1')
-    
-    merged = df.merge(cb, on='ISO_TER1', how='left')
-    same_territory = merged['UNION'] == merged['TERRITORY1']
-    merged.loc[~same_territory, 'CO2_emissions_2023'] = pd.NA
-
-    return merged
+    return [LoadTask(f'source{i}', source.path, load_source, (source,)) for i, source in enumerate(sources)]
 
-def _add_debt(debt_path: str, df: pd.DataFrame) -> pd.DataFrame:
+@traced(same_rows=True)
+def add_indicators(df: pd.DataFrame, sources: List[IndicatorSource], tables: List[pd.DataFrame] = None) -> pd.DataFrame:
     """
-    Adding informations on Total external debt of 2023 (in 2015 US$) to the dataset
+    This function adds the columns of every source to the dataset in a single pass.
+
+    The sources are combined into one lookup table indexed by ISO3 code, which is aligned on the
+    'ISO_TER1' column of df at once, then the values of the main_territory_only sources are
+    removed from the rows of non-main territories with a single mask. A code appearing several
+    times in a source repeats the row, as a left merge would.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data with the 'ISO_TER1', 'UNION' and 'TERRITORY1' columns.
+    sources : list of IndicatorSource
+        Sources to add.
+    tables : list of pandas.DataFrame, optional
+        Already loaded sources (output of load_source), in the order of `sources`.
+
+    Returns
+    -------
+    pandas.DataFrame
+        df with the columns of every source.
     """
-    db = pd.read_csv(debt_path)
-    db.columns = ['ISO_TER1', 'Debt (2015 US$)']
-    db = db.dropna(subset='ISO_TER1')
-
-    merged = df.merge(db, on='ISO_TER1', how='left')
-    same_territory = merged['UNION'] == merged['TERRITORY1']
-    merged.loc[~same_territory, 'Debt (2015 US$)'] = pd.NA
-    
+    if tables is None:
+        tables = [load_source(source) for source in sources]
+    lookup = reduce(lambda left, right: left.merge(right, on='ISO_TER1', how='outer'), tables)
+    lookup = lookup.set_index('ISO_TER1')
+
+    keys = pd.Index(df['ISO_TER1'])
+    if lookup.index.is_unique:
+        positions = lookup.index.get_indexer(keys)
+        rows = np.arange(len(df))
+    else:
+        positions, _ = lookup.index.get_indexer_non_unique(keys)
+        counts = lookup.index.value_counts()
+        repeats = np.maximum(keys.map(counts).fillna(0).to_numpy(dtype=np.int64), 1)
+        rows = np.repeat(np.arange(len(df)), repeats)
+
+    missing = positions == -1
+    values = lookup.iloc[np.where(missing, 0, positions)].reset_index(drop=True)
+    values.loc[missing] = np.nan # codes absent from every source
+
+    merged = pd.concat([df.iloc[rows].reset_index(drop=True), values], axis=1)
+    masked = [col for source in sources if source.main_territory_only for col in source.columns.values()]
+    same_territory = merged['UNION'] == merged['TERRITORY1'] # ensuring the values correspond to the main territory
+    merged.loc[~same_territory, masked] = np.nan
+
     return merged
 
-def reorganize_df(df: pd.DataFrame) -> pd.DataFrame:
-    df = df[['UNION', 'TERRITORY1', 'ISO_TER1', 'SOVEREIGN1', 'Continent', 'Groups', 'Population',
-             'Area_EEZ_KM2', 'GDP', 'CO2_emissions_2023', 'Debt (2015 US$)', 'saltmarshes_area_km2', 
-             'seagrasses_area_km2', 'mangroves_area_km2']].copy()
+def reorganize_df(df: pd.DataFrame, extra_columns: List[str] = None) -> pd.DataFrame:
+    df = lazy_copy(df[['UNION', 'TERRITORY1', 'ISO_TER1', 'SOVEREIGN1', 'Continent', 'Groups', 'Population',
+                       'Area_EEZ_KM2', 'GDP', 'CO2_emissions_2023', 'Debt (2015 US$)', 'saltmarshes_area_km2',
+                       'seagrasses_area_km2', 'mangroves_area_km2'] + (extra_columns or [])])
     return df
 
+@traced()
 def add_eco_data(df: pd.DataFrame,
                   group_path: str,
                   pop_path: str,
                   gdp_path: str,
                   cb_path: str,
-                  debt_path: str) -> pd.DataFrame:
+                  debt_path: str,
+                  extra_sources: List[IndicatorSource] = None,
+                  tables: List[pd.DataFrame] = None) -> pd.DataFrame:
     """
     This function adds economic, social and environmental data to the BCE areas dataframe.
     - df : DataFrame containing BCE areas by EEZs
@@ -101,12 +161,15 @@ def add_eco_data(df: pd.DataFrame,
     - gdp_path : Path to the GDP data file
     - cb_path : Path to the CO2 emissions data file
     - debt_path : Path to the Total external debt data file
+    - extra_sources : Other indicators to add, their columns are kept after the default ones
+    - tables : Already loaded sources, in the order of default_sources then extra_sources
+      (the sources are read one after another when not given, main.py reads them concurrently)
     """
-    df = _add_groups(group_path, df)
-    df = _add_population(pop_path, df)
-    df = _add_gdp(gdp_path, df)
-    df = _add_carbon_emissions(cb_path, df)
-    df = _add_debt(debt_path, df)
-    df = reorganize_df(df)
-
-    return df
\ No newline at end of file
+    extra_sources = extra_sources or []
+    sources = default_sources(group_path, pop_path, gdp_path, cb_path, debt_path) + extra_sources
+    if tables is None:
+        tables = list(load_all(source_load_tasks(sources), sequential=True).values())
+    df = add_indicators(df, sources, tables)
+    df = reorganize_df(df, [col for source in extra_sources for col in source.columns.values()])
+
+    return df
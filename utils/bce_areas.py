@@ -3,7 +3,12 @@ import pandas as pd
 import numpy as np
 import json
 from typing import List, Dict, Any
+from utils import cache
+from utils.loader import LoadTask, load_all
+from utils.overrides import OVERRIDES, apply_overrides
+from utils.instrument import traced
 
+@traced()
 def import_data(path: str, select: List[str] = None) -> pd.DataFrame:
     """
     This function imports data from a .csv/.xlsx file located at the given path
@@ -11,15 +16,21 @@ def import_data(path: str, select: List[str] = None) -> pd.DataFrame:
     if path.endswith('.csv'):
         df = pd.read_csv(path, usecols=select)
     elif path.endswith('.xlsx'):
-        df = pd.read_excel(path, usecols=select)
+        df = cache.read_excel(path, usecols=select)
     else:
         raise ValueError("Unsupported file format. Please provide a .csv or .xlsx file.")
     
-    # concat 4 first cols
-    parts = [df.iloc[:, i].fillna('').astype(str) for i in range(4)] # handle missing values safely
-    df['concat_identifiers'] = parts[0] + parts[1] + parts[2] + parts[3]
+    df['concat_identifiers'] = concat_identifiers(df)
     return df
 
+def concat_identifiers(df: pd.DataFrame) -> pd.Series:
+    """
+    This function returns the identifier of the EEZ of every row: its 4 first columns concatenated
+    """
+    parts = [df.iloc[:, i].fillna('').astype(str) for i in range(4)] # handle missing values safely
+    return parts[0] + parts[1] + parts[2] + parts[3]
+
+@traced(same_rows=True)
 def group_data(eez: pd.DataFrame, df1: pd.DataFrame, df1_area_col: str, 
                df2: pd.DataFrame, df2_are_col: str, df3: pd.DataFrame, df3_areal_col: str) -> pd.DataFrame:
     """
@@ -44,27 +55,44 @@ def adjust_data(df: pd.DataFrame, area_cols: List[str]) -> pd.DataFrame:
     were updated based on Fu et al. (2023) and Gallagher et al. (2022), with a mean area of 
     79,757 km² ranging from 66,990 to 92,524 km². Saltmarsh and seagrass data for Mauritania 
     were refined using estimates from Pottier et al. (2021).
+    The values and their citations are listed in the OVERRIDES registry of utils/overrides.py.
+    """
+    return apply_overrides(df, OVERRIDES, columns=area_cols)
+
+def bce_load_tasks(eez_path: str, habitat_paths: Dict[str, str], select: List[str]) -> List[LoadTask]:
+    """
+    This function returns the reads of the EEZ file (named 'eez') and of the BCE files (named by
+    their area column), to be executed by load_all.
+    - habitat_paths : Area column -> path of the BCE data file
     """
-    # Update Bahamas seagrass area
-    bahamas_mask = (df['TERRITORY1'] == 'Bahamas')
-    if 'seagrasses_area_km2' in area_cols:
-        df.loc[bahamas_mask, 'seagrasses_area_km2'] = 79757.0
+    tasks = [LoadTask('eez', eez_path, import_data, (eez_path, select + ['a']))]
+    tasks += [LoadTask(col, path, import_data, (path, select + [col])) for col, path in habitat_paths.items()]
+    return tasks
 
-    # Update Mauritania saltmarsh and seagrass areas
-    mauritania_mask = (df['ISO_TER1'] == 'MRT')
-    if 'saltmarshes_area_km2' in area_cols:
-        df.loc[mauritania_mask, 'saltmarshes_area_km2'] = 23.0
-    if 'seagrasses_area_km2' in area_cols:
-        df.loc[mauritania_mask, 'seagrasses_area_km2'] = 772.0
+def combine_bce_data(frames: Dict[str, pd.DataFrame], area_cols: List[str]) -> pd.DataFrame:
+    """
+    This function merges the loaded EEZ and BCE frames (see bce_load_tasks) into the BCE areas
+    by EEZs, the area columns being kept in the order of area_cols.
+    """
+    bce_df = group_data(frames['eez'], frames[area_cols[0]], area_cols[0],
+                        frames[area_cols[1]], area_cols[1],
+                        frames[area_cols[2]], area_cols[2])
 
-    return df
+    # adjusting the data
+    bce_df = adjust_data(bce_df, area_cols)
 
+    bce_df = bce_df.drop(columns=['concat_identifiers']).rename(columns={'a':'Area_EEZ_KM2'}).sort_values(by='UNION').reset_index(drop=True)
+
+    return bce_df
+
+@traced()
 def generate_bce_data(eez_path: str, 
                       mangroves_path: str, mangroves_area_col: str,
                       saltmarshes_path: str, saltmarshes_area_col: str,
                       seagrasses_path: str, seagrasses_area_col: str, select: List[str]) -> pd.DataFrame:
     """
     This function generates a DataFrame containing BCE areas by EEZs.
+    The four files are read one after another (main.py reads them concurrently, see utils/loader.py).
     - eez_path : Path to the EEZ data file
     - mangroves_path : Path to the Mangroves data file
     - mangroves_area_col : Column name for Mangroves area
@@ -73,23 +101,13 @@ def generate_bce_data(eez_path: str,
     - seagrasses_path : Path to the Seagrasses data file
     - seagrasses_area_col : Column name for Seagrasses area
     """
+    area_cols = [mangroves_area_col, saltmarshes_area_col, seagrasses_area_col]
     # importing the data
-    eez = import_data(eez_path, select + ['a'])
-    mangroves = import_data(mangroves_path, select + [mangroves_area_col])
-    saltmarshes = import_data(saltmarshes_path, select + [saltmarshes_area_col])
-    seagrasses = import_data(seagrasses_path, select + [seagrasses_area_col])
-    
-    # merging the data
-    bce_df = group_data(eez, mangroves, mangroves_area_col,
-                        saltmarshes, saltmarshes_area_col,
-                        seagrasses, seagrasses_area_col)
-    
-    # adjusting the data
-    bce_df = adjust_data(bce_df, [mangroves_area_col, saltmarshes_area_col, seagrasses_area_col])
-    
-    bce_df = bce_df.drop(columns=['concat_identifiers']).rename(columns={'a':'Area_EEZ_KM2'}).sort_values(by='UNION').reset_index(drop=True)
+    frames = load_all(bce_load_tasks(eez_path, dict(zip(area_cols, [mangroves_path, saltmarshes_path, seagrasses_path])),
+                                     select), sequential=True)
 
-    return bce_df
+    # merging and adjusting the data
+    return combine_bce_data(frames, area_cols)
 
 def load_sequestration_json(json_path: str) -> Dict[str, Any]:
     """
@@ -119,10 +137,79 @@ def load_sequestration_json(json_path: str) -> Dict[str, Any]:
 
     return flat_dict
     
-def compute_rates(df: pd.DataFrame, json_path: str, bce_columns: List[str]) -> pd.DataFrame:
+# rate fields of sequestration_rates.json -> scenario
+RATE_SCENARIOS = {'rate': 'central', 'ci_lower': 'LOW', 'ci_upper': 'HIGH'}
+# order of the area columns when compute_rates receives a list
+LEGACY_ECOSYSTEMS = ['saltmarshes', 'seagrass', 'mangroves']
+
+def rates_matrix(json_path: str, ecosystems: List[str] = None) -> pd.DataFrame:
     """
-    Open a JSON file containing normalized sequestration rates
-    and return them as a Python dictionary.
+    This function returns the sequestration rates of sequestration_rates.json as an
+    ecosystems x scenarios table (columns 'central', 'LOW' and 'HIGH').
+    - ecosystems : Ecosystems to keep, in this order (all ecosystems of the file by default)
+    """
+    with open(json_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    ecosystems = ecosystems or list(data)
+    return pd.DataFrame(
+        [[data[eco].get(field) for field in RATE_SCENARIOS] for eco in ecosystems],
+        index=ecosystems, columns=list(RATE_SCENARIOS.values()), dtype=float
+    )
+
+def uptake_column(ecosystem: str, scenario: str = 'central') -> str:
+    """
+    This function returns the name of the column added by compute_rates for the uptake of an
+    ecosystem of sequestration_rates.json in a scenario, e.g. 'Uptake Seag LOW' for ('seagrass', 'LOW')
+    """
+    suffix = '(t/km2)' if scenario == 'central' else scenario
+    return f'Uptake {ecosystem[:4].capitalize()} {suffix}'
+
+def _uptake_columns(ecosystems: List[str], scenarios: List[str]) -> List[str]:
+    """Names of the uptake columns, scenario by scenario, followed by the totals"""
+    columns = []
+    for scenario in scenarios:
+        columns += [uptake_column(eco, scenario) for eco in ecosystems]
+    columns += ['tot_uptake (tC)' if scenario == 'central' else f'tot_upt_{scenario}' for scenario in scenarios]
+    return columns
+
+def uptake_kernel(areas: np.ndarray, rates: np.ndarray) -> np.ndarray:
+    """
+    This function computes the uptakes of every territory, ecosystem and scenario in one block.
+
+    Parameters
+    ----------
+    areas : numpy.ndarray
+        territories x ecosystems areas (km2), NaN when the ecosystem is absent.
+    rates : numpy.ndarray
+        ecosystems x scenarios sequestration rates (tC/km2/year).
+
+    Returns
+    -------
+    numpy.ndarray
+        territories x (scenarios * ecosystems + scenarios) block: the uptake of every ecosystem for
+        the first scenario, then the second one, ..., followed by the total uptake of every
+        scenario (NaN when it is 0).
+    """
+    n_ter, n_eco = areas.shape
+    n_sc = rates.shape[1]
+    block = np.empty((n_ter, n_sc * (n_eco + 1)))
+
+    # territories x scenarios x ecosystems view of the uptake part of the block
+    uptakes = block[:, :n_sc * n_eco].reshape(n_ter, n_sc, n_eco)
+    np.multiply(areas[:, None, :], rates.T[None, :, :], out=uptakes)
+
+    # totals are summed ecosystem after ecosystem, as DataFrame.sum(axis=1) does
+    totals = block[:, n_sc * n_eco:]
+    np.nansum(uptakes, axis=2, out=totals)
+    totals[totals == 0] = np.nan
+
+    return block
+    
+@traced(same_rows=True)
+def compute_rates(df: pd.DataFrame, json_path: str, bce_columns, extra_rates: pd.DataFrame = None) -> pd.DataFrame:
+    """
+    Compute the carbon uptakes of every BCE and EEZ from the sequestration rates
+    of a JSON file.
 
     Paramètres
     ----------
@@ -130,47 +217,31 @@ def compute_rates(df: pd.DataFrame, json_path: str, bce_columns: List[str]) -> p
         DataFrame containing data on BCEs areas in km2 by EEZs.
     json_path : str
         Path of the JSON file.
-    bce_columns : List
-        List of BCE area column names in the DataFrame, in this order : saltmarshes, seagrasses, mangroves
+    bce_columns : List or Dict
+        Either the list of BCE area column names in the DataFrame, in this order : saltmarshes,
+        seagrasses, mangroves ; or a dictionary ecosystem of the JSON file -> area column name,
+        e.g. to add kelp or tidal flats.
+    extra_rates : pd.DataFrame, optional
+        Other rate scenarios, as an ecosystems x scenarios table, computed together with the
+        central, LOW and HIGH scenarios of the JSON file.
 
     Return
     ------
     Dataframe
         DataFrame containing sequestration rates by BCEs and EEZs.
     """
+    if not isinstance(bce_columns, dict):
+        bce_columns = dict(zip(LEGACY_ECOSYSTEMS, bce_columns))
+    ecosystems = list(bce_columns)
+
     # Loading sequestration rates
-    rates = load_sequestration_json(json_path)
-    mangroves_sr = rates['mangroves_sr']
-    mangroves_sr_low = rates['mangroves_sr_low']
-    mangroves_sr_high = rates['mangroves_sr_high']
-    saltmarshes_sr = rates['saltmarshes_sr']
-    saltmarshes_sr_low = rates['saltmarshes_sr_low']
-    saltmarshes_sr_high = rates['saltmarshes_sr_high']
-    seagrass_sr = rates['seagrass_sr']
-    seagrass_sr_high = rates['seagrass_sr_high']
-    seagrass_sr_low = rates['seagrass_sr_low']
-    
-    saltmarshes_col = bce_columns[0]
-    seagrasses_col = bce_columns[1]
-    mangroves_col = bce_columns[2]
-    
-    # compute uptakes
-    df['Uptake Salt (t/km2)'] = df[saltmarshes_col] * saltmarshes_sr
-    df['Uptake Seag (t/km2)'] = df[seagrasses_col] * seagrass_sr
-    df['Uptake Mang (t/km2)'] = df[mangroves_col] * mangroves_sr
-    df['Uptake Salt LOW'] = df[saltmarshes_col] * saltmarshes_sr_low
-    df['Uptake Seag LOW'] = df[seagrasses_col] * seagrass_sr_low
-    df['Uptake Mang LOW'] = df[mangroves_col] * mangroves_sr_low
-    df['Uptake Salt HIGH'] = df[saltmarshes_col] *  saltmarshes_sr_high
-    df['Uptake Seag HIGH'] = df[seagrasses_col] * seagrass_sr_high
-    df['Uptake Mang HIGH'] = df[mangroves_col] * mangroves_sr_high
-    
-    # compute total uptake
-    df['tot_uptake (tC)'] = df[['Uptake Salt (t/km2)', 'Uptake Seag (t/km2)', 
-                                'Uptake Mang (t/km2)']].sum(axis=1).replace(0, np.nan)
-    df['tot_upt_LOW'] = df[['Uptake Salt LOW', 'Uptake Seag LOW', 
-                            'Uptake Mang LOW']].sum(axis=1).replace(0, np.nan)
-    df['tot_upt_HIGH'] = df[['Uptake Salt HIGH', 'Uptake Seag HIGH', 
-                             'Uptake Mang HIGH']].sum(axis=1).replace(0, np.nan)
+    rates = rates_matrix(json_path, ecosystems)
+    if extra_rates is not None:
+        rates = pd.concat([rates, extra_rates.loc[ecosystems]], axis=1)
+
+    # compute uptakes and total uptakes
+    areas = df[list(bce_columns.values())].to_numpy(dtype=float)
+    block = uptake_kernel(areas, rates.to_numpy(dtype=float))
+    uptakes = pd.DataFrame(block, index=df.index, columns=_uptake_columns(ecosystems, list(rates.columns)))
     
-    return df
\ No newline at end of file
+    return pd.concat([df, uptakes], axis=1)
@@ -0,0 +1,170 @@
+# Computing BCE (Mangroves, Saltmarshes, Seagrasses) areas by EEZs from habitat and EEZ geometries
+import os
+import json
+import time
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Union
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+EQUAL_AREA_CRS = 'EPSG:6933' # WGS 84 / NSIDC EASE-Grid 2.0 Global, an equal-area projection
+EEZ_COLUMNS = ['UNION', 'TERRITORY1', 'ISO_TER1', 'SOVEREIGN1']
+
+# EEZ geometries and their spatial index, set once in every worker process
+_eez_geoms = None
+_eez_tree = None
+
+
+def _init_worker(eez_wkb: np.ndarray) -> None:
+    global _eez_geoms, _eez_tree
+    _eez_geoms = shapely.from_wkb(eez_wkb)
+    _eez_tree = shapely.STRtree(_eez_geoms)
+
+
+def _tile_areas(habitat_wkb: np.ndarray) -> np.ndarray:
+    """
+    Returns the area (m2) of the habitat polygons of a tile falling in every EEZ.
+    Candidate (habitat, EEZ) pairs come from the STRtree, and only their intersections are computed.
+    """
+    habitats = shapely.from_wkb(habitat_wkb)
+    hab_idx, eez_idx = _eez_tree.query(habitats, predicate='intersects')
+    areas = shapely.area(shapely.intersection(habitats[hab_idx], _eez_geoms[eez_idx]))
+    return np.bincount(eez_idx, weights=areas, minlength=len(_eez_geoms))
+
+
+def _read(layer: Union[str, gpd.GeoDataFrame]) -> gpd.GeoDataFrame:
+    return gpd.read_file(layer) if isinstance(layer, str) else layer
+
+
+def assign_tiles(geoms: gpd.GeoSeries, tile_size: float) -> np.ndarray:
+    """
+    This function returns the tile of every geometry, from the position of a point inside it,
+    so that each polygon is processed in exactly one tile and never counted twice.
+    """
+    points = geoms.representative_point()
+    col = np.floor(points.x.to_numpy() / tile_size).astype(np.int64)
+    row = np.floor(points.y.to_numpy() / tile_size).astype(np.int64)
+    _, tiles = np.unique(np.stack([col, row], axis=1), axis=0, return_inverse=True)
+    return tiles.ravel()
+
+
+def _layer_digest(wkb: np.ndarray, keys: pd.DataFrame = None) -> str:
+    """Content hash of a layer: its geometries (as WKB) and the columns identifying its features"""
+    digest = hashlib.sha256()
+    digest.update(np.array([len(geom) for geom in wkb], dtype=np.int64).tobytes())
+    digest.update(b''.join(wkb))
+    if keys is not None:
+        digest.update(json.dumps(list(keys.columns)).encode('utf-8'))
+        digest.update(pd.util.hash_pandas_object(keys, index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _checkpoint(checkpoint_dir: str, manifest: Dict) -> None:
+    """Creates the checkpoint directory, or checks that it belongs to the same computation"""
+    path = os.path.join(checkpoint_dir, 'manifest.json')
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if previous != manifest:
+            raise ValueError(f"{checkpoint_dir} holds the checkpoints of another computation: {previous}")
+        return
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def compute_bce_areas(habitats: Union[str, gpd.GeoDataFrame], eez: Union[str, gpd.GeoDataFrame],
+                      area_col: str, tile_size: float = 500_000, workers: int = None,
+                      checkpoint_dir: str = None, progress: bool = True,
+                      eez_columns: List[str] = EEZ_COLUMNS) -> pd.DataFrame:
+    """
+    This function computes the area of a BCE in every EEZ from the habitat polygons.
+
+    Both layers are projected to an equal-area CRS. Habitat polygons are split into square
+    tiles, and the tiles are processed in parallel. In each tile, an STRtree of the EEZ polygons
+    gives the candidate pairs whose intersections are measured.
+
+    Parameters
+    ----------
+    habitats : str or geopandas.GeoDataFrame
+        Habitat polygons (e.g. a mangrove extent layer), or the path of a file readable by geopandas.
+    eez : str or geopandas.GeoDataFrame
+        EEZ polygons with the `eez_columns` attributes, or the path of such a file.
+    area_col : str
+        Name of the area column of the output (e.g. 'mangroves_area_km2').
+    tile_size : float, default=500_000
+        Side of the tiles, in meters of the equal-area projection.
+    workers : int, optional
+        Number of processes (in-process when None or 1).
+    checkpoint_dir : str, optional
+        Directory where the result of every finished tile is saved. A run stopped and started again
+        with the same directory, layers and tile size only processes the missing tiles (the layers are
+        identified by a content hash of their geometries and of the EEZ attributes).
+    progress : bool, default=True
+        Whether to print the number of processed tiles.
+    eez_columns : list, default=EEZ_COLUMNS
+        EEZ attributes kept in the output.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per EEZ with some habitat: the `eez_columns` and `area_col` (km2), the format of the
+        data_*_areas_by_country sheets read by generate_bce_data (write it with .to_csv or .to_excel).
+    """
+    habitats = _read(habitats)
+    eez = _read(eez)
+    habitat_geoms = shapely.make_valid(habitats.to_crs(EQUAL_AREA_CRS).geometry.to_numpy())
+    eez_geoms = shapely.make_valid(eez.to_crs(EQUAL_AREA_CRS).geometry.to_numpy())
+    keep = ~(shapely.is_empty(habitat_geoms) | shapely.is_missing(habitat_geoms))
+    habitat_geoms = habitat_geoms[keep]
+
+    tiles = assign_tiles(gpd.GeoSeries(habitat_geoms), tile_size)
+    n_tiles = int(tiles.max()) + 1 if len(tiles) else 0
+    order = np.argsort(tiles, kind='stable')
+    bounds = np.searchsorted(tiles[order], np.arange(n_tiles + 1))
+    habitat_wkb = shapely.to_wkb(habitat_geoms)
+    eez_wkb = shapely.to_wkb(eez_geoms)
+
+    done = {}
+    if checkpoint_dir is not None:
+        _checkpoint(checkpoint_dir, {'habitats': len(habitat_geoms), 'eez': len(eez_geoms),
+                                     'habitats_digest': _layer_digest(habitat_wkb),
+                                     'eez_digest': _layer_digest(eez_wkb, pd.DataFrame(eez[eez_columns])),
+                                     'tile_size': tile_size, 'tiles': n_tiles, 'crs': EQUAL_AREA_CRS})
+        for t in range(n_tiles):
+            path = os.path.join(checkpoint_dir, f'tile-{t}.npy')
+            if os.path.exists(path):
+                done[t] = np.load(path)
+    todo = [t for t in range(n_tiles) if t not in done]
+
+    start = time.perf_counter()
+
+    def finished(t, areas):
+        done[t] = areas
+        if checkpoint_dir is not None:
+            tmp = os.path.join(checkpoint_dir, f'tile-{t}.tmp.npy')
+            np.save(tmp, areas)
+            os.replace(tmp, os.path.join(checkpoint_dir, f'tile-{t}.npy'))
+        if progress:
+            print(f"\r{area_col}: {len(done)}/{n_tiles} tiles ({time.perf_counter() - start:.0f}s)",
+                  end='' if len(done) < n_tiles else '\n', flush=True)
+
+    tasks = {t: habitat_wkb[order[bounds[t]:bounds[t + 1]]] for t in todo}
+    if workers is None or workers <= 1:
+        _init_worker(eez_wkb)
+        for t in todo:
+            finished(t, _tile_areas(tasks[t]))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(eez_wkb,)) as pool:
+            futures = {pool.submit(_tile_areas, tasks[t]): t for t in todo}
+            for future in as_completed(futures):
+                finished(futures[future], future.result())
+
+    areas = np.sum([done[t] for t in range(n_tiles)], axis=0) if n_tiles else np.zeros(len(eez_geoms))
+    result = pd.DataFrame(eez[eez_columns]).reset_index(drop=True)
+    result[area_col] = areas / 1e6
+    return result[result[area_col] > 0].reset_index(drop=True)
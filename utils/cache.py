@@ -0,0 +1,190 @@
+# Content-addressed on-disk cache for the Excel inputs of the pipeline
+import os
+import glob
+import hashlib
+import json
+from typing import List, Optional, Union
+
+import pandas as pd
+
+from utils.instrument import traced
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:  # the cache is simply bypassed without pyarrow
+    pa = None
+    feather = None
+
+CACHE_DIR = '.bcw_cache'
+MAX_CACHE_BYTES = 512 * 1024 ** 2
+ENABLED = True
+
+_HASH_BLOCK = 1024 ** 2
+_EXTENSIONS = ('.feather', '.pkl')
+_HASH_INDEX = 'hashes.json'
+
+
+def configure(enabled: bool = None, cache_dir: str = None, max_bytes: int = None) -> None:
+    """
+    This function sets the cache options used by read_excel.
+    - enabled : False to bypass the cache (files are parsed with openpyxl every time)
+    - cache_dir : Directory where cached sheets are stored
+    - max_bytes : Maximum size of the cache directory, oldest entries are evicted first
+    """
+    global ENABLED, CACHE_DIR, MAX_CACHE_BYTES
+    if enabled is not None:
+        ENABLED = enabled
+    if cache_dir is not None:
+        CACHE_DIR = cache_dir
+    if max_bytes is not None:
+        MAX_CACHE_BYTES = max_bytes
+
+
+def file_hash(path: str) -> str:
+    """
+    This function returns the sha256 digest of the content of a file.
+    Digests are remembered in the cache directory with the size and modification time of the
+    file, so that unchanged files are not read again on later runs.
+    """
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime_ns]
+    index_path = os.path.join(CACHE_DIR, _HASH_INDEX)
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    known = index.get(os.path.abspath(path))
+    if known is not None and known[:2] == stamp:
+        return known[2]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+            h.update(block)
+    digest = h.hexdigest()
+
+    index[os.path.abspath(path)] = stamp + [digest]
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f'{index_path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(tmp, index_path)
+    return digest
+
+
+def _entry_prefix(path: str, sheet_name: Union[str, int], usecols: Optional[List[str]], header: int = 0) -> str:
+    """
+    Entries are named <file stem>-<selection key>-<content hash>.feather (or .pkl), the selection key
+    identifying the (file, sheet, columns) triple so that stale versions can be found.
+    """
+    selection = [os.path.abspath(path), sheet_name, usecols] + ([header] if header else [])
+    selection = json.dumps(selection, default=str)
+    key = hashlib.sha256(selection.encode('utf-8')).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(CACHE_DIR, f'{stem}-{key}')
+
+
+def _entries() -> List[str]:
+    return [entry for ext in _EXTENSIONS for entry in glob.glob(os.path.join(CACHE_DIR, f'*{ext}'))]
+
+
+def _evict(keep: str = None) -> None:
+    """
+    Removes the least recently used entries until the cache fits in MAX_CACHE_BYTES
+    """
+    entries = []
+    for entry in _entries():
+        st = os.stat(entry)
+        entries.append((st.st_mtime, st.st_size, entry))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= MAX_CACHE_BYTES:
+            break
+        if entry == keep:
+            continue
+        os.remove(entry)
+        total -= size
+
+
+def has_entries(path: str) -> bool:
+    """
+    This function tells whether some sheet of the current content of a file is cached
+    """
+    stem = glob.escape(os.path.splitext(os.path.basename(path))[0])
+    digest = file_hash(path)
+    return any(glob.glob(os.path.join(glob.escape(CACHE_DIR), f'{stem}-*-{digest}{ext}')) for ext in _EXTENSIONS)
+
+
+def clear_cache() -> int:
+    """
+    This function deletes every cached sheet and returns the number of removed entries
+    """
+    entries = _entries()
+    for entry in entries:
+        os.remove(entry)
+    return len(entries)
+
+
+@traced()
+def read_excel(path: str, sheet_name: Union[str, int] = 0, usecols: Optional[List[str]] = None,
+               header: int = 0) -> pd.DataFrame:
+    """
+    This function reads a sheet of an .xlsx file through the cache.
+
+    On the first read the sheet is parsed with pandas/openpyxl and the projected columns are
+    written as an uncompressed Arrow (Feather) file keyed by the content hash of the workbook,
+    the sheet and the column selection (sheets with mixed-type columns are pickled instead).
+    Later reads memory-map that file instead of parsing the workbook. Entries of a previous
+    version of the workbook are deleted when its content changes.
+
+    Parameters
+    ----------
+    path : str
+        Path of the .xlsx file.
+    sheet_name : str or int, default=0
+        Sheet to read, as in pandas.read_excel.
+    usecols : list, optional
+        Columns to keep, as in pandas.read_excel.
+    header : int, default=0
+        Row holding the column names, as in pandas.read_excel.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The same DataFrame as pandas.read_excel(path, sheet_name=sheet_name, usecols=usecols, header=header).
+    """
+    if not ENABLED or feather is None:
+        return pd.read_excel(path, sheet_name=sheet_name, usecols=usecols, header=header)
+
+    prefix = _entry_prefix(path, sheet_name, usecols, header)
+    entry = f'{prefix}-{file_hash(path)}'
+
+    if os.path.exists(entry + '.feather'):
+        os.utime(entry + '.feather')  # marks the entry as recently used
+        return feather.read_table(entry + '.feather', memory_map=True).to_pandas()
+    if os.path.exists(entry + '.pkl'):
+        os.utime(entry + '.pkl')
+        return pd.read_pickle(entry + '.pkl')
+
+    df = pd.read_excel(path, sheet_name=sheet_name, usecols=usecols, header=header)
+
+    # invalidating the entries of older versions of the same file
+    for stale in glob.glob(f'{glob.escape(prefix)}-*'):
+        os.remove(stale)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp = f'{entry}.{os.getpid()}.tmp'
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        feather.write_feather(table, tmp, compression='uncompressed')
+        entry += '.feather'
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # columns mixing types (e.g. a date in a footer row) cannot be stored as Arrow
+        df.to_pickle(tmp)
+        entry += '.pkl'
+    os.replace(tmp, entry)
+    _evict(keep=entry)
+
+    return df
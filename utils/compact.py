@@ -0,0 +1,125 @@
+# Compact in-memory representation of the pipeline frames (categoricals, Arrow strings, downcasts)
+import os
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+ENV_VAR = 'BCW_COMPACT'
+ENABLED = os.environ.get(ENV_VAR, '') not in ('', '0')
+# labels repeated over many rows, stored as categoricals; the other text columns (names and ISO
+# codes, which are compared, concatenated and merged on) are stored as Arrow strings
+CATEGORY_COLUMNS = ['SOVEREIGN1', 'Continent', 'Groups']
+# Arrow-backed strings with the NaN semantics of object columns (comparisons with a missing
+# value are False), the default string dtype of pandas 3
+STRING_DTYPE = pd.StringDtype('pyarrow', na_value=np.nan)
+
+_report: List[Dict[str, Any]] = []
+
+
+def configure(enabled: bool = True) -> None:
+    """
+    This function turns the compact mode on or off. In compact mode, pandas copy-on-write is
+    enabled so that the frames handed from a stage to the next share their buffers until one
+    of them is modified.
+    """
+    global ENABLED
+    ENABLED = enabled
+    pd.set_option('mode.copy_on_write', enabled)
+    reset()
+
+
+def reset() -> None:
+    _report.clear()
+
+
+def lazy_copy(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function returns a copy of df that can be modified without changing df. With
+    copy-on-write the copy shares the buffers of df, which are only duplicated on write.
+    """
+    return df.copy(deep=not pd.get_option('mode.copy_on_write'))
+
+
+def _is_text(values: pd.Series) -> bool:
+    if values.dtype != object:
+        return False
+    present = values.dropna()
+    return len(present) > 0 and present.map(type).eq(str).all()
+
+
+def compact_frame(df: pd.DataFrame, categories: List[str] = None, floats: bool = False) -> pd.DataFrame:
+    """
+    This function returns df with a smaller representation and the same values.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Frame to compact.
+    categories : list, optional
+        Text columns stored as categoricals (CATEGORY_COLUMNS by default). The other text columns
+        are stored as Arrow strings.
+    floats : bool, default=False
+        Also store as float32 the float columns whose values are all exactly representable in
+        float32. Off by default because arithmetic on float32 columns would then be rounded to
+        float32 (e.g. the sums of areas), which changes the results.
+
+    Returns
+    -------
+    pandas.DataFrame
+        df with integer columns downcast to the smallest integer type holding their values,
+        without any loss of precision.
+    """
+    categories = CATEGORY_COLUMNS if categories is None else categories
+    dtypes = {}
+    for col in df.columns:
+        values = df[col]
+        if isinstance(values, pd.DataFrame): # duplicated column names
+            continue
+        if _is_text(values):
+            dtypes[col] = 'category' if col in categories else STRING_DTYPE
+        elif pd.api.types.is_integer_dtype(values.dtype) and not isinstance(values.dtype, pd.api.extensions.ExtensionDtype):
+            dtypes[col] = pd.to_numeric(values, downcast='integer').dtype
+        elif floats and values.dtype == np.float64:
+            narrow = values.to_numpy().astype(np.float32)
+            if np.array_equal(narrow.astype(np.float64), values.to_numpy(), equal_nan=True):
+                dtypes[col] = np.float32
+    dtypes = {col: dtype for col, dtype in dtypes.items() if dtype != df[col].dtype}
+    return df.astype(dtypes) if dtypes else df
+
+
+def standard_bytes(df: pd.DataFrame) -> int:
+    """
+    This function returns the memory df would use in the default representation (object strings,
+    64-bit numbers)
+    """
+    total = df.index.memory_usage(deep=True)
+    for col in range(df.shape[1]):
+        values = df.iloc[:, col]
+        if isinstance(values.dtype, (pd.CategoricalDtype, pd.StringDtype)):
+            total += values.astype(object).memory_usage(deep=True, index=False)
+        elif pd.api.types.is_numeric_dtype(values.dtype) and not pd.api.types.is_bool_dtype(values.dtype):
+            total += 8 * len(values)
+        else:
+            total += values.memory_usage(deep=True, index=False)
+    return int(total)
+
+
+def frame_bytes(df: pd.DataFrame) -> int:
+    """This function returns the memory used by df, including the content of its strings"""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def record(name: str, df: pd.DataFrame) -> None:
+    """This function adds the memory of a stage output to the report"""
+    standard, compact = standard_bytes(df), frame_bytes(df)
+    _report.append({'stage': name, 'rows': len(df), 'columns': df.shape[1], 'standard_MB': standard / 1024 ** 2,
+                    'compact_MB': compact / 1024 ** 2, 'saving': 1 - compact / standard if standard else np.nan})
+
+
+def memory_report() -> pd.DataFrame:
+    """
+    This function returns the memory of the output of every stage executed in compact mode, in
+    the default and in the compact representation
+    """
+    return pd.DataFrame(_report, columns=['stage', 'rows', 'columns', 'standard_MB', 'compact_MB', 'saving'])
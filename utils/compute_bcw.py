@@ -1,29 +1,114 @@
 # Computing Blue Carbon Weath functions
 import pandas as pd
 import numpy as np
+from utils.consolidation import CLAIMS, ConsolidationRule, consolidate
+from utils.identity import IdentityIndex, UNMATCHED, load_identity_index, report_unmatched
+from utils.instrument import traced
+from utils import sinks
+
+SCENARIO_KEYS = ['dmgfuncpar', 'climate', 'prtp', 'eta', 'dr', 'run']
+DEFAULT_SCENARIO = {'dmgfuncpar': 'bootstrap', 'climate': 'uncertain', 'prtp': np.nan,
+                    'eta': np.nan, 'dr': 3., 'run': 'bhm_richpoor_lr'}
+GSCC_COLUMNS = ['run', 'dmgfuncpar', 'climate', 'ISO3', 'prtp', 'eta', 'dr', '16.7%', '50%', '83.3%']
+GSCC_DTYPES = {'run': 'category', 'dmgfuncpar': 'category', 'climate': 'category', 'ISO3': 'category',
+               'prtp': 'float64', 'eta': 'float64', 'dr': 'float64'}
+
+def scenario_grid(**values) -> pd.DataFrame:
+    """
+    This function builds every combination of the given scenario parameters.
+    Each keyword is one of SCENARIO_KEYS and takes a list of values, parameters that are not
+    given take their value from DEFAULT_SCENARIO.
+    e.g. scenario_grid(dr=[3., 5.], run=['bhm_richpoor_lr', 'bhm_lr']) gives 4 scenarios.
+    """
+    unknown = set(values) - set(SCENARIO_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown scenario parameters: {sorted(unknown)}")
+    axes = [values.get(key, [DEFAULT_SCENARIO[key]]) for key in SCENARIO_KEYS]
+    index = pd.MultiIndex.from_product(axes, names=SCENARIO_KEYS)
+    return index.to_frame(index=False)
+
+def _scenario_table(scenarios) -> pd.DataFrame:
+    """Scenario specs (list of dicts or DataFrame) as a table with one integer id per scenario"""
+    table = pd.DataFrame(list(scenarios) if not isinstance(scenarios, pd.DataFrame) else scenarios)
+    missing = [key for key in SCENARIO_KEYS if key not in table.columns]
+    if missing:
+        raise ValueError(f"Missing scenario parameters: {missing}")
+    table = table[SCENARIO_KEYS].astype({'prtp': 'float64', 'eta': 'float64', 'dr': 'float64'})
+    table = table.drop_duplicates().reset_index(drop=True)
+    table.insert(0, 'scenario', np.arange(len(table)))
+    return table
+
+@traced()
+def _read_scenarios(path: str, table: pd.DataFrame, chunksize: int) -> pd.DataFrame:
+    """
+    Streams the CSV file by chunks and keeps the rows belonging to one of the scenarios of `table`,
+    labelled with their scenario id. Rows are first pre-filtered on the values used by any scenario,
+    then the survivors are matched to the exact combinations (NaN prtp/eta/dr match NaN).
+    """
+    kept = []
+    for chunk in pd.read_csv(path, usecols=GSCC_COLUMNS, dtype=GSCC_DTYPES, chunksize=chunksize):
+        mask = np.ones(len(chunk), dtype=bool)
+        for key in SCENARIO_KEYS:
+            mask &= chunk[key].isin(table[key]).to_numpy()
+        chunk = chunk[mask]
+        if chunk.empty:
+            continue
+        # categories differ from one chunk to the other, string columns are kept as plain strings
+        chunk = chunk.astype({'run': 'object', 'dmgfuncpar': 'object', 'climate': 'object', 'ISO3': 'object'})
+        chunk = chunk.merge(table, on=SCENARIO_KEYS, how='inner')
+        kept.append(chunk[['scenario', 'ISO3', '16.7%', '50%', '83.3%']])
+    if not kept:
+        raise ValueError(f"No row of {path} matches the GSCC scenarios.")
+    return pd.concat(kept, ignore_index=True)
+
+@traced()
+def gscc_scenarios(path: str, scenarios, chunksize: int = 500_000):
+    """
+    This function computes the country-level SCC and the GSCC of several scenarios in a single
+    read of the cscc_db_v2 file and a single groupby.
 
-def gscc_computer(path: str) -> float:
+    Parameters
+    ----------
+    path : str
+        Path of the cscc_db_v2 CSV file.
+    scenarios : list of dict or pandas.DataFrame
+        Scenario specs with the keys of SCENARIO_KEYS (see scenario_grid).
+    chunksize : int, default=500_000
+        Number of rows read at once.
+
+    Returns
+    -------
+    cube : pandas.DataFrame
+        One row per scenario and country with the scenario id, its parameters, 'country',
+        '16.7%', 'median' and '83.3%'.
+    gscc : pandas.Series
+        GSCC of each scenario (sum of the country medians, 'WLD' excluded), indexed by scenario id.
+    """
+    table = _scenario_table(scenarios)
+    df_filtered = _read_scenarios(path, table, chunksize)
+
+    group = df_filtered.groupby(['scenario', 'ISO3'])[['16.7%', '50%', '83.3%']].median().reset_index()
+    group = group.rename(columns={'ISO3': 'country', '50%': 'median'})
+    cube = table.merge(group, on='scenario', how='inner')
+
+    gscc = cube[cube['country'] != 'WLD'].groupby('scenario')['median'].sum()
+    return cube, gscc
+
+@traced()
+def gscc_computer(path: str, chunksize: int = 500_000) -> float:
     """
     This function computes the global Social Cost of Carbon (GSCC) by reading country-level SCC data
     from a CSV file located at the given path.
+    The file is streamed by chunks of `chunksize` rows: only the needed columns are parsed (string
+    columns as categoricals) and the scenario filter is applied to each chunk, so that only the
+    matching rows are kept in memory until the per-country medians are computed.
     """
-    df = pd.read_csv(path)
-    df_filtered = df[(df['dmgfuncpar'] == 'bootstrap') & 
-                     (df['climate'] == 'uncertain') & 
-                     (df['prtp'].isna()) & 
-                     (df['eta'].isna()) & 
-                     (df['dr'] == 3.) & 
-                     (df['run'].isin(['bhm_richpoor_lr']))]
-    
-    group = df_filtered.groupby('ISO3')[['16.7%', '50%', '83.3%']].median()
-    group['country'] = group.index
-    group = group[['country', '16.7%', '50%', '83.3%']]
-    group = group.reset_index(drop=True)
-    group.rename(columns={'50%':'median'}, inplace=True)
+    cube, _ = gscc_scenarios(path, [DEFAULT_SCENARIO], chunksize)
+    group = cube[['country', '16.7%', 'median', '83.3%']]
     
     cscc = group[group['country'] != 'WLD']
     gscc = cscc['median'].sum()
-    group.to_csv('data_source/gscc/country_level_gscc.csv', index=False)
+    sinks.publish('country_level_gscc', group)
     return gscc
     
 def cbcw_calculator(df: pd.DataFrame, cmol: float, gscc: float) -> pd.DataFrame:
@@ -36,29 +121,27 @@ def cbcw_calculator(df: pd.DataFrame, cmol: float, gscc: float) -> pd.DataFrame:
     df = df.drop(columns='total_sequestration')
     return df
 
-def bcp_inclusion(df: pd.DataFrame, bcp_path: str, cmol: float, gscc: float) -> pd.DataFrame:
-    """This function add Blue carbon pump to the data"""
+@traced(same_rows=True)
+def bcp_inclusion(df: pd.DataFrame, bcp_path: str, cmol: float, gscc: float,
+                  identity: IdentityIndex = None) -> pd.DataFrame:
+    """
+    This function add Blue carbon pump to the data.
+    BCP countries and the rows of df are resolved to entities of the identity index (see
+    utils/identity.py) and joined on the entity id. BCP countries that cannot be resolved
+    are reported instead of being silently left out.
+    """
+    identity = identity or load_identity_index()
     bcp = pd.read_csv(bcp_path)
     bcp['BCP sequestration in EEZ (tC/year)'] = bcp['BCP sequestration in EEZ (GtC/year)'] * 1e9
-    bcp = bcp[['Country', 'BCP sequestration in EEZ (tC/year)']]
-    name_map = {
-        "Antigua & B.": "Antigua and Barbuda",
-        "Chagos Archip.": "Chagos Archipelago",
-        "Dem. Rep. Congo": "Democratic Republic of the Congo",
-        "Eq. Guinea": "Equatorial Guinea",
-        "FS of Micronesia": "Micronesia",
-        "Papua N. Guinea": "Papua New Guinea",
-        "Rep. of Congo": "Republic of the Congo",
-        "Sao Tome & P.": "Sao Tome and Principe",
-        "St. Vincent & Gr.": "Saint Vincent and the Grenadines",
-        "UK": "United Kingdom",
-        "Mauritius": "Republic of Mauritius",
-        "Somalia": "Federal Republic of Somalia"
-    }
-    bcp['Country'] = bcp['Country'].replace(name_map)
-    data = df.merge(bcp, left_on='country_name', right_on='Country', how='left')
+
+    bcp['entity_id'], unmatched = identity.resolve(bcp['Country'], bcp['ISO3'])
+    report_unmatched(unmatched, bcp_path)
+    bcp = bcp.loc[bcp['entity_id'] != UNMATCHED, ['entity_id', 'BCP sequestration in EEZ (tC/year)']]
+
+    entity_id, _ = identity.resolve(df['country_name'], fuzzy=False)
+    data = df.assign(entity_id=entity_id).merge(bcp, on='entity_id', how='left')
     data.rename(columns={'BCP sequestration in EEZ (tC/year)': 'BCP Seq (tC)'}, inplace=True)
-    data.drop(columns=['Country'], inplace=True)
+    data.drop(columns=['entity_id'], inplace=True)
     data['oBCW'] = data['BCP Seq (tC)'] * cmol * gscc
     return data
 
@@ -85,50 +168,58 @@ def group_claims(df, pattern, new_name, key_column='Country'):
     pandas.DataFrame
         A new DataFrame with the grouped row added.
     """
+    rule = ConsolidationRule(new_name, pattern=pattern, objects='drop')
+    return consolidate(df, [rule], key_column=key_column)
 
-    # 1. Identify the rows to group
-    mask = df[key_column].str.contains(pattern, na=False)
-
-    # 2. Split the DataFrame
-    df_rest = df[~mask]
-    df_to_group = df[mask]
-
-    if df_to_group.empty:
-        return df.copy()  # Nothing to group
-
-    # 3. Sum numeric columns
-    def sum_if_any(s):
-        return s.sum(skipna=True) if s.notna().any() else np.nan
-
-    numeric_sum = df_to_group.select_dtypes(include='number').apply(sum_if_any)
+def _bcw_frame(df: pd.DataFrame, cmol: float, gscc: float, bcp_path: str,
+               identity: IdentityIndex = None) -> pd.DataFrame:
+    """Coastal and open-ocean BCW of every EEZ, before grouping the claims and joint regimes"""
+    df = cbcw_calculator(df, cmol, gscc)
+    df = bcp_inclusion(df, bcp_path, cmol, gscc, identity)
+    df = bcw_totals(df)
+    df = df.rename(columns={'ISO_TER1': 'ISO'})
+    return df
 
-    # 4. Object columns: set to NaN except for key_column
-    object_cols = df_to_group.select_dtypes(include='object').columns
-    object_values = {col: np.nan for col in object_cols}
-    object_values[key_column] = new_name
+def bcw_totals(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function adds the total sequestration and the Total BCW (coastal plus open-ocean)
+    """
+    df['Total BCseq'] = df[['tot_uptake (tC)', 'BCP Seq (tC)']].sum(axis=1, min_count=1)
+    df['Total BCW'] = df[['cBCW', 'oBCW']].sum(axis=1, min_count=1)
+    return df
 
-    # 5. Combine both parts
-    combined_row = {**object_values, **numeric_sum.to_dict()}
+def _group_all_claims(df: pd.DataFrame, identity: IdentityIndex = None) -> pd.DataFrame:
+    """Overlapping claims and joint regime areas (POL_TYPE of the entities) are grouped in a single pass"""
+    return consolidate(df, CLAIMS, key_column='country_name', identity=identity)
 
-    # 6. Return the final DataFrame
-    df_final = pd.concat([df_rest, pd.DataFrame([combined_row])], ignore_index=True)
+def _bcw_scenarios(df: pd.DataFrame, cmol: float, gscc: pd.Series, bcp_path: str,
+                   identity: IdentityIndex = None) -> pd.DataFrame:
+    """
+    BCW is linear in the GSCC: the data is valued once with a unit GSCC, then the cBCW, oBCW and
+    Total BCW columns are scaled by the GSCC of every scenario.
+    """
+    base = _group_all_claims(_bcw_frame(df, cmol, 1., bcp_path, identity), identity)
+    n, k = len(base), len(gscc)
 
-    return df_final
+    data = base.iloc[np.tile(np.arange(n), k)].reset_index(drop=True)
+    data.insert(0, 'scenario', np.repeat(gscc.index.to_numpy(), n))
+    factor = np.repeat(gscc.to_numpy(dtype=float), n)[:, None]
+    data[['cBCW', 'oBCW', 'Total BCW']] = data[['cBCW', 'oBCW', 'Total BCW']].to_numpy() * factor
+    return data
 
-def bcw_computer(df: pd.DataFrame, cmol: float, gscc: float, bcp_path: str) -> pd.DataFrame:
+@traced()
+def bcw_computer(df: pd.DataFrame, cmol: float, gscc, bcp_path: str,
+                 identity: IdentityIndex = None) -> pd.DataFrame:
     """
-    This function compute the Blue Carbon Weath including Blue Carbon Pump
+    This function compute the Blue Carbon Weath including Blue Carbon Pump.
+    `gscc` is either a single GSCC value or the GSCC Series returned by gscc_scenarios, in which
+    case the result has one row per scenario and country, identified by a 'scenario' column.
+    `identity` is the index used to join the BCP data and to find the overlapping claims and joint
+    regimes (built from EEZ_full.csv by default).
     """
-    df = cbcw_calculator(df, cmol, gscc)
-    df = bcp_inclusion(df, bcp_path, cmol, gscc)
-    df['Total BCseq'] = df[['tot_uptake (tC)', 'BCP Seq (tC)']].sum(axis=1, min_count=1)
-    df['Total BCW'] = df['Total BCW'] = df[['cBCW', 'oBCW']].sum(axis=1, min_count=1)
-    df = df.rename(columns={'ISO_TER1': 'ISO'})
-    df.to_csv('data_source/summary/bcw_data_before_grouping.csv', index=False)
-    df = group_claims(
-        df, pattern='Overlapping claim', new_name='Overlapping Claims', key_column='country_name'
-    )
-    df = group_claims(
-        df, pattern='Joint regime area', new_name='Joint Regimes', key_column='country_name'
-    )
-    return df
\ No newline at end of file
+    if isinstance(gscc, pd.Series):
+        return _bcw_scenarios(df, cmol, gscc, bcp_path, identity)
+
+    df = _bcw_frame(df, cmol, gscc, bcp_path, identity)
+    sinks.publish('bcw_data_before_grouping', df, intermediate=True)
+    return _group_all_claims(df, identity)
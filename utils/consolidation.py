@@ -0,0 +1,125 @@
+# Consolidation of several rows of the data into a single one (Kiribati island groups, claims, joint regimes)
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from utils.identity import IdentityIndex, load_identity_index, report_unmatched
+from utils.instrument import traced
+
+@dataclass
+class ConsolidationRule:
+    """
+    Rows merged into a single `target` row.
+    - target : Value of the key column of the consolidated row
+    - members : Values of the key column of the merged rows (names, or ids if the key column holds ids)
+    - pattern : Regular expression searched in the key column, for rows that are not listed in members
+      (in the names of the entities of the identity index when entities is given)
+    - entities : Values of columns of the entities of the identity index (e.g. {'POL_TYPE': 'Joint regime (EEZ)'});
+      the rows whose key resolves to a matching entity are merged, whatever their name in the data
+    - objects : 'first' to keep the first non-missing value of the non-numeric columns, 'drop' to leave them empty
+    Numeric columns are summed, the sum being missing when all the merged values are missing.
+    """
+    target: str
+    members: List = field(default_factory=list)
+    pattern: str = None
+    entities: Dict[str, str] = None
+    objects: str = 'first'
+
+# island groups of Kiribati (the EEZ unions of the sovereign state Kiribati in EEZ_full.csv)
+KIRIBATI = ConsolidationRule('Kiribati', entities={'kind': 'eez', 'SOVEREIGN1': 'Kiribati'})
+# overlapping claims and joint regime areas of the EEZ data (POL_TYPE of EEZ_full.csv); the disputed
+# territories with a name of their own (e.g. Falkland Islands) are overlapping claims that are kept apart
+CLAIMS = [
+    ConsolidationRule('Overlapping Claims', entities={'POL_TYPE': 'Overlapping claim'}, pattern='^Overlapping claim',
+                      objects='drop'),
+    ConsolidationRule('Joint Regimes', entities={'POL_TYPE': 'Joint regime (EEZ)'}, objects='drop'),
+]
+
+def rule_entities(rule: ConsolidationRule, identity: IdentityIndex) -> np.ndarray:
+    """
+    This function returns the ids of the entities of the identity index selected by a rule
+    """
+    entities = identity.entities
+    selected = np.ones(len(entities), dtype=bool)
+    for column, value in rule.entities.items():
+        selected &= (entities[column] == value).to_numpy()
+    if rule.pattern:
+        selected &= entities['name'].astype('object').str.contains(rule.pattern, flags=re.UNICODE, na=False).to_numpy()
+    return entities.index[selected].to_numpy()
+
+def consolidation_labels(keys: pd.Series, rules: List[ConsolidationRule],
+                         identity: IdentityIndex = None) -> np.ndarray:
+    """
+    This function returns, for every row, the position of the first rule it belongs to (-1 if none),
+    whether the rule lists members, selects entities or searches a pattern.
+    The keys are resolved once to entities of the identity index (the one of EEZ_full.csv by default)
+    when a rule selects entities; all the patterns are searched at once with a single regular expression,
+    every pattern being looked for from the start of the key independently of the others.
+    """
+    labels = np.full(len(keys), -1)
+    if any(rule.entities for rule in rules):
+        identity = identity or load_identity_index()
+        ids, unmatched = identity.resolve(keys, fuzzy=False)
+        report_unmatched(unmatched, 'the consolidated data')
+        ids = ids.to_numpy()
+    patterns = [(i, rule.pattern) for i, rule in enumerate(rules) if rule.pattern and not rule.entities]
+    if patterns:
+        regex = '^' + ''.join(f'(?:(?=.*?(?P<r{i}>{pattern})))?' for i, pattern in patterns)
+        found = keys.astype('object').str.extract(regex, flags=re.UNICODE | re.DOTALL)
+
+    # rules applied from the last to the first, so that the first rule of a row is the one kept
+    for i, rule in reversed(list(enumerate(rules))):
+        if rule.members:
+            labels[keys.isin(rule.members).to_numpy()] = i
+        if rule.entities:
+            labels[np.isin(ids, rule_entities(rule, identity))] = i
+        elif rule.pattern:
+            labels[found[f'r{i}'].notna().to_numpy()] = i
+    return labels
+
+@traced()
+def consolidate(df: pd.DataFrame, rules: List[ConsolidationRule], key_column: str = 'country_name',
+                identity: IdentityIndex = None) -> pd.DataFrame:
+    """
+    This function applies every consolidation rule in a single groupby.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Input DataFrame.
+    rules : list of ConsolidationRule
+        Consolidations to apply, a row belonging to the first rule it matches.
+    key_column : str, default='country_name'
+        Column holding the names (or ids) the rules refer to.
+    identity : IdentityIndex, optional
+        Index the keys are resolved with for the rules selecting entities (EEZ_full.csv by default).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The rows that belong to no rule, in their order, followed by one row per rule with members,
+        in the order of the rules.
+    """
+    labels = consolidation_labels(df[key_column], rules, identity)
+    grouped = labels >= 0
+    if not grouped.any():
+        return df.copy()
+
+    members = df[grouped]
+    numeric = [col for col in df.columns if col != key_column and pd.api.types.is_numeric_dtype(df[col])]
+    others = [col for col in df.columns if col != key_column and col not in numeric]
+
+    groups = members.groupby(labels[grouped], sort=True)
+    sums = groups[numeric].sum(min_count=1)
+    firsts = groups[others].first()
+
+    found = sums.index.to_numpy()
+    firsts.loc[[rules[i].objects == 'drop' for i in found]] = np.nan
+    rows = pd.concat([sums, firsts], axis=1)
+    rows[key_column] = [rules[i].target for i in found]
+    rows = rows[df.columns]
+
+    return pd.concat([df[~grouped], rows], ignore_index=True)
@@ -0,0 +1,207 @@
+# Recomputation of the rows of the BCW data affected by overrides, from a baseline run of the pipeline
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+from utils.bce_areas import compute_rates
+from utils.compact import lazy_copy
+from utils.compute_bcw import _bcw_frame, _group_all_claims, bcw_totals, cbcw_calculator
+from utils.consolidation import CLAIMS, KIRIBATI, consolidation_labels
+from utils.functions import correct_kiribati, per_capita
+from utils.identity import EEZ_FULL_PATH, IdentityIndex, load_identity_index
+from utils.instrument import traced
+from utils.overrides import Override, apply_overrides, override_mask
+
+# columns of the final table summed into the global totals
+TOTAL_COLUMNS = ['Area_EEZ_KM2', 'saltmarshes_area_km2', 'seagrasses_area_km2', 'mangroves_area_km2',
+                 'tot_uptake (tC)', 'tot_upt_LOW', 'tot_upt_HIGH', 'BCP Seq (tC)', 'Total BCseq',
+                 'cBCW', 'oBCW', 'Total BCW']
+# country_name of the global totals in the diff
+GLOBAL = '(global)'
+
+
+@dataclass
+class Baseline:
+    """
+    The tables of a pipeline run the overrides are applied to (see build_baseline).
+    - eco : BCE areas and economic data by EEZ (output of the eco_data stage)
+    - rates : eco with the uptakes (rates stage)
+    - kiribati : rates with the Kiribati island groups merged (kiribati stage, bce_data.csv)
+    - bcw_rows : BCW of every row of kiribati, before grouping the claims (bcw_data_before_grouping.csv)
+    - bcw : bcw_rows with the claims and joint regimes grouped (bcw stage)
+    - per_capita : bcw with the per capita values (per_capita stage, country_level_bcw.csv)
+    - totals : Global totals of TOTAL_COLUMNS
+    - json_path, bce_columns : Sequestration rates and area columns of compute_rates
+    - cmol, gscc : Parameters of the coastal BCW
+    - pcap_cols, pop_column : Parameters of per_capita
+    - eez_full_path : EEZ_full.csv of the identity index the BCP data and the consolidations are joined with
+    """
+    eco: pd.DataFrame
+    rates: pd.DataFrame
+    kiribati: pd.DataFrame
+    bcw_rows: pd.DataFrame
+    bcw: pd.DataFrame
+    per_capita: pd.DataFrame
+    totals: pd.Series
+    json_path: str
+    bce_columns: List[str]
+    cmol: float
+    gscc: float
+    pcap_cols: List[str]
+    pop_column: str = 'Population'
+    eez_full_path: str = EEZ_FULL_PATH
+
+
+@dataclass
+class DeltaResult:
+    """
+    Tables updated by recompute.
+    - tables : Name of the Baseline table -> updated table
+    - totals : Updated global totals
+    - diff : Changed values ('country_name', 'column', 'old', 'new', 'change'), the global
+      totals having the country_name GLOBAL
+    - rows : Number of rows recomputed at every level
+    """
+    tables: Dict[str, pd.DataFrame]
+    totals: pd.Series
+    diff: pd.DataFrame
+    rows: Dict[str, int] = field(default_factory=dict)
+
+
+def _totals(df: pd.DataFrame) -> pd.Series:
+    return df[[col for col in TOTAL_COLUMNS if col in df.columns]].sum()
+
+
+@traced()
+def build_baseline(eco_data: pd.DataFrame, rates: pd.DataFrame, kiribati: pd.DataFrame, bcw: pd.DataFrame,
+                   per_capita: pd.DataFrame, gscc: float, json_path: str, bcp_path: str, bce_columns: List[str],
+                   cmol: float, pcap_cols: List[str], pop_column: str = 'Population',
+                   eez_full_path: str = EEZ_FULL_PATH) -> Baseline:
+    """
+    This function gathers the outputs of the pipeline stages into the Baseline of recompute.
+    The BCW of the rows before grouping the claims, which no stage returns, is computed here once
+    (the BCP data being joined through the identity index of eez_full_path).
+    """
+    if isinstance(gscc, pd.Series):
+        raise ValueError("The delta recomputation needs a single GSCC value, not GSCC scenarios")
+    bcw_rows = _bcw_frame(lazy_copy(kiribati), cmol, gscc, bcp_path, load_identity_index(eez_full_path))
+    return Baseline(eco_data, rates, kiribati, bcw_rows, bcw, per_capita, _totals(per_capita), json_path,
+                    list(bce_columns), cmol, gscc, list(pcap_cols), pop_column, eez_full_path)
+
+
+def _closure(keys: pd.Series, hit: np.ndarray, rules, identity: IdentityIndex) -> np.ndarray:
+    """
+    Extends the rows hit to every row with the same key and to every row consolidated with
+    them by the rules, so that the consolidated rows can be recomputed from the hit rows alone
+    """
+    hit = keys.isin(keys[hit]).to_numpy()
+    labels = consolidation_labels(keys, rules, identity)
+    return hit | np.isin(labels, labels[hit & (labels >= 0)])
+
+
+def _replace(base: pd.DataFrame, mask: np.ndarray, rows: pd.DataFrame) -> pd.DataFrame:
+    """Replaces the rows of base selected by mask by rows, in the same order"""
+    if mask.sum() != len(rows):
+        raise ValueError(f"{len(rows)} recomputed rows for {mask.sum()} rows of the baseline")
+    rows = rows[base.columns].set_axis(base.index[mask])
+    return pd.concat([base[~mask], rows]).loc[base.index]
+
+
+def _splice(base: pd.DataFrame, rows: pd.DataFrame, key: str) -> pd.DataFrame:
+    """Replaces the rows of base with the keys of rows, which have the same order, by rows"""
+    return _replace(base, base[key].isin(rows[key]).to_numpy(), rows)
+
+
+def _diff(old: pd.DataFrame, new: pd.DataFrame, old_totals: pd.Series, new_totals: pd.Series) -> pd.DataFrame:
+    numeric = [col for col in new.columns if pd.api.types.is_numeric_dtype(new[col])]
+    before = old[numeric].to_numpy(dtype=float)
+    after = new[numeric].to_numpy(dtype=float)
+    changed = ~((before == after) | (np.isnan(before) & np.isnan(after)))
+    rows, cols = np.nonzero(changed)
+    diff = pd.DataFrame({'country_name': new['country_name'].to_numpy()[rows],
+                         'column': np.asarray(numeric, dtype=object)[cols],
+                         'old': before[rows, cols], 'new': after[rows, cols]})
+    moved = old_totals.ne(new_totals)
+    totals = pd.DataFrame({'country_name': GLOBAL, 'column': new_totals.index[moved],
+                           'old': old_totals[moved].to_numpy(), 'new': new_totals[moved].to_numpy()})
+    diff = pd.concat([diff, totals], ignore_index=True)
+    diff['change'] = diff['new'] - diff['old']
+    return diff
+
+
+@traced()
+def recompute(baseline: Baseline, overrides: List[Override]) -> DeltaResult:
+    """
+    This function applies overrides to the baseline and recomputes only the values they affect.
+
+    The rows of the economic data matched by the overrides get new uptakes; the Kiribati row,
+    the overlapping claims and the joint regimes are consolidated again when one of their members
+    changed, from the baseline values of the other members; the BCW, the per capita values and
+    the global totals (baseline totals minus the old plus the new values of the recomputed rows)
+    follow. The updated tables are those a full run of the pipeline with the overrides applied
+    by adjust_data would return.
+
+    Parameters
+    ----------
+    baseline : Baseline
+        Tables of a pipeline run (see build_baseline).
+    overrides : list of Override
+        Values to set, on the columns of the economic data (BCE areas, Population, GDP, ...).
+
+    Returns
+    -------
+    DeltaResult
+        Updated tables, global totals and diff of the final table.
+    """
+    eco = lazy_copy(baseline.eco)
+    hit = np.zeros(len(eco), dtype=bool)
+    for override in overrides:
+        mask = override_mask(eco, override)
+        if not mask.any():
+            raise ValueError(f"No row of the data has {override.key_column} == {override.key!r}")
+        hit |= mask
+    eco = apply_overrides(eco, overrides)
+    identity = load_identity_index(baseline.eez_full_path)
+
+    # uptakes of the rows overridden, then the Kiribati consolidation of their closure
+    hit = _closure(eco['UNION'], hit, [KIRIBATI], identity)
+    uptakes = compute_rates(eco[hit], baseline.json_path, baseline.bce_columns)
+    rates = _replace(baseline.rates, hit, uptakes)
+    kiribati_rows = correct_kiribati(rates[hit], identity)
+    kiribati = _splice(baseline.kiribati, kiribati_rows, 'country_name')
+
+    # BCW of the rows changed, the BCP of a territory not depending on the overrides
+    changed = baseline.kiribati['country_name'].isin(kiribati_rows['country_name']).to_numpy()
+    values = cbcw_calculator(kiribati[changed].reset_index(drop=True), baseline.cmol, baseline.gscc)
+    values = values.rename(columns={'ISO_TER1': 'ISO'})
+    values[['BCP Seq (tC)', 'oBCW']] = baseline.bcw_rows.loc[changed, ['BCP Seq (tC)', 'oBCW']].to_numpy()
+    values = bcw_totals(values)
+    bcw_rows = _replace(baseline.bcw_rows, changed, values)
+
+    # claims and joint regimes with a changed member, then the per capita values
+    grouped = _closure(bcw_rows['country_name'], changed, CLAIMS, identity)
+    bcw_changed = _group_all_claims(bcw_rows[grouped], identity)
+    bcw = _splice(baseline.bcw, bcw_changed, 'country_name')
+    final_rows = per_capita(bcw_changed, baseline.pcap_cols, baseline.pop_column)
+    final = _splice(baseline.per_capita, final_rows, 'country_name')
+
+    old_rows = baseline.per_capita[baseline.per_capita['country_name'].isin(final_rows['country_name'])]
+    totals = baseline.totals - _totals(old_rows) + _totals(final_rows)
+    tables = {'eco': eco, 'rates': rates, 'kiribati': kiribati, 'bcw_rows': bcw_rows, 'bcw': bcw,
+              'per_capita': final}
+    rows = {'eco': int(hit.sum()), 'kiribati': len(kiribati_rows), 'bcw': len(bcw_changed)}
+    diff = _diff(old_rows, final.loc[old_rows.index], baseline.totals, totals)
+    return DeltaResult(tables, totals, diff, rows)
+
+
+def with_overrides(baseline: Baseline, result: DeltaResult) -> Baseline:
+    """
+    This function returns the baseline of the updated tables, to apply further overrides on
+    top of those of result
+    """
+    tables = result.tables
+    return Baseline(tables['eco'], tables['rates'], tables['kiribati'], tables['bcw_rows'], tables['bcw'],
+                    tables['per_capita'], result.totals, baseline.json_path, baseline.bce_columns,
+                    baseline.cmol, baseline.gscc, baseline.pcap_cols, baseline.pop_column, baseline.eez_full_path)
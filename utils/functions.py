@@ -1,40 +1,23 @@
 import pandas as pd
+from utils.compact import lazy_copy
+from utils.consolidation import KIRIBATI, consolidate
+from utils.identity import IdentityIndex
+from utils.instrument import traced
 
-def correct_kiribati(df: pd.DataFrame) -> pd.DataFrame:
+@traced()
+def correct_kiribati(df: pd.DataFrame, identity: IdentityIndex = None) -> pd.DataFrame:
     """
     This function corrects the data for Kiribati by summing the values
-    of its different island groups into a single entry for Kiribati.
+    of its different island groups into a single entry for Kiribati
+    (see the KIRIBATI rule of utils/consolidation.py). The island groups are
+    found through the identity index (the one of EEZ_full.csv by default).
     """
-    
-    df = df.copy()
     df = df.rename(columns={'UNION': 'country_name'})
-
-    islands = ["Line Group", "Gilbert Islands", "Phoenix Group"]
-    kiribati_rows = df[df['country_name'].isin(islands)]
-
-    def sum_if_any(series):
-        if series.notna().any():
-            return series.sum(skipna=True)
-        return pd.NA
-
-    agg_map = {}
-    for col in df.columns:
-        if col == 'country_name':
-            continue
-        if pd.api.types.is_numeric_dtype(df[col]):
-            agg_map[col] = sum_if_any
-        else:
-            agg_map[col] = lambda x: x.dropna().iloc[0] if x.notna().any() else pd.NA
-
-    kiribati_agg = kiribati_rows.groupby(lambda _: "Kiribati").agg(agg_map).reset_index()
-    kiribati_agg = kiribati_agg.rename(columns={"index": "country_name"})
-
-    df = df[~df['country_name'].isin(islands)].copy()
-    kiribati_agg = kiribati_agg.dropna(axis=1, how='all')
-    df = pd.concat([df, kiribati_agg], ignore_index=True)
+    df = consolidate(df, [KIRIBATI], key_column='country_name', identity=identity)
 
     return df.sort_values(by='country_name')
 
+@traced(same_rows=True)
 def per_capita(df: pd.DataFrame, columns: list, pop_columns: str) -> pd.DataFrame:
     """
     This function computes per capita values for specified columns.
@@ -52,7 +35,7 @@ def per_capita(df: pd.DataFrame, columns: list, pop_columns: str) -> pd.DataFram
     pandas.DataFrame
         DataFrame with new per capita columns added.
     """
-    df = df.copy()
+    df = lazy_copy(df)
     for col in columns:
         per_capita_col = f"{col}_per_capita"
         df[per_capita_col] = df[col] / df[pop_columns]
@@ -77,6 +60,6 @@ def ratio_computer(df: pd.DataFrame, numerator: str, denominator: str, new_colum
     pandas.DataFrame
         DataFrame with the new ratio column added.
     """
-    df = df.copy()
+    df = lazy_copy(df)
     df[new_column] = df[numerator] / df[denominator]
     return df
\ No newline at end of file
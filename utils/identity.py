@@ -0,0 +1,233 @@
+# Resolution of the country and territory names and codes of every data source to canonical entities
+import os
+import re
+import difflib
+import hashlib
+import pickle
+import unicodedata
+import warnings
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils import cache
+from utils.instrument import traced
+
+EEZ_FULL_PATH = 'data_source/shp/EEZ_full.csv'
+
+# name variants of the data sources -> EEZ union name
+NAME_ALIASES = {
+    "Antigua & B.": "Antigua and Barbuda",
+    "Chagos Archip.": "Chagos Archipelago",
+    "Dem. Rep. Congo": "Democratic Republic of the Congo",
+    "Eq. Guinea": "Equatorial Guinea",
+    "FS of Micronesia": "Micronesia",
+    "Papua N. Guinea": "Papua New Guinea",
+    "Rep. of Congo": "Republic of the Congo",
+    "Sao Tome & P.": "Sao Tome and Principe",
+    "St. Vincent & Gr.": "Saint Vincent and the Grenadines",
+    "UK": "United Kingdom",
+    "Mauritius": "Republic of Mauritius",
+    "Somalia": "Federal Republic of Somalia"
+}
+
+UNMATCHED = -1
+
+
+def normalize_name(name) -> str:
+    """
+    This function returns the comparison form of a name: without accents, case, punctuation
+    and repeated spaces, '&' being read as 'and'
+    """
+    if not isinstance(name, str):
+        return ''
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = name.casefold().replace('&', ' and ')
+    name = re.sub(r'[^\w\s]', ' ', name)
+    return ' '.join(name.split())
+
+
+class IdentityIndex:
+    """
+    Index of the entities of the pipeline (one per EEZ union of EEZ_full.csv, plus one per
+    sovereign state that is not itself an EEZ union, such as Kiribati) and of every name
+    variant, ISO code and MRGID pointing to them.
+    - entities : Table of the entities, indexed by their integer id
+    - names : Normalized name -> entity id
+    - codes : ISO3 code -> entity id
+    - mrgids : MRGID of an EEZ -> entity id
+    """
+
+    def __init__(self, entities: pd.DataFrame, names: Dict[str, int], codes: Dict[str, int],
+                 mrgids: Dict[int, int]):
+        self.entities = entities
+        self.names = names
+        self.codes = codes
+        self.mrgids = mrgids
+        self._fuzzy = {}
+        self._choices = list(names)
+
+    def _fuzzy_match(self, key: str, cutoff: float) -> int:
+        if (key, cutoff) not in self._fuzzy:
+            match = difflib.get_close_matches(key, self._choices, n=1, cutoff=cutoff)
+            self._fuzzy[(key, cutoff)] = self.names[match[0]] if match else UNMATCHED
+        return self._fuzzy[(key, cutoff)]
+
+    def resolve(self, names: pd.Series, codes: pd.Series = None, fuzzy: bool = True,
+                cutoff: float = 0.9) -> Tuple[pd.Series, pd.DataFrame]:
+        """
+        This function returns the entity id of every row, looking for the name first, then for
+        the ISO3 code and finally for the closest known name (memoized).
+
+        Parameters
+        ----------
+        names : pandas.Series
+            Names to resolve.
+        codes : pandas.Series, optional
+            ISO3 codes of the same rows, used when the name is unknown.
+        fuzzy : bool, default=True
+            Whether to fall back on the closest known name.
+        cutoff : float, default=0.9
+            Minimum similarity of a fuzzy match (see difflib.get_close_matches).
+
+        Returns
+        -------
+        ids : pandas.Series
+            Entity id of every row (UNMATCHED when unresolved), with the index of names.
+        unmatched : pandas.DataFrame
+            The names and codes of the unresolved rows.
+        """
+        keys = names.map(normalize_name)
+        ids = keys.map(self.names)
+        if codes is not None:
+            ids = ids.fillna(codes.map(self.codes))
+        if fuzzy:
+            missing = ids.isna() & (keys != '')
+            ids[missing] = keys[missing].map(lambda key: self._fuzzy_match(key, cutoff))
+        ids = ids.fillna(UNMATCHED).astype(np.int64)
+
+        unresolved = ids == UNMATCHED
+        unmatched = pd.DataFrame({'name': names[unresolved]})
+        if codes is not None:
+            unmatched['code'] = codes[unresolved]
+        return ids, unmatched
+
+
+def _add(mapping: Dict, ambiguous: set, key, entity_id: int) -> None:
+    """Adds a key, keys pointing to several entities of the same tier are discarded"""
+    if key in ambiguous or key is None or key == '':
+        return
+    if key in mapping and mapping[key] != entity_id:
+        del mapping[key]
+        ambiguous.add(key)
+    else:
+        mapping[key] = entity_id
+
+
+@traced()
+def build_identity_index(eez_path: str = EEZ_FULL_PATH,
+                         name_sources: List[Tuple[str, str, str]] = None) -> IdentityIndex:
+    """
+    This function builds the identity index from EEZ_full.csv.
+
+    Names are registered by decreasing priority (a name already known is never reassigned):
+    EEZ union names, NAME_ALIASES, territory names, sovereign names, then the names of
+    `name_sources`. ISO3 codes point to the main territory (UNION == TERRITORY1) of the code,
+    or to the sovereign state when several EEZ unions share it.
+    - eez_path : Path to EEZ_full.csv
+    - name_sources : (path, name column, ISO3 column) of .csv/.xlsx files whose names are added
+      as variants of the entity of their ISO3 code, e.g. the economy files
+    """
+    eez = pd.read_csv(eez_path)
+    eez = eez.sort_values('UNION').reset_index(drop=True)
+
+    entities = eez[['UNION', 'TERRITORY1', 'ISO_TER1', 'SOVEREIGN1', 'ISO_SOV1',
+                    'MRGID_EEZ', 'MRGID_TER1', 'MRGID_SOV1', 'POL_TYPE']].copy()
+    entities.insert(0, 'kind', 'eez')
+    entities = entities.rename(columns={'UNION': 'name'})
+
+    names, codes, mrgids = {}, {}, {}
+
+    def add_tier(mapping, pairs):
+        tier, ambiguous = {}, set()
+        for key, entity_id in pairs:
+            _add(tier, ambiguous, key, entity_id)
+        for key, entity_id in tier.items():
+            mapping.setdefault(key, entity_id)
+
+    add_tier(names, ((normalize_name(n), i) for i, n in entities['name'].items()))
+    add_tier(names, ((normalize_name(alias), names.get(normalize_name(target)))
+                     for alias, target in NAME_ALIASES.items() if normalize_name(target) in names))
+    add_tier(names, ((normalize_name(n), i) for i, n in entities['TERRITORY1'].items()))
+
+    # sovereign states that are not EEZ unions themselves (e.g. Kiribati and its island groups)
+    sovereigns = entities.dropna(subset='SOVEREIGN1').drop_duplicates('SOVEREIGN1')
+    sovereigns = sovereigns[~sovereigns['SOVEREIGN1'].map(normalize_name).isin(names)]
+    extra = pd.DataFrame({
+        'kind': 'sovereign', 'name': sovereigns['SOVEREIGN1'].to_numpy(),
+        'SOVEREIGN1': sovereigns['SOVEREIGN1'].to_numpy(), 'ISO_SOV1': sovereigns['ISO_SOV1'].to_numpy(),
+        'MRGID_SOV1': sovereigns['MRGID_SOV1'].to_numpy(),
+    }, index=np.arange(len(entities), len(entities) + len(sovereigns)))
+    entities = pd.concat([entities, extra])
+    add_tier(names, ((normalize_name(n), i) for i, n in extra['name'].items()))
+
+    main = entities[(entities['kind'] == 'eez') & (entities['name'] == entities['TERRITORY1'])]
+    preferred = main[main['name'] == main['SOVEREIGN1']]
+    add_tier(codes, ((code, i) for i, code in preferred['ISO_TER1'].dropna().items()))
+    add_tier(codes, ((code, i) for i, code in main['ISO_TER1'].dropna().items()))
+    add_tier(codes, ((code, i) for i, code in extra['ISO_SOV1'].dropna().items()))
+
+    add_tier(mrgids, ((int(m), i) for i, m in entities['MRGID_EEZ'].dropna().items()))
+
+    for path, name_col, code_col in name_sources or []:
+        if path.endswith('.csv'):
+            source = pd.read_csv(path, usecols=[name_col, code_col])
+        else:
+            source = cache.read_excel(path, usecols=[name_col, code_col])
+        source = source.dropna()
+        add_tier(names, ((normalize_name(n), codes[c]) for n, c in zip(source[name_col], source[code_col])
+                         if isinstance(c, str) and c in codes))
+
+    entities.index.name = 'entity_id'
+    return IdentityIndex(entities, names, codes, mrgids)
+
+
+_loaded = {}
+
+
+@traced()
+def load_identity_index(eez_path: str = EEZ_FULL_PATH,
+                        name_sources: List[Tuple[str, str, str]] = None) -> IdentityIndex:
+    """
+    This function returns the identity index of the given files. It is built once, then
+    persisted in the cache directory (keyed by the content hashes of the files) and kept in memory.
+    """
+    description = [cache.file_hash(eez_path)]
+    for path, name_col, code_col in name_sources or []:
+        description += [cache.file_hash(path), name_col, code_col]
+    key = hashlib.sha256('|'.join(description).encode('utf-8')).hexdigest()[:24]
+    if key in _loaded:
+        return _loaded[key]
+
+    entry = os.path.join(cache.CACHE_DIR, f'identity-{key}.pkl')
+    if os.path.exists(entry):
+        with open(entry, 'rb') as f:
+            index = pickle.load(f)
+    else:
+        index = build_identity_index(eez_path, name_sources)
+        os.makedirs(cache.CACHE_DIR, exist_ok=True)
+        with open(entry, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    _loaded[key] = index
+    return index
+
+
+def report_unmatched(unmatched: pd.DataFrame, source: str) -> None:
+    """
+    This function warns about the rows of a source that could not be resolved to an entity
+    """
+    if not unmatched.empty:
+        warnings.warn(f"{len(unmatched)} row(s) of {source} could not be matched to a country or "
+                      f"territory and are left out of the join: {unmatched['name'].tolist()}")
@@ -0,0 +1,209 @@
+# Per-stage instrumentation of the pipeline: time, memory, rows and bytes read of every traced call
+import os
+import sys
+import json
+import time
+import functools
+import threading
+import tracemalloc
+import warnings
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # not available on Windows, the RSS is then left out
+    resource = None
+
+ENV_VAR = 'BCW_PROFILE'
+ENABLED = os.environ.get(ENV_VAR, '') not in ('', '0')
+
+_spans = []
+_local = threading.local()
+_origin = time.perf_counter()
+_PROC_IO = '/proc/self/io'
+
+
+def configure(enabled: bool = True, memory: bool = True) -> None:
+    """
+    This function turns the instrumentation on or off (it is on when the BCW_PROFILE environment
+    variable is set). With memory=True, allocations are traced with tracemalloc, which slows the
+    traced calls down.
+    """
+    global ENABLED
+    ENABLED = enabled
+    if enabled and memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if not enabled and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset() -> None:
+    """This function forgets the recorded spans"""
+    _spans.clear()
+
+
+def _stack() -> List[Dict]:
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _bytes_read() -> int:
+    """Bytes read by the process so far (Linux only)"""
+    try:
+        with open(_PROC_IO, 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _max_rss_mb() -> float:
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024 # bytes on macOS, kB elsewhere
+
+
+def row_count(value) -> int:
+    """Number of rows of a DataFrame or Series (or of the first one of a tuple), None otherwise"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return len(value)
+    if isinstance(value, tuple):
+        rows = [len(v) for v in value if isinstance(v, (pd.DataFrame, pd.Series))]
+        return rows[0] if rows else None
+    return None
+
+
+@contextmanager
+def span(name: str, rows_in: int = None, files: List[str] = ()):
+    """
+    This context manager records a span: wall and CPU time, peak of the traced memory above its
+    start, process RSS high-water mark, and the bytes read by the process (or the size of `files`
+    where the operating system does not report them). Spans opened inside it are its children.
+    Nothing is recorded when the instrumentation is disabled.
+    """
+    if not ENABLED:
+        yield {}
+        return
+
+    stack = _stack()
+    record = {'name': name, 'path': ';'.join([s['name'] for s in stack] + [name]),
+              'thread': threading.current_thread().name, 'depth': len(stack), 'rows_in': rows_in}
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # the peak of the enclosing spans is saved before resetting it for this one
+        current, peak = tracemalloc.get_traced_memory()
+        for parent in stack:
+            parent['_peak'] = max(parent['_peak'], peak)
+        tracemalloc.reset_peak()
+        record['_mem'], record['_peak'] = current, current
+    io_start = _bytes_read()
+    record['start_s'] = time.perf_counter() - _origin
+    cpu = time.process_time()
+    stack.append(record)
+    try:
+        yield record
+    finally:
+        stack.pop()
+        record['wall_s'] = time.perf_counter() - _origin - record['start_s']
+        record['cpu_s'] = time.process_time() - cpu
+        if tracing and tracemalloc.is_tracing():
+            record['_peak'] = max(record['_peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = (record['_peak'] - record['_mem']) / 1024 ** 2
+            if stack:
+                stack[-1]['_peak'] = max(stack[-1]['_peak'], record['_peak'])
+        record.pop('_mem', None)
+        record.pop('_peak', None)
+        if rows_in is not None and record.get('rows_out') is not None:
+            record['row_delta'] = record['rows_out'] - rows_in
+        record['max_rss_mb'] = _max_rss_mb()
+        io_end = _bytes_read()
+        if io_start is not None and io_end is not None:
+            record['bytes_read'] = io_end - io_start
+        else:
+            record['bytes_read'] = sum(os.path.getsize(f) for f in files if isinstance(f, str) and os.path.isfile(f))
+        _spans.append(record)
+
+
+def traced(name: str = None, same_rows: bool = False) -> Callable:
+    """
+    This decorator records a span for every call of the function when the instrumentation is
+    enabled, and only costs a flag test otherwise.
+    - name : Name of the span (name of the function by default)
+    - same_rows : The function should return as many rows as its first DataFrame argument
+      (e.g. a left join), a different count is recorded and reported as a warning
+    """
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            values = list(args) + list(kwargs.values())
+            frames = [v for v in values if isinstance(v, pd.DataFrame)]
+            rows_in = len(frames[0]) if frames else None
+            with span(label, rows_in, [v for v in values if isinstance(v, str)]) as record:
+                output = func(*args, **kwargs)
+                record['rows_out'] = row_count(output)
+            if same_rows and record.get('row_delta', 0) != 0:
+                warnings.warn(f"{label} returned {record['rows_out']} rows from {rows_in} "
+                              f"({record['row_delta']:+d}), a join key is probably not unique", stacklevel=2)
+            return output
+        return wrapper
+    return decorator
+
+
+def spans() -> List[Dict]:
+    """This function returns the recorded spans, in the order they started"""
+    return sorted(_spans, key=lambda s: s['start_s'])
+
+
+def folded() -> Dict[str, float]:
+    """
+    This function returns the self time (in microseconds) of every call path, i.e. the time spent
+    in a span outside its children, as used by flame graph tools
+    """
+    totals, children = defaultdict(float), defaultdict(float)
+    for s in _spans:
+        totals[s['path']] += s['wall_s']
+        if ';' in s['path']:
+            children[s['path'].rsplit(';', 1)[0]] += s['wall_s']
+    return {path: max(total - children[path], 0.) * 1e6 for path, total in totals.items()}
+
+
+def write_trace(path: str) -> None:
+    """
+    This function writes the spans as JSON to `path` and the folded stacks next to it (same name
+    with a .folded extension), readable by flamegraph.pl, speedscope or inferno
+    """
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'spans': spans()}, f, indent=1)
+    with open(os.path.splitext(path)[0] + '.folded', 'w', encoding='utf-8') as f:
+        for stack, micros in folded().items():
+            f.write(f"{stack} {int(round(micros))}\n")
+
+
+def summary() -> pd.DataFrame:
+    """
+    This function returns one row per call path with its number of calls, total wall and CPU
+    times, largest memory peak, bytes read and row counts, the slowest first
+    """
+    if not _spans:
+        return pd.DataFrame()
+    table = pd.DataFrame(_spans)
+    for col in ['peak_mb', 'rows_in', 'rows_out', 'row_delta']:
+        table[col] = pd.to_numeric(table[col]) if col in table else float('nan')
+    grouped = table.groupby('path', sort=False).agg(
+        calls=('name', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'), peak_mb=('peak_mb', 'max'),
+        bytes_read=('bytes_read', 'sum'), rows_in=('rows_in', 'max'), rows_out=('rows_out', 'max'),
+        row_delta=('row_delta', lambda delta: delta.sum(min_count=1)),
+    )
+    return grouped.sort_values('wall_s', ascending=False)
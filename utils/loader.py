@@ -0,0 +1,126 @@
+# Concurrent loading of the independent input files of the pipeline
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List
+
+from utils import cache, instrument
+
+ENV_VAR = 'BCW_SEQUENTIAL_LOAD'
+SEQUENTIAL = os.environ.get(ENV_VAR, '') not in ('', '0')
+MAX_WORKERS = min(8, os.cpu_count() or 1)
+# openpyxl parses in pure Python and holds the GIL, so .xlsx files can be parsed in separate processes
+PROCESS_TYPES = ('.xlsx',)
+
+
+@dataclass
+class LoadTask:
+    """
+    A read of an input file, executed as func(*args, **kwargs).
+    - name : Key of the loaded frame in the result of load_all
+    - path : Path of the file, which decides the kind of pool running the task
+    - func : Function reading the file (a module-level function, as it may run in another process)
+    """
+    name: str
+    path: str
+    func: Callable
+    args: tuple = ()
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+
+
+def configure(sequential: bool = None, max_workers: int = None) -> None:
+    """
+    This function sets the loading options.
+    - sequential : True to read the files one after another in the main thread (e.g. for debugging)
+    - max_workers : Maximum number of threads and of processes
+    """
+    global SEQUENTIAL, MAX_WORKERS
+    if sequential is not None:
+        SEQUENTIAL = sequential
+    if max_workers is not None:
+        MAX_WORKERS = max_workers
+
+
+def _in_process(task: LoadTask) -> bool:
+    """Files parsed under the GIL go to processes, unless their parsed content is already cached"""
+    if not task.path.endswith(PROCESS_TYPES) or not os.path.exists(task.path):
+        return False
+    return not (cache.ENABLED and cache.has_entries(task.path))
+
+
+def _run(task: LoadTask) -> Any:
+    with instrument.span(f'load:{task.name}', files=[task.path]) as record:
+        output = task.func(*task.args, **task.kwargs)
+        record['rows_out'] = instrument.row_count(output)
+    return output
+
+
+def _run_in_process(settings: Dict[str, Any], task: LoadTask) -> Any:
+    # processes started with spawn do not inherit the cache settings of the parent
+    cache.configure(**settings)
+    return task.func(*task.args, **task.kwargs)
+
+
+def load_all(tasks: List[LoadTask], sequential: bool = None, processes: bool = False) -> Dict[str, Any]:
+    """
+    This function executes independent reads concurrently and returns their outputs by task name,
+    in the order of `tasks`.
+
+    The files are read on a thread pool bounded by MAX_WORKERS. With processes=True, the .xlsx
+    files not yet cached are parsed on a process pool instead (a single .xlsx file is simply read
+    in a thread); as processes are started with spawn on Windows, this is only safe from a script
+    whose entry point is under `if __name__ == '__main__'`, such as main.py. All the reads are
+    awaited before reporting errors, and the error raised is the one of the first failing task in
+    the order of `tasks`, whatever the order in which the reads finished.
+
+    Parameters
+    ----------
+    tasks : list of LoadTask
+        Reads to execute, with unique names.
+    sequential : bool, optional
+        Read the files one after another in the calling thread (SEQUENTIAL by default).
+    processes : bool, default=False
+        Parse the uncached .xlsx files in separate processes.
+
+    Returns
+    -------
+    dict
+        Task name -> output of its function.
+    """
+    names = [task.name for task in tasks]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Load tasks must have unique names: {names}")
+    sequential = SEQUENTIAL if sequential is None else sequential
+    if sequential or len(tasks) <= 1 or MAX_WORKERS <= 1:
+        outputs = {}
+        for task in tasks:
+            try:
+                outputs[task.name] = _run(task)
+            except Exception as error:
+                raise RuntimeError(f"Could not load '{task.name}' from {task.path}: {error}") from error
+        return outputs
+
+    in_process = {task.name for task in tasks if processes and _in_process(task)}
+    if len(in_process) <= 1:
+        in_process = set()
+    settings = {'enabled': cache.ENABLED, 'cache_dir': cache.CACHE_DIR, 'max_bytes': cache.MAX_CACHE_BYTES}
+
+    futures = {}
+    threads = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    processes = ProcessPoolExecutor(max_workers=min(MAX_WORKERS, len(in_process))) if in_process else None
+    try:
+        for task in tasks:
+            if task.name in in_process:
+                futures[task.name] = processes.submit(_run_in_process, settings, task)
+            else:
+                futures[task.name] = threads.submit(_run, task)
+    finally:
+        threads.shutdown(wait=True)
+        if processes is not None:
+            processes.shutdown(wait=True)
+
+    for task in tasks:
+        error = futures[task.name].exception()
+        if error is not None:
+            raise RuntimeError(f"Could not load '{task.name}' from {task.path}: {error}") from error
+    return {name: future.result() for name, future in futures.items()}
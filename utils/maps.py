@@ -0,0 +1,225 @@
+# Batch rendering of choropleth maps of the BCW from cached, simplified country geometries
+import os
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import matplotlib
+matplotlib.use('Agg') # files only, no display
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm, Normalize
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from utils import cache
+from utils.instrument import traced
+
+MAP_PATH = 'data_source/shp/map/ne_110m_admin_0_countries.shp'
+USA_SPLIT_PATH = 'data_source/shp/map/usa_split.csv'
+MAP_CRS = 'ESRI:54030' # Robinson
+# zoom level -> tolerance (m) of the simplification of the projected geometries
+ZOOMS = {'world': 25_000., 'region': 5_000., 'full': 0.}
+# subunits of usa_split.csv joined on the territory name instead of the ISO3 code
+SPLIT_KEYS = {'Alaska': 'Alaska'}
+
+
+@dataclass
+class MapSpec:
+    """
+    A figure of one or several choropleth maps sharing the same color scale.
+    - name : Name of the output file, without extension
+    - columns : Columns of the BCW data mapped, one map per column (e.g. ['cBCW', 'oBCW'])
+    - label : Label of the color bar
+    - titles : Titles of the maps (the column names by default)
+    - cmap : Matplotlib colormap
+    - log : Logarithmic color scale, for values spanning several orders of magnitude
+    - scale : Factor the values are multiplied by (e.g. 1e-9 for billion US$)
+    - zoom : Simplification level of the geometries (a key of ZOOMS)
+    """
+    name: str
+    columns: List[str]
+    label: str = ''
+    titles: Optional[List[str]] = None
+    cmap: str = 'viridis'
+    log: bool = True
+    scale: float = 1.
+    zoom: str = 'world'
+
+
+def default_specs() -> List[MapSpec]:
+    """
+    This function returns the maps of the paper: Total BCW, BCW per capita, coastal vs open-ocean
+    BCW and the LOW/HIGH sequestration rate scenarios
+    """
+    return [
+        MapSpec('total_bcw', ['Total BCW'], 'Total BCW (billion US$)', scale=1e-9),
+        MapSpec('bcw_per_capita', ['Total BCW_per_capita'], 'BCW per capita (US$)', cmap='magma_r'),
+        MapSpec('cbcw_vs_obcw', ['cBCW', 'oBCW'], 'BCW (billion US$)', ['Coastal BCW', 'Open-ocean BCW'],
+                scale=1e-9),
+        MapSpec('total_bcw_scenarios', ['Total BCW LOW', 'Total BCW', 'Total BCW HIGH'], 'Total BCW (billion US$)',
+                ['LOW sequestration rates', 'Central', 'HIGH sequestration rates'], scale=1e-9),
+    ]
+
+
+def add_scenario_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    This function adds the coastal and total BCW of the LOW and HIGH sequestration rate
+    scenarios ('cBCW LOW', 'Total BCW LOW', ...). The coastal BCW is proportional to the total
+    uptake, and the open-ocean BCW does not depend on the rates.
+    """
+    df = df.copy()
+    for scenario in ['LOW', 'HIGH']:
+        df[f'cBCW {scenario}'] = df['cBCW'] * df[f'tot_upt_{scenario}'] / df['tot_uptake (tC)']
+        total = df[[f'cBCW {scenario}', 'oBCW']].sum(axis=1, min_count=1)
+        df[f'Total BCW {scenario}'] = total
+    return df
+
+
+def load_geometries(map_path: str = MAP_PATH, usa_split_path: str = USA_SPLIT_PATH) -> gpd.GeoDataFrame:
+    """
+    This function reads the Natural Earth countries, replaces the United States by the two
+    subunits of usa_split.csv (Alaska being a separate territory of the BCW data), and returns
+    the 'key' (ISO3 code, or territory name for SPLIT_KEYS), 'NAME' and geometry of every country.
+    """
+    countries = gpd.read_file(map_path)
+    split = pd.read_csv(usa_split_path)
+    split = gpd.GeoDataFrame(split, geometry=shapely.from_wkt(split['geometry']), crs=countries.crs)
+    countries = pd.concat([countries[countries['ADM0_A3'] != 'USA'], split], ignore_index=True)
+    countries['key'] = countries['SUBUNIT'].map(SPLIT_KEYS).fillna(countries['ADM0_A3'])
+    return gpd.GeoDataFrame(countries[['key', 'NAME', 'geometry']], geometry='geometry', crs=countries.crs)
+
+
+def prepared_geometries(zoom: str = 'world', crs: str = MAP_CRS, map_path: str = MAP_PATH,
+                        usa_split_path: str = USA_SPLIT_PATH) -> gpd.GeoDataFrame:
+    """
+    This function returns the projected country geometries simplified for a zoom level.
+
+    The simplification is applied to the whole coverage at once (shapely.coverage_simplify), so
+    that the borders shared by two countries stay shared and no gap or overlap appears. The
+    result is cached in the cache directory for the content of the map files, the CRS and the
+    zoom level, so the geometries are only read, projected and simplified once.
+    """
+    key = json.dumps([cache.file_hash(map_path), cache.file_hash(usa_split_path), crs, ZOOMS[zoom]])
+    path = os.path.join(cache.CACHE_DIR, 'maps', f"{zoom}-{hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]}.feather")
+    if cache.ENABLED and os.path.exists(path):
+        return gpd.read_feather(path)
+
+    geoms = load_geometries(map_path, usa_split_path).to_crs(crs)
+    geoms['geometry'] = shapely.make_valid(geoms.geometry.values)
+    if ZOOMS[zoom] > 0:
+        geoms['geometry'] = shapely.coverage_simplify(geoms.geometry.values, ZOOMS[zoom])
+
+    if cache.ENABLED:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        geoms.to_feather(tmp)
+        os.replace(tmp, path)
+    return geoms
+
+
+def join_values(geoms: gpd.GeoDataFrame, df: pd.DataFrame, columns: Sequence[str]) -> gpd.GeoDataFrame:
+    """
+    This function joins columns of the BCW data to the geometries, on the ISO3 code or, for
+    territories without code, the territory name. A code shared by several territories keeps
+    the values of its first one.
+    """
+    keys = df['ISO'].fillna(df['country_name'])
+    values = df[list(columns)].set_axis(pd.Index(keys, name='key')).groupby(level=0, sort=False).first()
+    return geoms.join(values, on='key')
+
+
+# joined geometries of every zoom level, set once in every worker process
+_frames: Dict[str, gpd.GeoDataFrame] = {}
+
+
+def _init_worker(frames: Dict[str, gpd.GeoDataFrame]) -> None:
+    _frames.update(frames)
+
+
+def _render(spec: MapSpec, path: str, dpi: int) -> str:
+    """Draws the maps of a figure with a shared color scale and saves it (temporary file renamed)"""
+    frame = _frames[spec.zoom]
+    values = frame[spec.columns].to_numpy(dtype=float) * spec.scale
+    positive = values[np.isfinite(values) & (values > 0)] if spec.log else values[np.isfinite(values)]
+    if positive.size == 0:
+        norm = Normalize()
+    elif spec.log:
+        norm = LogNorm(positive.min(), positive.max())
+    else:
+        norm = Normalize(positive.min(), positive.max())
+
+    n = len(spec.columns)
+    fig, axes = plt.subplots(1, n, figsize=(8 * n, 4.8), squeeze=False)
+    for ax, col, title, data in zip(axes[0], spec.columns, spec.titles or spec.columns, values.T):
+        shown = np.isfinite(data) & ((data > 0) if spec.log else True)
+        frame[~shown].plot(ax=ax, color='#dddddd', linewidth=0)
+        frame[shown].assign(value=data[shown]).plot(column='value', ax=ax, cmap=spec.cmap, norm=norm, linewidth=0)
+        ax.set_title(title)
+        ax.set_axis_off()
+    mappable = plt.cm.ScalarMappable(norm=norm, cmap=spec.cmap)
+    fig.colorbar(mappable, ax=axes[0].tolist(), orientation='horizontal', fraction=0.05, pad=0.04, label=spec.label)
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        fig.savefig(tmp, dpi=dpi, format=os.path.splitext(path)[1][1:], bbox_inches='tight')
+        os.replace(tmp, path)
+    finally:
+        plt.close(fig)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+def _render_task(args) -> str:
+    return _render(*args)
+
+
+@traced()
+def render_maps(df: pd.DataFrame, specs: List[MapSpec] = None, output_dir: str = 'figures', workers: int = None,
+                fmt: str = 'png', dpi: int = 150) -> List[str]:
+    """
+    This function renders a batch of choropleth maps of the BCW data to files.
+
+    The geometries of every zoom level used are prepared once (see prepared_geometries) and
+    joined once to all the mapped columns, then the figures are rendered in parallel by a
+    process pool whose workers receive the joined geometries once.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Country-level BCW data (country_level_bcw.csv), with the 'ISO' and 'country_name' columns.
+    specs : list of MapSpec, optional
+        Figures to render (default_specs by default). Columns of the LOW and HIGH scenarios are
+        added by add_scenario_columns.
+    output_dir : str, default='figures'
+        Directory of the files.
+    workers : int, optional
+        Number of processes (in-process when None or 1).
+    fmt : str, default='png'
+        Format of the files ('png', 'pdf', 'svg', ...).
+    dpi : int, default=150
+        Resolution of raster formats.
+
+    Returns
+    -------
+    list of str
+        Paths of the rendered files, in the order of specs.
+    """
+    specs = specs or default_specs()
+    if any(col.endswith((' LOW', ' HIGH')) for spec in specs for col in spec.columns):
+        df = add_scenario_columns(df)
+    columns = list(dict.fromkeys(col for spec in specs for col in spec.columns))
+    frames = {zoom: join_values(prepared_geometries(zoom), df, columns) for zoom in {spec.zoom for spec in specs}}
+
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(spec, os.path.join(output_dir, f'{spec.name}.{fmt}'), dpi) for spec in specs]
+    workers = min(workers or 1, os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        _init_worker(frames)
+        return [_render_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(frames,)) as pool:
+        return list(pool.map(_render_task, tasks))
@@ -0,0 +1,181 @@
+# Monte Carlo propagation of the sequestration rate and GSCC uncertainties to the BCW
+import os
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from utils.bce_areas import load_sequestration_json
+from utils.instrument import traced
+
+# quantile of the standard normal distribution matching the 83.3% GSCC quantile
+_Z_833 = NormalDist().inv_cdf(0.833)
+_BINS = 4096
+
+
+def _draw(params: Dict[str, np.ndarray], seed: np.random.SeedSequence, size: int) -> np.ndarray:
+    """
+    Draws `size` samples of the BCW of every country, the last row being the global BCW.
+
+    Sequestration rates are normal with the standard error of sequestration_rates.json (clipped at 0).
+    Each country SCC is a two-piece normal centred on its median whose lower and upper halves match
+    the 16.7% and 83.3% quantiles; the GSCC is the sum of the country SCCs.
+    """
+    rng = np.random.default_rng(seed)
+    n_eco = len(params['rate'])
+
+    # ecosystems x samples
+    rates = params['rate'][:, None] + params['se'][:, None] * rng.standard_normal((n_eco, size))
+    np.clip(rates, 0, None, out=rates)
+
+    # countries of the GSCC table x samples
+    if params['comonotonic']:
+        z = np.broadcast_to(rng.standard_normal(size), (len(params['scc_median']), size))
+    else:
+        z = rng.standard_normal((len(params['scc_median']), size))
+    scale = np.where(z < 0, params['scc_low'][:, None], params['scc_high'][:, None])
+    gscc = (params['scc_median'][:, None] + z * scale).sum(axis=0)
+
+    # countries x samples
+    sequestration = params['areas'] @ rates + params['bcp'][:, None]
+    bcw = sequestration * (params['cmol'] * gscc)[None, :]
+    bcw[~params['valid']] = np.nan
+
+    total = np.nansum(bcw, axis=0)
+    return np.vstack([bcw, total[None, :]])
+
+
+def _range_worker(args) -> np.ndarray:
+    params, seed, size = args
+    bcw = _draw(params, seed, size)
+    return np.stack([np.fmin.reduce(bcw, axis=1), np.fmax.reduce(bcw, axis=1)], axis=1)
+
+
+def _histogram_worker(args) -> np.ndarray:
+    params, seed, size, lo, width = args
+    bcw = _draw(params, seed, size)
+    rows = bcw.shape[0]
+
+    idx = np.floor((bcw - lo[:, None]) / width[:, None] * _BINS)
+    idx = np.clip(np.nan_to_num(idx, nan=0), 0, _BINS - 1).astype(np.int64)
+    flat = (np.arange(rows)[:, None] * _BINS + idx).ravel()
+    return np.bincount(flat, minlength=rows * _BINS).reshape(rows, _BINS)
+
+
+def _map(worker, tasks: List, workers: int) -> List:
+    if workers is None or workers <= 1:
+        return [worker(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(worker, tasks))
+
+
+def _histogram_percentiles(counts: np.ndarray, lo: np.ndarray, width: np.ndarray,
+                           percentiles: Sequence[float]) -> np.ndarray:
+    """Percentiles of every row of a histogram, interpolated linearly inside the bins"""
+    cum = np.cumsum(counts, axis=1)
+    total = cum[:, -1]
+    out = np.empty((counts.shape[0], len(percentiles)))
+    for j, q in enumerate(percentiles):
+        target = q / 100 * total
+        b = (cum >= target[:, None]).argmax(axis=1)
+        rows = np.arange(counts.shape[0])
+        before = np.where(b > 0, cum[rows, np.maximum(b - 1, 0)], 0)
+        inside = counts[rows, b]
+        frac = np.divide(target - before, inside, out=np.zeros(len(rows)), where=inside > 0)
+        out[:, j] = lo + (b + frac) / _BINS * width
+    return out
+
+
+@traced()
+def bcw_monte_carlo(df: pd.DataFrame, json_path: str, bce_columns: Dict[str, str], cscc: pd.DataFrame,
+                    cmol: float, n_samples: int = 10_000, seed: int = None, chunk_size: int = 10_000,
+                    workers: int = None, percentiles: Sequence[float] = (2.5, 50, 97.5),
+                    comonotonic_gscc: bool = False):
+    """
+    This function estimates confidence intervals of the Total BCW of every country by Monte Carlo.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Output of bcw_computer, with the BCE area columns and 'BCP Seq (tC)'.
+    json_path : str
+        Path of sequestration_rates.json (rates and standard errors).
+    bce_columns : dict
+        Ecosystem name of the JSON file -> area column of df, e.g. {'mangroves': 'mangroves_area_km2'}.
+    cscc : pandas.DataFrame
+        Country-level SCC with the columns 'country', '16.7%', 'median' and '83.3%'
+        (country_level_gscc.csv written by gscc_computer).
+    cmol : float
+        Carbon to CO2 conversion factor.
+    n_samples : int, default=10_000
+        Number of Monte Carlo samples.
+    seed : int, optional
+        Seed of the random generator. Results only depend on the seed and chunk_size,
+        not on the number of workers.
+    chunk_size : int, default=10_000
+        Number of samples drawn at once, which bounds the memory used.
+    workers : int, optional
+        Number of processes the chunks are spread over (in-process when None or 1).
+    percentiles : sequence of float, default=(2.5, 50, 97.5)
+        Percentiles reported for every country.
+    comonotonic_gscc : bool, default=False
+        If True, all country SCCs are drawn from the same standard normal variate instead of
+        independently, which gives the widest GSCC distribution.
+
+    Returns
+    -------
+    country_ci : pandas.DataFrame
+        'country_name', 'ISO' and one 'Total BCW p<q>' column per percentile.
+    global_ci : pandas.Series
+        Percentiles of the global BCW.
+
+    When all samples fit in one chunk the percentiles are exact. Otherwise they are read from
+    per-country histograms of 4096 bins accumulated over the chunks, the range of which is
+    found by a first pass regenerating the same samples.
+    """
+    rates = load_sequestration_json(json_path)
+    ecosystems = list(bce_columns)
+    cscc = cscc[cscc['country'] != 'WLD']
+
+    areas = df[[bce_columns[eco] for eco in ecosystems]].to_numpy(dtype=float)
+    bcp = df['BCP Seq (tC)'].to_numpy(dtype=float)
+    valid = ~(np.isnan(areas).all(axis=1) & np.isnan(bcp))
+    median = cscc['median'].to_numpy(dtype=float)
+    params = {
+        'rate': np.array([rates[f'{eco}_sr'] for eco in ecosystems], dtype=float),
+        'se': np.array([rates[f'{eco}_sr_se'] for eco in ecosystems], dtype=float),
+        'areas': np.nan_to_num(areas),
+        'bcp': np.nan_to_num(bcp),
+        'valid': valid,
+        'scc_median': median,
+        'scc_low': (median - cscc['16.7%'].to_numpy(dtype=float)) / _Z_833,
+        'scc_high': (cscc['83.3%'].to_numpy(dtype=float) - median) / _Z_833,
+        'cmol': cmol,
+        'comonotonic': comonotonic_gscc,
+    }
+
+    sizes = [min(chunk_size, n_samples - start) for start in range(0, n_samples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    workers = min(workers or 1, os.cpu_count() or 1, len(sizes))
+
+    if len(sizes) == 1:
+        values = np.percentile(_draw(params, seeds[0], sizes[0]), percentiles, axis=1).T
+    else:
+        ranges = _map(_range_worker, [(params, s, n) for s, n in zip(seeds, sizes)], workers)
+        lo = np.min([r[:, 0] for r in ranges], axis=0)
+        hi = np.max([r[:, 1] for r in ranges], axis=0)
+        width = np.where(hi > lo, hi - lo, 1.) * (1 + 1e-12)
+        tasks = [(params, s, n, lo, width) for s, n in zip(seeds, sizes)]
+        counts = np.sum(_map(_histogram_worker, tasks, workers), axis=0)
+        values = _histogram_percentiles(counts, lo, width, percentiles)
+
+    values[:-1][~valid] = np.nan
+    labels = [f'Total BCW p{q:g}' for q in percentiles]
+    country_ci = pd.DataFrame(values[:-1], columns=labels)
+    country_ci.insert(0, 'country_name', df['country_name'].to_numpy())
+    country_ci.insert(1, 'ISO', df['ISO'].to_numpy())
+    global_ci = pd.Series(values[-1], index=labels, name='Global BCW')
+
+    return country_ci, global_ci
@@ -0,0 +1,66 @@
+# Registry of the values of the data replaced by literature estimates, with their citation
+from dataclasses import dataclass
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+
+# columns identifying a territory, which an override cannot change
+ID_COLUMNS = ['UNION', 'TERRITORY1', 'ISO_TER1', 'SOVEREIGN1', 'concat_identifiers', 'country_name', 'ISO']
+
+
+@dataclass
+class Override:
+    """
+    A value of the data replaced by a better estimate.
+    - key_column : Column identifying the territory (e.g. 'TERRITORY1', 'ISO_TER1', 'UNION')
+    - key : Value of key_column of the rows overridden
+    - column : Column overridden (e.g. 'seagrasses_area_km2')
+    - value : New value
+    - citation : Source of the new value
+    """
+    key_column: str
+    key: Any
+    column: str
+    value: Any
+    citation: str = ''
+
+
+# countries with incomplete or outdated BCE areas (see bce_areas.adjust_data)
+OVERRIDES = [
+    Override('TERRITORY1', 'Bahamas', 'seagrasses_area_km2', 79757.0,
+             'Fu et al. (2023), Gallagher et al. (2022): mean of 66,990 - 92,524 km²'),
+    Override('ISO_TER1', 'MRT', 'saltmarshes_area_km2', 23.0, 'Pottier et al. (2021)'),
+    Override('ISO_TER1', 'MRT', 'seagrasses_area_km2', 772.0, 'Pottier et al. (2021)'),
+]
+
+
+def override_mask(df: pd.DataFrame, override: Override) -> np.ndarray:
+    """This function returns the rows of df an override applies to"""
+    if override.key_column not in df.columns:
+        raise KeyError(f"Override key column '{override.key_column}' is not in the data")
+    if override.column not in df.columns:
+        raise KeyError(f"Overridden column '{override.column}' is not in the data")
+    if override.column in ID_COLUMNS:
+        raise ValueError(f"Identifier column '{override.column}' cannot be overridden")
+    return (df[override.key_column] == override.key).to_numpy()
+
+
+def apply_overrides(df: pd.DataFrame, overrides: List[Override] = None, columns: List[str] = None) -> pd.DataFrame:
+    """
+    This function sets the values of the overrides (OVERRIDES by default) in df, in their order,
+    and returns df. With columns, the overrides of other columns are left out.
+    """
+    overrides = OVERRIDES if overrides is None else overrides
+    for override in overrides:
+        if columns is not None and override.column not in columns:
+            continue
+        df.loc[override_mask(df, override), override.column] = override.value
+    return df
+
+
+def citations(overrides: List[Override] = None) -> pd.DataFrame:
+    """This function returns the overrides as a table, for the documentation of the data"""
+    overrides = OVERRIDES if overrides is None else overrides
+    return pd.DataFrame([vars(override) for override in overrides],
+                        columns=['key_column', 'key', 'column', 'value', 'citation'])
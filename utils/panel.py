@@ -0,0 +1,173 @@
+# Year panel (territory x year) of the BCW and of the economic indicators
+import warnings
+from functools import reduce
+from typing import List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from utils import cache
+from utils.adding_eco_data import IndicatorSource
+from utils.consolidation import KIRIBATI
+from utils.functions import per_capita, ratio_computer
+from utils.instrument import traced
+
+# columns of the BCW data carried to every year of the panel
+ID_COLUMNS = ['country_name', 'TERRITORY1', 'ISO', 'SOVEREIGN1', 'Continent', 'Groups']
+BCW_COLUMNS = ['Area_EEZ_KM2', 'tot_uptake (tC)', 'BCP Seq (tC)', 'Total BCseq', 'cBCW', 'oBCW', 'Total BCW']
+
+# year of the single-year sources of the panel: WPP population estimates and external debt
+POPULATION_YEAR = 2024
+DEBT_YEAR = 2023
+
+def default_panel_sources(pop_path: str, gdp_path: str, cb_path: str, debt_path: str) -> List[IndicatorSource]:
+    """
+    This function returns the sources of the year panel: GDP and CO2 emissions of every year,
+    population and debt of their single year
+    """
+    return [
+        IndicatorSource(pop_path, 'ISO3 Alpha-code', {'Total Population, as of 1 July (thousands)': 'Population'},
+                        scale={'Population': 1000}, year=POPULATION_YEAR),
+        # GDP (constant 2015 US$) of every year, one column per year
+        IndicatorSource(gdp_path, 'Country Code', {'GDP (constant 2015 US$)': 'GDP'}, sheet_name='Data (2)',
+                        header=3, wide=True),
+        IndicatorSource(cb_path, 'Code', {'Annual CO₂ emissions': 'CO2_emissions'}, year='Year'),
+        IndicatorSource(debt_path, 'economy', {'YR2023_2015US$': 'Debt (2015 US$)'}, year=DEBT_YEAR),
+    ]
+
+def _single_year(source: IndicatorSource) -> bool:
+    return not source.wide and not isinstance(source.year, str)
+
+@traced()
+def load_panel_source(source: IndicatorSource) -> pd.Series:
+    """
+    This function reads a source and returns its values indexed by (ISO3 code, year). The values
+    of a single-year source only get the year of the source. A code appearing several times for
+    the same year keeps its first value.
+    """
+    if len(source.columns) != 1:
+        raise ValueError(f"A panel source adds a single indicator, not {list(source.columns.values())}")
+    (column, name), = source.columns.items()
+    if not source.wide and source.year is None:
+        raise ValueError(f"The year of the values of {name} is not given")
+    if source.path.endswith('.csv'):
+        data = pd.read_csv(source.path)
+    elif source.path.endswith('.xlsx'):
+        data = cache.read_excel(source.path, sheet_name=source.sheet_name, header=source.header)
+    else:
+        raise ValueError("Unsupported file format. Please provide a .csv or .xlsx file.")
+    data = data.dropna(subset=source.key)
+    for col, value in source.filters.items():
+        data = data[data[col] == value]
+
+    if source.wide:
+        # the columns whose name is a year are stacked
+        years = pd.to_numeric(pd.Index(data.columns.astype(str)), errors='coerce')
+        year_columns = data.columns[~np.isnan(years)]
+        values = data.set_index(source.key)[year_columns]
+        values.columns = years[~np.isnan(years)].astype(np.int64)
+        values = values.stack()
+    elif isinstance(source.year, str):
+        values = data.set_index([source.key, source.year])[column]
+        values.index = values.index.set_levels(values.index.levels[1].astype(np.int64), level=1)
+    else:
+        values = data.set_index([source.key, np.full(len(data), source.year, dtype=np.int64)])[column]
+
+    values = values[~values.index.duplicated()].astype(float) * source.scale.get(name, 1.)
+    values.index.names = ['ISO', 'year']
+    return values.rename(name)
+
+@traced()
+def build_panel(df: pd.DataFrame, sources: List[IndicatorSource], years: Sequence[int] = None,
+                columns: List[str] = None) -> pd.DataFrame:
+    """
+    This function builds the long (territory x year) panel of the BCW data and the indicators.
+
+    The rows of df are repeated for every year, then the sources are aligned on the (ISO3 code,
+    year) keys of the whole panel at once, without any loop over the years. The values of a
+    single-year source are only given to its year, missing in the others.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Country-level BCW data (output of bcw_computer), with the ID_COLUMNS.
+    sources : list of IndicatorSource
+        Indicators to add, with their `year` or `wide` layout (see default_panel_sources).
+    years : sequence of int, optional
+        Years of the panel (by default the years covered by every source with several years,
+        plus the years of the single-year sources, so that their values are in the panel).
+    columns : list, optional
+        Columns of df repeated over the years (BCW_COLUMNS by default).
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per territory and year: the ID_COLUMNS, 'year', the columns of df and one column
+        per source. Indicators are only given to main territories (country_name == TERRITORY1) and
+        to Kiribati, whose island groups are consolidated into a single row.
+    """
+    tables = [load_panel_source(source) for source in sources]
+    names = [table.name for table in tables]
+    if years is None:
+        source_years = [np.unique(table.index.get_level_values('year')) for table in tables]
+        several = [table_years for source, table_years in zip(sources, source_years) if not _single_year(source)]
+        single = [table_years for source, table_years in zip(sources, source_years) if _single_year(source)]
+        years = reduce(np.intersect1d, several) if several else np.array([], dtype=np.int64)
+        years = np.union1d(years, np.concatenate(single)) if single else years
+    years = np.asarray(years, dtype=np.int64)
+    columns = [col for col in (columns or BCW_COLUMNS) if col in df.columns]
+
+    n, t = len(df), len(years)
+    rows = np.repeat(np.arange(n), t)
+    panel = df[ID_COLUMNS + columns].iloc[rows].reset_index(drop=True)
+    panel.insert(len(ID_COLUMNS), 'year', np.tile(years, n))
+
+    keys = pd.MultiIndex.from_arrays([panel['ISO'].to_numpy(), panel['year'].to_numpy()], names=['ISO', 'year'])
+    lookup = pd.concat(tables, axis=1)
+    panel[names] = lookup.reindex(keys).to_numpy()
+
+    main = ((df['country_name'] == df['TERRITORY1']) | (df['country_name'] == KIRIBATI.target)).to_numpy()
+    masked = [name for source, name in zip(sources, names) if source.main_territory_only]
+    panel.loc[~main[rows], masked] = np.nan
+
+    return panel[ID_COLUMNS + ['year'] + columns + names]
+
+def panel_ratios(panel: pd.DataFrame, bcw_column: str = 'Total BCW', pop_column: str = 'Population',
+                 gdp_column: str = 'GDP', co2_column: str = 'CO2_emissions') -> pd.DataFrame:
+    """
+    This function adds the BCW ratios to every year of the panel at once: BCW, GDP and CO2
+    emissions per capita, BCW to GDP and BCW per tonne of CO2 emitted
+    """
+    panel = per_capita(panel, [bcw_column, gdp_column, co2_column], pop_column)
+    panel = ratio_computer(panel, bcw_column, gdp_column, f'{bcw_column}_to_GDP')
+    panel = ratio_computer(panel, bcw_column, co2_column, f'{bcw_column}_per_tCO2')
+    ratios = [f'{col}_per_capita' for col in [bcw_column, gdp_column, co2_column]]
+    ratios += [f'{bcw_column}_to_GDP', f'{bcw_column}_per_tCO2']
+    empty = [col for col in ratios if panel[col].isna().all()]
+    if empty:
+        warnings.warn(f"The panel ratios {empty} are missing for every territory and year: no year of the panel "
+                      f"has values of both their inputs (e.g. a single-year population source)")
+    return panel
+
+def bcw_panel(df: pd.DataFrame, pop_path: str, gdp_path: str, cb_path: str, debt_path: str,
+              years: Sequence[int] = None) -> pd.DataFrame:
+    """
+    This function returns the year panel of the BCW data with its ratios, from the default sources.
+    - df : Country-level BCW data
+    - pop_path, gdp_path, cb_path, debt_path : Paths to the population, GDP, CO2 emissions and
+      Total external debt data files
+    - years : Years of the panel (the years of both the GDP and CO2 files, plus POPULATION_YEAR and
+      DEBT_YEAR, by default; the population and debt are only given to their own year)
+    """
+    sources = default_panel_sources(pop_path, gdp_path, cb_path, debt_path)
+    return panel_ratios(build_panel(df, sources, years))
+
+def write_panel(panel: pd.DataFrame, path: str) -> None:
+    """
+    This function saves the panel, as Parquet (columnar) when the path ends with .parquet and as
+    a long CSV file otherwise
+    """
+    if path.endswith('.parquet'):
+        panel.to_parquet(path, index=False)
+    else:
+        panel.to_csv(path, index=False)
@@ -0,0 +1,175 @@
+# Partitioned out-of-core computation of the BCE areas by EEZ from grid-cell habitat inputs
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from utils.bce_areas import combine_bce_data, concat_identifiers, import_data
+from utils.instrument import traced
+
+PARTITIONS = 16
+WORKERS = None
+CHUNKSIZE = 1_000_000
+SPILL_DIR = None
+
+# spilled cells: hash of the EEZ identifier and area
+_SPILL_KEY = 'key'
+
+
+def configure(partitions: int = None, workers: int = None, chunksize: int = None, spill_dir: str = None) -> None:
+    """
+    This function sets the defaults of partitioned_bce_data.
+    - partitions : Number of partitions of the EEZs (a partition must fit in memory)
+    - workers : Number of processes (os.cpu_count() by default)
+    - chunksize : Number of cells read at once from an input file
+    - spill_dir : Directory of the temporary partition files (the system temporary directory by default)
+    """
+    global PARTITIONS, WORKERS, CHUNKSIZE, SPILL_DIR
+    if partitions is not None:
+        PARTITIONS = partitions
+    if workers is not None:
+        WORKERS = workers
+    if chunksize is not None:
+        CHUNKSIZE = chunksize
+    if spill_dir is not None:
+        SPILL_DIR = spill_dir
+
+
+def read_chunks(path: str, columns: List[str], chunksize: int) -> Iterator[pd.DataFrame]:
+    """
+    This function reads the columns of a .csv or .parquet file by chunks of chunksize rows,
+    the columns being kept in the order of the file (as import_data does)
+    """
+    if path.endswith('.csv'):
+        header = pd.read_csv(path, nrows=0).columns
+        ids = {col: str for col in columns[:-1]} # identifiers read as text whatever the chunk
+        yield from pd.read_csv(path, usecols=[col for col in header if col in columns], dtype=ids, chunksize=chunksize)
+    elif path.endswith('.parquet'):
+        parquet = pq.ParquetFile(path)
+        names = [col for col in parquet.schema_arrow.names if col in columns]
+        for batch in parquet.iter_batches(batch_size=chunksize, columns=names):
+            yield batch.to_pandas()
+    else:
+        raise ValueError("Unsupported file format for partitioned reading. Please provide .csv or .parquet files.")
+
+
+def _hash_keys(keys: pd.Series) -> np.ndarray:
+    return pd.util.hash_array(keys.to_numpy(dtype=object))
+
+
+def _spill(area_col: str, paths: List[str], select: List[str], partitions: int, chunksize: int,
+           directory: str) -> Tuple[Dict[int, str], Dict[int, str]]:
+    """
+    Streams the cells of the files of an area column into one Parquet file per partition, with
+    the hash of the EEZ identifier and the area of every cell in the order of the files. Returns
+    the files of the partitions and the identifier of every hash.
+    """
+    writers: Dict[int, pq.ParquetWriter] = {}
+    files: Dict[int, str] = {}
+    names: Dict[int, str] = {}
+    schema = pa.schema([(_SPILL_KEY, pa.uint64()), (area_col, pa.float64())])
+    try:
+        for path in paths:
+            for chunk in read_chunks(path, select + [area_col], chunksize):
+                keys = concat_identifiers(chunk)
+                hashes = _hash_keys(keys)
+                for h, key in zip(*np.unique(hashes, return_index=True)):
+                    if names.setdefault(int(h), keys.iat[key]) != keys.iat[key]:
+                        raise ValueError(f"Hash collision between the EEZs {names[int(h)]!r} and {keys.iat[key]!r}")
+                cells = pd.DataFrame({_SPILL_KEY: hashes, area_col: chunk[area_col].to_numpy(dtype=float)})
+                for part, rows in cells.groupby(hashes % partitions, sort=False):
+                    if part not in writers:
+                        files[part] = os.path.join(directory, f'{area_col}-{part}.parquet')
+                        writers[part] = pq.ParquetWriter(files[part], schema)
+                    writers[part].write_table(pa.Table.from_pandas(rows, schema=schema, preserve_index=False))
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return files, names
+
+
+def _spill_task(args) -> Tuple[Dict[int, str], Dict[int, str]]:
+    return _spill(*args)
+
+
+def _sum_partition(files: Dict[str, str]) -> Dict[str, pd.DataFrame]:
+    """
+    Sums the areas of the cells of a partition by EEZ. All the cells of an EEZ are in the same
+    partition, in the order of the input files, so every sum is the one of a single-frame run.
+    """
+    sums = {}
+    for area_col, path in files.items():
+        cells = pd.read_parquet(path)
+        sums[area_col] = cells.groupby(_SPILL_KEY).sum().reset_index()
+    return sums
+
+
+def _map(func, tasks: list, workers: int) -> list:
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1:
+        return [func(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(func, tasks))
+
+
+@traced()
+def partitioned_bce_data(eez_path: str, habitat_paths: Dict[str, Union[str, List[str]]], select: List[str],
+                         partitions: int = None, workers: int = None, chunksize: int = None,
+                         spill_dir: str = None) -> pd.DataFrame:
+    """
+    This function computes the BCE areas by EEZ from habitat inputs too large to fit in memory,
+    such as areas by grid cell.
+
+    The cells of every input file are streamed by chunks and written to partitions keyed by
+    EEZ, then the partitions are summed in parallel processes and the sums of all partitions
+    combined. An EEZ belongs to a single partition and its cells keep the order of the files,
+    so the result is identical to generate_bce_data on the same files read in a single frame;
+    the memory used is bounded by the size of a chunk and of a partition. The rates, BCW,
+    consolidations and per capita values follow from this table as in main.py.
+
+    Parameters
+    ----------
+    eez_path : str
+        Path of the EEZ data file (the total area 'a' of every EEZ).
+    habitat_paths : dict
+        Area column -> path, or list of paths, of the .csv or .parquet files of the areas by cell,
+        with the `select` identifier columns first. The three columns are given in the order
+        of combine_bce_data.
+    select : list
+        Identifier columns of the EEZs (UNION, TERRITORY1, ISO_TER1, SOVEREIGN1).
+    partitions, workers, chunksize, spill_dir : optional
+        See configure (its values by default).
+
+    Returns
+    -------
+    pandas.DataFrame
+        BCE areas by EEZ, as returned by generate_bce_data.
+    """
+    partitions = partitions or PARTITIONS
+    workers = workers or WORKERS
+    chunksize = chunksize or CHUNKSIZE
+    area_cols = list(habitat_paths)
+    eez = import_data(eez_path, select + ['a'])
+
+    with tempfile.TemporaryDirectory(prefix='bcw-partitions-', dir=spill_dir or SPILL_DIR) as directory:
+        tasks = [(col, [paths] if isinstance(paths, str) else list(paths), select, partitions, chunksize, directory)
+                 for col, paths in habitat_paths.items()]
+        spilled = _map(_spill_task, tasks, workers)
+        names = {h: key for _, hashes in spilled for h, key in hashes.items()}
+
+        files = [{col: files[part] for col, (files, _) in zip(area_cols, spilled) if part in files}
+                 for part in range(partitions)]
+        sums = _map(_sum_partition, [part for part in files if part], workers)
+
+    frames = {'eez': eez}
+    for col in area_cols:
+        parts = [part[col] for part in sums if col in part]
+        table = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame({_SPILL_KEY: [], col: []})
+        table.insert(0, 'concat_identifiers', table.pop(_SPILL_KEY).map(names))
+        frames[col] = table
+    return combine_bce_data(frames, area_cols)
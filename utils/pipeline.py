@@ -0,0 +1,184 @@
+# Incremental execution of the BCW pipeline with memoized stage outputs
+import os
+import glob
+import hashlib
+import inspect
+import json
+import pickle
+import time
+from functools import lru_cache
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List
+
+import pandas as pd
+
+from utils import cache, compact, instrument, sinks
+
+
+@dataclass
+class Stage:
+    """
+    A step of the pipeline, called as func(**inputs, **deps, **params).
+    - name : Unique name of the stage
+    - func : Function computing the output of the stage
+    - inputs : Argument name -> path of an input file
+    - deps : Argument name -> name of an upstream stage whose output is passed
+    - params : Argument name -> constant value
+    """
+    name: str
+    func: Callable
+    inputs: Dict[str, str] = field(default_factory=dict)
+    deps: Dict[str, str] = field(default_factory=dict)
+    params: Dict[str, Any] = field(default_factory=dict)
+
+
+def _stage_dir() -> str:
+    return os.path.join(cache.CACHE_DIR, 'stages')
+
+
+def _entry(stage: Stage, key: str) -> str:
+    return os.path.join(_stage_dir(), f'{stage.name}-{key}.pkl')
+
+
+@lru_cache(maxsize=None)
+def code_digest() -> str:
+    """
+    This function returns a digest of the source of every module of the utils package. The
+    stages call helpers of these modules (adjust_data and the OVERRIDES, the consolidation
+    rules, bcp_inclusion, ...) that their own source does not show, so any change of the
+    package invalidates the memoized outputs.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:24]
+
+
+def stage_keys(stages: List[Stage]) -> Dict[str, str]:
+    """
+    This function returns the key of every stage: a digest of the stage source code and of the
+    utils package (see code_digest), the content hashes of its input files, its parameters and
+    the keys of its upstream stages, so that a change anywhere upstream changes the key of every
+    downstream stage. Files a stage reads must be declared in its inputs to be taken into account.
+    """
+    keys = {}
+    for stage in stages:
+        unknown = [dep for dep in stage.deps.values() if dep not in keys]
+        if unknown:
+            raise ValueError(f"Stage '{stage.name}' depends on undeclared or later stages: {unknown}")
+        description = {
+            'name': stage.name,
+            'source': inspect.getsource(stage.func),
+            'code': code_digest(),
+            'inputs': {arg: cache.file_hash(path) for arg, path in sorted(stage.inputs.items())},
+            'deps': {arg: keys[dep] for arg, dep in sorted(stage.deps.items())},
+            'params': {arg: repr(value) for arg, value in sorted(stage.params.items())},
+        }
+        if compact.ENABLED:
+            # outputs of the compact mode have other dtypes
+            description['compact'] = True
+        if sinks.signature():
+            # the files written by the stages depend on the output options
+            description['outputs'] = sinks.signature()
+        keys[stage.name] = hashlib.sha256(json.dumps(description).encode('utf-8')).hexdigest()[:24]
+    return keys
+
+
+def plan(stages: List[Stage], targets: List[str] = None, force: bool = False) -> List[str]:
+    """
+    This function returns the names of the stages that a run would execute to produce `targets`
+    (all stages by default), without executing anything.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    keys = stage_keys(stages)
+    to_run = []
+
+    def visit(name):
+        if name in to_run:
+            return
+        stage = by_name[name]
+        if force or not os.path.exists(_entry(stage, keys[name])):
+            for dep in stage.deps.values():
+                visit(dep)
+            to_run.append(name)
+
+    for name in targets or list(by_name):
+        visit(name)
+    return [stage.name for stage in stages if stage.name in to_run]
+
+
+def run(stages: List[Stage], targets: List[str] = None, force: bool = False,
+        verbose: bool = True) -> Dict[str, Any]:
+    """
+    This function produces the outputs of `targets` (all stages by default).
+
+    A stage whose key has a memoized output is loaded from disk, and its upstream stages are
+    not even loaded. Other stages are executed and their output is stored, replacing the output
+    of a previous key. Side effects of a stage (files it writes) only happen when it executes.
+
+    Returns
+    -------
+    dict
+        Stage name -> output, for the targets and every stage that was loaded or executed.
+    """
+    by_name = {stage.name: stage for stage in stages}
+    keys = stage_keys(stages)
+    results = {}
+    os.makedirs(_stage_dir(), exist_ok=True)
+
+    def get(name):
+        if name in results:
+            return results[name]
+        stage = by_name[name]
+        entry = _entry(stage, keys[name])
+
+        if not force and os.path.exists(entry):
+            with instrument.span(f'{name} (cached)'), open(entry, 'rb') as f:
+                results[name] = pickle.load(f)
+            if verbose:
+                print(f"[{name}] cached")
+            return results[name]
+
+        # stages may modify the frames they receive, upstream outputs are handed over as copies
+        # (sharing their buffers in compact mode)
+        kwargs = {}
+        for arg, dep in stage.deps.items():
+            value = get(dep)
+            kwargs[arg] = compact.lazy_copy(value) if isinstance(value, pd.DataFrame) else value
+        start = time.perf_counter()
+        rows_in = next((len(value) for value in kwargs.values() if isinstance(value, pd.DataFrame)), None)
+        with instrument.span(name, rows_in, list(stage.inputs.values())) as record:
+            output = stage.func(**stage.inputs, **kwargs, **stage.params)
+            if compact.ENABLED and isinstance(output, pd.DataFrame):
+                output = compact.compact_frame(output)
+            record['rows_out'] = instrument.row_count(output)
+        if compact.ENABLED and isinstance(output, pd.DataFrame):
+            compact.record(name, output)
+        if verbose:
+            print(f"[{name}] executed in {time.perf_counter() - start:.2f}s")
+
+        for stale in glob.glob(os.path.join(_stage_dir(), f'{glob.escape(stage.name)}-*.pkl')):
+            os.remove(stale)
+        tmp = f'{entry}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, entry)
+
+        results[name] = output
+        return output
+
+    for name in targets or list(by_name):
+        get(name)
+    return results
+
+
+def clear() -> int:
+    """
+    This function deletes every memoized stage output and returns the number of removed entries
+    """
+    entries = glob.glob(os.path.join(_stage_dir(), '*.pkl'))
+    for entry in entries:
+        os.remove(entry)
+    return len(entries)
@@ -0,0 +1,165 @@
+# Present value of the BCW over several horizons, discount rates and ecosystem area trajectories
+from dataclasses import dataclass
+from typing import Dict, Sequence, Union
+
+import numpy as np
+import pandas as pd
+
+from utils.bce_areas import rates_matrix
+from utils.instrument import traced
+
+BASE_YEAR = 2023
+
+
+@dataclass
+class ProjectionCube:
+    """
+    Present values (US$) of the BCW of every territory, discount rate, area scenario and horizon.
+    - territories : Names of the territories (first axis)
+    - discount_rates : Annual discount rates (second axis)
+    - area_scenarios : Table of the annual area change rates, one row per scenario (third axis of coastal)
+    - horizons : Last year of each horizon (last axis)
+    - coastal : territories x discount rates x area scenarios x horizons PV of the coastal BCW
+    - ocean : territories x discount rates x horizons PV of the open-ocean BCW (no area change)
+    """
+    territories: pd.Index
+    discount_rates: np.ndarray
+    area_scenarios: pd.DataFrame
+    horizons: np.ndarray
+    coastal: np.ndarray
+    ocean: np.ndarray
+
+    @property
+    def total(self) -> np.ndarray:
+        """Coastal plus open-ocean PV, missing only when both are missing"""
+        ocean = self.ocean[:, :, None, :]
+        total = np.nan_to_num(self.coastal) + np.nan_to_num(ocean)
+        total[np.isnan(self.coastal) & np.isnan(ocean)] = np.nan
+        return total
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        This function returns the cube as a long table with one row per territory, discount rate,
+        area scenario and horizon
+        """
+        index = pd.MultiIndex.from_product(
+            [self.territories, self.discount_rates, self.area_scenarios.index, self.horizons],
+            names=['country_name', 'discount_rate', 'area_scenario', 'horizon'])
+        ocean = np.broadcast_to(self.ocean[:, :, None, :], self.coastal.shape)
+        return pd.DataFrame({'coastal_pv': self.coastal.ravel(), 'ocean_pv': ocean.ravel(),
+                             'total_pv': self.total.ravel()}, index=index).reset_index()
+
+
+def area_change_grid(**rates) -> pd.DataFrame:
+    """
+    This function builds every combination of the given annual area change rates, one keyword per
+    ecosystem of sequestration_rates.json (ecosystems that are not given keep their area).
+    e.g. area_change_grid(mangroves=[-0.02, -0.01, 0.], seagrass=[-0.07, 0.]) gives 6 scenarios.
+    """
+    index = pd.MultiIndex.from_product(list(rates.values()), names=list(rates))
+    return index.to_frame(index=False)
+
+
+def annuity_factors(growth: np.ndarray, discount_rates: np.ndarray, horizons: np.ndarray) -> np.ndarray:
+    """
+    This function returns sum over t = 1..H of ((1 + g) / (1 + r)) ** t for every growth rate g,
+    discount rate r and number of years H, in closed form.
+
+    Parameters
+    ----------
+    growth : numpy.ndarray
+        Annual growth rates of any shape S.
+    discount_rates : numpy.ndarray
+        D annual discount rates.
+    horizons : numpy.ndarray
+        K numbers of years.
+
+    Returns
+    -------
+    numpy.ndarray
+        D x S x K factors.
+    """
+    q = (1 + np.asarray(growth, dtype=float))[None, ...] / (1 + np.asarray(discount_rates, dtype=float)).reshape(
+        (-1,) + (1,) * np.ndim(growth))
+    q = q[..., None]
+    h = np.asarray(horizons, dtype=float)
+    flat = np.isclose(q, 1.)
+    # q (1 - q^H) / (1 - q), which tends to H when q tends to 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        factors = q * (1 - q ** h) / (1 - q)
+    return np.where(flat, np.broadcast_to(h, factors.shape), factors)
+
+
+@traced()
+def project_bcw(df: pd.DataFrame, json_path: str, bce_columns: Dict[str, str], cmol: float, gscc: float,
+                discount_rates: Sequence[float], horizons: Sequence[int],
+                area_scenarios: Union[pd.DataFrame, Dict[str, Dict[str, float]]] = None,
+                base_year: int = BASE_YEAR, rate_scenario: str = 'central') -> ProjectionCube:
+    """
+    This function computes the present value of the BCW of every territory for every discount rate,
+    area scenario and horizon, with broadcast array operations (no loop over the years).
+
+    The coastal sequestration of an ecosystem in year base_year + t is area * rate * (1 + g) ** t,
+    g being the annual area change rate of the scenario, and the open-ocean (BCP) sequestration is
+    constant. Each year is valued at cmol * gscc US$ per tC, as in cbcw_calculator and
+    bcp_inclusion, and discounted by (1 + r) ** t, for t = 1 to horizon - base_year.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        BCW data (output of bcw_computer) with the 'country_name', 'BCP Seq (tC)' and area columns.
+    json_path : str
+        Path of sequestration_rates.json.
+    bce_columns : dict
+        Ecosystem of the JSON file -> area column of df.
+    cmol : float
+        Carbon to CO2 conversion factor.
+    gscc : float
+        Global social cost of carbon (US$/tCO2).
+    discount_rates : sequence of float
+        Annual discount rates, e.g. [0.02, 0.03, 0.05].
+    horizons : sequence of int
+        Last year of every horizon, e.g. [2030, 2050].
+    area_scenarios : pandas.DataFrame or dict, optional
+        Annual area change rate of each ecosystem, one row per scenario (see area_change_grid), or a
+        dict scenario name -> {ecosystem: rate}. Missing ecosystems keep their area. Constant areas
+        by default.
+    base_year : int, default=BASE_YEAR
+        Year of the areas and sequestration rates.
+    rate_scenario : str, default='central'
+        Sequestration rates used ('central', 'LOW' or 'HIGH').
+
+    Returns
+    -------
+    ProjectionCube
+        The coastal and open-ocean present values (use .total and .to_frame()).
+    """
+    ecosystems = list(bce_columns)
+    if area_scenarios is None:
+        area_scenarios = pd.DataFrame({eco: [0.] for eco in ecosystems}, index=pd.Index(['constant'], name='area_scenario'))
+    elif isinstance(area_scenarios, dict):
+        area_scenarios = pd.DataFrame.from_dict(area_scenarios, orient='index')
+    unknown = set(area_scenarios.columns) - set(ecosystems)
+    if unknown:
+        raise ValueError(f"Area change rates given for ecosystems without area column: {sorted(unknown)}")
+    growth = area_scenarios.reindex(columns=ecosystems).fillna(0.).to_numpy(dtype=float)
+
+    years = np.asarray(horizons, dtype=np.int64) - base_year
+    if (years < 0).any():
+        raise ValueError(f"Horizons must not be before the base year {base_year}.")
+    rates = np.asarray(discount_rates, dtype=float)
+    value = cmol * gscc # US$ per tC
+
+    # territories x ecosystems annual uptakes (tC)
+    areas = df[[bce_columns[eco] for eco in ecosystems]].to_numpy(dtype=float)
+    uptakes = np.nan_to_num(areas) * rates_matrix(json_path, ecosystems)[rate_scenario].to_numpy()[None, :]
+
+    # discount rates x area scenarios x ecosystems x horizons
+    factors = annuity_factors(growth, rates, years)
+    coastal = np.einsum('ne,daek->ndak', uptakes, factors, optimize=True) * value
+    coastal[np.isnan(areas).all(axis=1)] = np.nan
+
+    ocean = df['BCP Seq (tC)'].to_numpy(dtype=float)[:, None, None] * annuity_factors(0., rates, years)[None] * value
+
+    return ProjectionCube(pd.Index(df['country_name'], name='country_name'), rates,
+                          area_scenarios, np.asarray(horizons), coastal, ocean)
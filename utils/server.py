@@ -0,0 +1,387 @@
+# Local query server over the published BCW results, kept in memory with indexes
+#   python -m utils.server --port 8765
+#   curl 'http://127.0.0.1:8765/top?column=Total%20BCW&n=5&continent=Europe'
+import os
+import json
+import math
+import time
+import asyncio
+import argparse
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from utils import sinks
+
+TABLE = 'country_level_bcw'
+# columns the rows are indexed by: ISO3 code (or the name of territories without code), then filters
+KEY_COLUMNS = {'iso': 'ISO', 'continent': 'Continent', 'group': 'Groups'}
+# filters the aggregates are precomputed for
+GROUPINGS = ['continent', 'group']
+AGGREGATES = ['sum', 'mean', 'min', 'max', 'count']
+# query parameters of every route, the other ones being rejected
+ROUTE_PARAMS = {
+    'territory': [],
+    'top': ['column', 'n', 'ascending'] + list(KEY_COLUMNS),
+    'range': ['column', 'min', 'max'] + list(KEY_COLUMNS),
+    'aggregate': ['column', 'by', 'stat'],
+    'metrics': [],
+    'health': [],
+}
+# latencies kept per route for the percentiles of /metrics
+LATENCY_WINDOW = 10_000
+
+parser = argparse.ArgumentParser(description='Serve queries over the published BCW results')
+parser.add_argument('--host', default='127.0.0.1', help='address to listen on (localhost by default)')
+parser.add_argument('--port', type=int, default=8765, help='port to listen on')
+parser.add_argument('--output-format', choices=list(sinks.FORMATS), default='csv',
+                    help='format the results were published in (see main.py --output-format)')
+parser.add_argument('--poll', type=float, default=1.0, help='seconds between two checks for new results')
+
+
+class QueryError(ValueError):
+    """A query that cannot be answered, returned with its HTTP status"""
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_value(value: Any) -> Any:
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    if value is pd.NA or value is pd.NaT:
+        return None
+    return value
+
+
+class ResultIndex:
+    """
+    The rows of a result table and the indexes answering the queries without scanning it.
+    - rows : JSON-ready rows, in the order of the table
+    - by_key : Lower-cased ISO3 code or territory name -> positions of its rows
+    - masks : Filter name -> lower-cased value -> boolean mask of the rows (ISO3 code or name, Continent, Groups)
+    - labels : Filter name -> lower-cased value -> value
+    - order : Numeric column -> positions of the rows with a value, by decreasing value
+    - aggregates : (filter name, value, column) -> aggregate -> value for the GROUPINGS, and
+      (None, None, column) globally
+    The index is immutable once built: a reload builds a new one.
+    """
+
+    def __init__(self, df: pd.DataFrame, version: Dict[str, Any] = None):
+        self.version = version or {}
+        self.columns = list(df.columns)
+        self.numeric = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+        self.rows = [{col: _json_value(value) for col, value in zip(self.columns, row)}
+                     for row in df.itertuples(index=False, name=None)]
+
+        keys = df[KEY_COLUMNS['iso']].fillna(df['country_name']) if KEY_COLUMNS['iso'] in df else df['country_name']
+        self.by_key: Dict[str, np.ndarray] = {}
+        for key, positions in pd.Series(np.arange(len(df))).groupby(keys.astype(str).str.lower().to_numpy()):
+            self.by_key[key] = positions.to_numpy()
+        for name, positions in pd.Series(np.arange(len(df))).groupby(df['country_name'].astype(str).str.lower().to_numpy()):
+            self.by_key.setdefault(name, positions.to_numpy())
+
+        self.masks: Dict[str, Dict[str, np.ndarray]] = {}
+        self.labels: Dict[str, Dict[str, str]] = {}
+        for name, col in KEY_COLUMNS.items():
+            if name == 'iso' or col in df:
+                values = (keys if name == 'iso' else df[col]).astype(object).to_numpy()
+                labels = [v for v in pd.unique(values) if isinstance(v, str)]
+                self.masks[name] = {v.lower(): values == v for v in labels}
+                self.labels[name] = {v.lower(): v for v in labels}
+
+        self.values = {col: df[col].to_numpy(dtype=float) for col in self.numeric}
+        self.order: Dict[str, np.ndarray] = {}
+        for col, values in self.values.items():
+            present = np.flatnonzero(~np.isnan(values))
+            self.order[col] = present[np.argsort(-values[present], kind='stable')]
+
+        self.aggregates: Dict[Tuple, Dict[str, Any]] = {}
+        groups = [(None, None, np.ones(len(df), dtype=bool))]
+        groups += [(name, value, mask) for name, masks in self.masks.items() if name in GROUPINGS
+                   for value, mask in masks.items()]
+        for name, value, mask in groups:
+            for col in self.numeric:
+                selected = self.values[col][mask]
+                selected = selected[~np.isnan(selected)]
+                stats = {'count': int(selected.size)}
+                if selected.size:
+                    stats.update(sum=float(selected.sum()), mean=float(selected.mean()),
+                                 min=float(selected.min()), max=float(selected.max()))
+                else:
+                    stats.update(sum=0., mean=None, min=None, max=None)
+                self.aggregates[(name, value, col)] = stats
+
+    def _column(self, column: Optional[str]) -> str:
+        if column not in self.values:
+            raise QueryError(f"Unknown numeric column: {column!r}")
+        return column
+
+    def _mask(self, filters: Dict[str, str]) -> Optional[np.ndarray]:
+        mask = None
+        for name, value in filters.items():
+            if name not in self.masks:
+                raise QueryError(f"Unknown filter: {name!r}")
+            selected = self.masks[name].get(value.lower())
+            if selected is None:
+                selected = np.zeros(len(self.rows), dtype=bool)
+            mask = selected if mask is None else mask & selected
+        return mask
+
+    def lookup(self, key: str) -> List[Dict[str, Any]]:
+        """Rows of a territory, by ISO3 code or name (case-insensitive)"""
+        positions = self.by_key.get(key.lower())
+        if positions is None:
+            raise QueryError(f"Unknown territory: {key!r}", status=404)
+        return [self.rows[i] for i in positions]
+
+    def top(self, column: str, n: int = 10, ascending: bool = False, **filters: str) -> List[Dict[str, Any]]:
+        """The n rows with the largest (smallest if ascending) values of column"""
+        if n < 0:
+            raise QueryError(f"The number of rows cannot be negative: {n}")
+        order = self.order[self._column(column)]
+        if ascending:
+            order = order[::-1]
+        mask = self._mask(filters)
+        if mask is not None:
+            order = order[mask[order]]
+        return [self.rows[i] for i in order[:n]]
+
+    def range(self, column: str, low: float = -math.inf, high: float = math.inf, **filters: str) -> List[Dict[str, Any]]:
+        """Rows with low <= column <= high, by decreasing value"""
+        if math.isnan(low) or math.isnan(high):
+            raise QueryError(f"The bounds of a range must be numbers: min={low}, max={high}")
+        order = self.order[self._column(column)]
+        values = self.values[column][order]
+        # values decrease along order: the rows in the range are contiguous
+        start = np.searchsorted(-values, -high, side='left')
+        stop = np.searchsorted(-values, -low, side='right')
+        order = order[start:stop]
+        mask = self._mask(filters)
+        if mask is not None:
+            order = order[mask[order]]
+        return [self.rows[i] for i in order]
+
+    def aggregate(self, column: str, by: str = None, stat: str = None) -> Dict[str, Any]:
+        """Aggregates of column, globally or for every continent or group"""
+        self._column(column)
+        if stat is not None and stat not in AGGREGATES:
+            raise QueryError(f"Unknown aggregate: {stat!r} (one of {AGGREGATES})")
+        if by is None:
+            stats = self.aggregates[(None, None, column)]
+            return stats if stat is None else {stat: stats[stat]}
+        groupings = [name for name in GROUPINGS if name in self.masks]
+        if by not in groupings:
+            raise QueryError(f"Unknown grouping: {by!r} (one of {groupings})")
+        result = {}
+        for value in self.masks[by]:
+            stats = self.aggregates[(by, value, column)]
+            result[self.labels[by][value]] = stats if stat is None else stats[stat]
+        return result
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+@dataclass
+class LatencyMetrics:
+    """
+    Latency of the requests of every route, measured from the parsed request to the encoded
+    response (in milliseconds).
+    - window : Number of latest latencies kept per route for the percentiles
+    """
+    window: int = LATENCY_WINDOW
+    counts: Dict[str, int] = field(default_factory=dict)
+    errors: Dict[str, int] = field(default_factory=dict)
+    latencies: Dict[str, Deque[float]] = field(default_factory=dict)
+
+    def record(self, route: str, ms: float, error: bool = False) -> None:
+        self.counts[route] = self.counts.get(route, 0) + 1
+        if error:
+            self.errors[route] = self.errors.get(route, 0) + 1
+        self.latencies.setdefault(route, deque(maxlen=self.window)).append(ms)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+        for route, latencies in self.latencies.items():
+            values = sorted(latencies)
+            summary[route] = {'requests': self.counts[route], 'errors': self.errors.get(route, 0),
+                              'mean_ms': sum(values) / len(values), 'p50_ms': _percentile(values, .5),
+                              'p95_ms': _percentile(values, .95), 'p99_ms': _percentile(values, .99),
+                              'max_ms': values[-1]}
+        return summary
+
+
+def _signature(path: str) -> Optional[Tuple[int, int]]:
+    """The modification time and size of a file, which change when a new table is published"""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class QueryService:
+    """
+    The queries over the results published by the pipeline (see utils/sinks.py).
+
+    The table is read once into a ResultIndex. The sinks replace the published file atomically,
+    so a new run is detected by the modification time and size of the file; the new index is
+    built off the event loop, then replaces the current one in a single assignment. A request
+    uses the index current when it started, so it never sees a half-reloaded table.
+    """
+
+    def __init__(self, path: str = None, sink: sinks.OutputSink = None):
+        self.sink = sink or sinks.SINK
+        self.path = path or sinks.path_of(TABLE)
+        self.metrics = LatencyMetrics()
+        self.reloads = 0
+        self.index: Optional[ResultIndex] = None
+        self._signature = None
+
+    def load(self) -> bool:
+        """This function (re)loads the table if it changed since the last load, and returns whether it did"""
+        signature = _signature(self.path)
+        if signature is None or signature == self._signature:
+            return False
+        df = self.sink.read(self.path)
+        version = {'path': self.path, 'rows': len(df), 'loaded_at': time.time(), 'mtime_ns': signature[0]}
+        self.index = ResultIndex(df, version)
+        self._signature = signature
+        self.reloads += 1
+        return True
+
+    async def watch(self, poll: float = 1.0) -> None:
+        """This coroutine reloads the table whenever a new one is published"""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(poll)
+            try:
+                await loop.run_in_executor(None, self.load)
+            except Exception as error: # a table being replaced again, retried at the next poll
+                print(f"Reload of {self.path} failed: {error}")
+
+    def query(self, target: str) -> Tuple[int, Any]:
+        """
+        This function answers a request target (path and query string) and returns the HTTP
+        status and the JSON-ready payload.
+        - /territory/<ISO3 or name> : rows of a territory
+        - /top?column=&n=10&ascending=0&iso=&continent=&group= : top-N rows of a column
+        - /range?column=&min=&max=&iso=&continent=&group= : rows within a range of a column
+        - /aggregate?column=&by=continent|group&stat=sum|mean|min|max|count : aggregates
+        - /metrics : latency of the requests by route
+        - /health : version of the loaded table
+        Other query parameters are rejected.
+        """
+        start = time.perf_counter()
+        url = urlsplit(target)
+        parts = [unquote(part) for part in url.path.strip('/').split('/') if part]
+        route = parts[0] if parts else ''
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        index = self.index
+        try:
+            status, payload = 200, self._answer(index, route, parts[1:], params)
+        except QueryError as error:
+            status, payload = error.status, {'error': str(error)}
+        except (TypeError, ValueError) as error:
+            status, payload = 400, {'error': str(error)}
+        self.metrics.record(route or '/', (time.perf_counter() - start) * 1e3, error=status != 200)
+        return status, payload
+
+    def _answer(self, index: Optional[ResultIndex], route: str, args: List[str], params: Dict[str, str]) -> Any:
+        if route not in ROUTE_PARAMS or len(args) != (route == 'territory'):
+            raise QueryError(f"Unknown route: /{'/'.join([route] + args)}", status=404)
+        unknown = [name for name in params if name not in ROUTE_PARAMS[route]]
+        if unknown:
+            raise QueryError(f"Unknown parameter(s) of /{route}: {unknown} (one of {ROUTE_PARAMS[route]})")
+        if route == 'metrics':
+            return self.metrics.summary()
+        if route == 'health':
+            return {'loaded': index is not None, 'reloads': self.reloads, **(index.version if index else {})}
+        if index is None:
+            raise QueryError(f"No results loaded yet from {self.path}", status=503)
+        filters = {name: params.pop(name) for name in list(params) if name in KEY_COLUMNS}
+        if route == 'territory':
+            return index.lookup(args[0])
+        if route == 'top':
+            return index.top(params.get('column'), int(params.get('n', 10)),
+                             params.get('ascending', '0') not in ('0', 'false'), **filters)
+        if route == 'range':
+            return index.range(params.get('column'), float(params.get('min', -math.inf)),
+                               float(params.get('max', math.inf)), **filters)
+        if route == 'aggregate':
+            return index.aggregate(params.get('column'), params.get('by'), params.get('stat'))
+
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 503: 'Service Unavailable'}
+
+
+async def _handle(service: QueryService, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answers the GET requests of a connection, kept alive until the client closes it"""
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            headers = {}
+            while True:
+                header = await reader.readline()
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = header.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip().lower()
+            method, target, *_ = line.decode('latin-1').split() + ['', '']
+            if method == 'GET':
+                status, payload = service.query(target)
+            else:
+                status, payload = 405, {'error': f"Unsupported method: {method}"}
+            body = json.dumps(payload, allow_nan=False).encode('utf-8')
+            close = headers.get('connection') == 'close'
+            writer.write(f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: {'close' if close else 'keep-alive'}\r\n\r\n"
+                         .encode('latin-1') + body)
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(service: QueryService, host: str = '127.0.0.1', port: int = 8765,
+                poll: float = 1.0) -> Tuple[asyncio.AbstractServer, asyncio.Task]:
+    """
+    This coroutine loads the results, then starts the server and the task reloading them. It
+    returns both, to be closed and cancelled when done; port 0 picks a free port (see
+    server.sockets[0].getsockname()).
+    """
+    service.load()
+    server = await asyncio.start_server(lambda reader, writer: _handle(service, reader, writer), host, port)
+    return server, asyncio.create_task(service.watch(poll))
+
+
+async def _main(args) -> None:
+    sinks.configure(sink=args.output_format)
+    service = QueryService()
+    server, watcher = await serve(service, args.host, args.port, args.poll)
+    print(f"Serving {service.path} on http://{args.host}:{server.sockets[0].getsockname()[1]}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(_main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,192 @@
+# Output sinks the pipeline publishes its intermediate and final tables to
+import os
+from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from utils.compact import lazy_copy
+
+# name of every published table -> path of the file, without extension
+OUTPUTS = {
+    'bce_data': 'data_source/summary/bce_data',
+    'bcw_data_before_grouping': 'data_source/summary/bcw_data_before_grouping',
+    'country_level_gscc': 'data_source/gscc/country_level_gscc',
+    'country_level_bcw': 'country_level_bcw',
+    'bcw_confidence_intervals': 'data_source/summary/bcw_confidence_intervals',
+    # summary tables rebuilt by --summaries (see utils/summaries.py), kept apart from the curated
+    # tables of data_source/summary/
+    'continental_uptakes': 'summaries/continental_uptakes',
+    'sequestration_by_continent': 'summaries/sequestration_by_continent',
+    'grouping_uptakes': 'summaries/grouping_uptakes',
+    'top_bce_uptakers': 'summaries/bcw-bce-eez-pop-of-top_bce_uptakers',
+    'data_summary': 'summaries/data_summary',
+    'summary_cube': 'summaries/summary_cube',
+}
+
+
+class OutputSink(ABC):
+    """
+    A file format the published tables are written in. Subclasses implement write and read,
+    and give the extension of their files.
+    """
+    extension = ''
+
+    @abstractmethod
+    def write(self, df: pd.DataFrame, path: str) -> None:
+        """Writes df to path"""
+
+    @abstractmethod
+    def read(self, path: str) -> pd.DataFrame:
+        """Reads the table written to path"""
+
+
+@dataclass
+class CsvSink(OutputSink):
+    """CSV files, compressed when compression is given (e.g. 'gzip' gives .csv.gz files)"""
+    compression: Optional[str] = None
+
+    @property
+    def extension(self) -> str:
+        return '.csv' + {None: '', 'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz', 'zstd': '.zst'}[self.compression]
+
+    def write(self, df: pd.DataFrame, path: str) -> None:
+        df.to_csv(path, index=False, compression=self.compression)
+
+    def read(self, path: str) -> pd.DataFrame:
+        return pd.read_csv(path, compression=self.compression)
+
+
+@dataclass
+class ParquetSink(OutputSink):
+    """Compressed columnar Parquet files"""
+    compression: str = 'zstd'
+    extension = '.parquet'
+
+    def write(self, df: pd.DataFrame, path: str) -> None:
+        df.to_parquet(path, index=False, compression=self.compression)
+
+    def read(self, path: str) -> pd.DataFrame:
+        return pd.read_parquet(path)
+
+
+@dataclass
+class FeatherSink(OutputSink):
+    """Compressed columnar Feather (Arrow IPC) files"""
+    compression: str = 'zstd'
+    extension = '.feather'
+
+    def write(self, df: pd.DataFrame, path: str) -> None:
+        df.reset_index(drop=True).to_feather(path, compression=self.compression)
+
+    def read(self, path: str) -> pd.DataFrame:
+        return pd.read_feather(path)
+
+
+FORMATS = {
+    'csv': CsvSink,
+    'csv.gz': lambda: CsvSink('gzip'),
+    'parquet': ParquetSink,
+    'feather': FeatherSink,
+}
+
+SINK: OutputSink = CsvSink()
+INTERMEDIATE = True
+BACKGROUND = True
+
+_executor: Optional[ThreadPoolExecutor] = None
+_pending: List[Future] = []
+
+
+def configure(sink: OutputSink = None, intermediate: bool = None, background: bool = None) -> None:
+    """
+    This function sets the output options.
+    - sink : Format of the published tables (an OutputSink, or a key of FORMATS)
+    - intermediate : False to skip the intermediate tables (e.g. for fast batch runs)
+    - background : False to write the tables before publish returns
+    """
+    global SINK, INTERMEDIATE, BACKGROUND
+    if sink is not None:
+        SINK = FORMATS[sink]() if isinstance(sink, str) else sink
+    if intermediate is not None:
+        INTERMEDIATE = intermediate
+    if background is not None:
+        BACKGROUND = background
+
+
+def signature() -> Dict[str, str]:
+    """
+    This function describes the options that change which files the stages write, empty with
+    the default options
+    """
+    described = {}
+    if not (isinstance(SINK, CsvSink) and SINK.compression is None):
+        described['sink'] = repr(SINK)
+    if not INTERMEDIATE:
+        described['intermediate'] = 'off'
+    return described
+
+
+def path_of(name: str) -> str:
+    """This function returns the path of the file of a published table"""
+    return OUTPUTS.get(name, name) + SINK.extension
+
+
+def _write(sink: OutputSink, df: pd.DataFrame, path: str) -> None:
+    """Writes to a temporary file renamed at the end, so that a file is never seen half written"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        sink.write(df, tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def publish(name: str, df: pd.DataFrame, intermediate: bool = False) -> Optional[str]:
+    """
+    This function writes a table to the file of its name (see OUTPUTS and path_of) and returns
+    the absolute path, or None for an intermediate table when intermediate outputs are disabled.
+
+    With BACKGROUND, the table is written by a background thread while the computation goes on;
+    the tables are written in the order they are published, and flush waits for them. The
+    frame is copied first (lazily with copy-on-write), so the caller may keep modifying it, and
+    the path is resolved against the working directory of the call, whatever it is when the
+    table is written.
+    """
+    if intermediate and not INTERMEDIATE:
+        return None
+    global _executor
+    path = os.path.abspath(path_of(name))
+    if not BACKGROUND:
+        _write(SINK, df, path)
+        return path
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sink')
+    _pending.append(_executor.submit(_write, SINK, lazy_copy(df), path))
+    return path
+
+
+def flush() -> None:
+    """
+    This function waits until every published table is written, and raises the error of the
+    first table that could not be written
+    """
+    futures = list(_pending)
+    _pending.clear()
+    errors = [future.exception() for future in futures]
+    error = next((error for error in errors if error is not None), None)
+    if error is not None:
+        raise RuntimeError(f"Could not write an output table: {error}") from error
+
+
+def read(name: str) -> pd.DataFrame:
+    """This function reads a published table back, once the pending writes are done"""
+    flush()
+    return SINK.read(path_of(name))
+
@@ -0,0 +1,297 @@
+# Aggregation cube of the BCW data and the summary tables answered from it
+from dataclasses import dataclass, field
+from itertools import combinations
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from utils.bce_areas import RATE_SCENARIOS, uptake_column
+from utils.instrument import traced
+
+# label of the rolled-up levels of the cube
+ALL = '(all)'
+# finest level of the cube (position of the row in the data, as territory names are not unique,
+# e.g. Germany and Yemen have two rows), its label, then the levels it is rolled up over
+ROW = 'row'
+TERRITORY = 'country_name'
+LEVELS = ['Continent', 'Groups']
+# ecosystem of sequestration_rates.json -> (label in the summaries, area column)
+ECOSYSTEMS = {
+    'saltmarshes': ('Saltmarshes', 'saltmarshes_area_km2'),
+    'seagrass': ('Seagrasses', 'seagrasses_area_km2'),
+    'mangroves': ('Mangroves', 'mangroves_area_km2'),
+}
+# the open-ocean sequestration (Blue Carbon Pump), which does not depend on the rate scenario
+BCP = 'BCP'
+SCENARIOS = list(RATE_SCENARIOS.values())
+# country-level indicators of the data summary: column -> (label, scale)
+INDICATORS = {
+    'Area_EEZ_KM2': ('EEZ Area (1,000 km²)', 1e-3),
+    'Area_EEZ_KM2_per_capita': ('EEZ per capita', 1.),
+    'Total BCW': ('Total BCW (billion US$)', 1e-9),
+    'Total BCW_per_capita': ('Total BCW per capita', 1.),
+    'GDP': ('GDP (billion US$)', 1e-9),
+    'GDP_per_capita': ('GDP per capita', 1.),
+    'Debt (2015 US$)': ('TED (billion US$)', 1e-9),
+    'Debt (2015 US$)_per_capita': ('TED per capita', 1.),
+}
+
+
+@dataclass
+class AggregationCube:
+    """
+    Sums, sums of squares and counts of measures over every grouping set of some levels.
+    - levels : Levels rolled up, the finest one first (its cells are the rows of the data). The
+      rolled-up levels of a cell are labelled ALL
+    - fixed : Levels kept in every grouping set (e.g. ecosystem and scenario)
+    - labels : Columns describing the finest cells (e.g. TERRITORY), ALL in the coarser cells
+    - measures : Aggregated columns
+    - cells : One row per cell, with the levels and, for every measure m, the columns m (sum,
+      missing values counted as 0), 'm count' (non-missing values) and 'm sumsq'
+    """
+    levels: List[str]
+    fixed: List[str]
+    measures: List[str]
+    cells: pd.DataFrame
+    labels: List[str] = field(default_factory=list)
+
+    def slice(self, by: Sequence[str] = (), **filters) -> pd.DataFrame:
+        """
+        This function returns the cells of the grouping set keeping the `by` levels (the other
+        levels being rolled up), restricted to the given level values, e.g.
+        cube.slice(['Continent'], scenario='central'). Slices keeping the finest level return
+        its cells, with all the levels.
+        """
+        finest = self.levels[0]
+        mask = np.ones(len(self.cells), dtype=bool)
+        if finest in by or finest in filters:
+            mask &= (self.cells[finest] != ALL).to_numpy()
+            rolled = []
+        else:
+            rolled = [level for level in self.levels if level not in by and level not in filters] + self.labels
+            for level in self.levels:
+                kept = self.cells[level] != ALL
+                mask &= (~kept if level in rolled else kept).to_numpy()
+        for level, value in filters.items():
+            mask &= (self.cells[level] == value).to_numpy()
+        return self.cells[mask].drop(columns=rolled).reset_index(drop=True)
+
+    def stats(self, by: Sequence[str] = (), **filters) -> pd.DataFrame:
+        """
+        This function returns the sum, count, mean and sample standard deviation of every measure
+        over the cells of a slice, indexed by the `by` levels
+        """
+        cells = self.slice(by, **filters).set_index(list(by)) if by else self.slice(by, **filters)
+        stats = {}
+        for measure in self.measures:
+            total, count, sumsq = cells[measure], cells[f'{measure} count'], cells[f'{measure} sumsq']
+            mean = total / count.where(count > 0)
+            var = (sumsq - count * mean ** 2) / (count - 1).where(count > 1)
+            stats.update({(measure, 'sum'): total, (measure, 'count'): count, (measure, 'mean'): mean,
+                          (measure, 'std'): np.sqrt(var.clip(lower=0))})
+        return pd.DataFrame(stats)
+
+
+def _grouping_sets(levels: List[str], finest: str) -> List[Tuple[str, ...]]:
+    """The finest level with all the others, then every subset of the other levels"""
+    sets = [tuple([finest] + levels)]
+    for size in range(len(levels), -1, -1):
+        sets += list(combinations(levels, size))
+    return sets
+
+
+def build_cube(df: pd.DataFrame, measures: List[str], levels: List[str] = None,
+               fixed: List[str] = None, finest: str = ROW, labels: List[str] = None) -> AggregationCube:
+    """
+    This function aggregates the measures of df over every grouping set of `levels` in one pass:
+    the cells of the finest grouping set are computed by a single groupby, and every coarser
+    grouping set is a sum of them. The `fixed` levels (e.g. ecosystem and scenario) are kept in
+    every grouping set.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data with the levels and the measures.
+    measures : list
+        Columns aggregated.
+    levels : list, optional
+        Levels rolled up (LEVELS by default).
+    fixed : list, optional
+        Levels never rolled up.
+    finest : str, default=ROW
+        Level of the rows of df, only kept in the finest grouping set (e.g. for rankings). ROW
+        is the position of the rows in df when df has no such column.
+    labels : list, optional
+        Columns describing the finest cells ([TERRITORY] by default when present).
+
+    Returns
+    -------
+    AggregationCube
+        The cube; missing level values (e.g. territories without development group) are kept
+        as their own cells.
+    """
+    levels = LEVELS if levels is None else levels
+    fixed = fixed or []
+    labels = [col for col in [TERRITORY] if col in df.columns] if labels is None else labels
+    if finest == ROW and ROW not in df.columns:
+        df = df.assign(**{ROW: np.arange(len(df))})
+    keys = [finest] + levels + fixed
+
+    values = df[measures].to_numpy(dtype=float)
+    stats = pd.DataFrame(np.hstack([np.nan_to_num(values), ~np.isnan(values), np.nan_to_num(values) ** 2]),
+                         columns=measures + [f'{m} count' for m in measures] + [f'{m} sumsq' for m in measures])
+    stats[keys + labels] = df[keys + labels].astype(object).to_numpy()
+    # the labels depend on the finest level, grouping on them only keeps them in the cells
+    finest_cells = stats.groupby(keys + labels, dropna=False, sort=False).sum().reset_index()
+
+    columns = list(stats.columns[:3 * len(measures)])
+    parts = []
+    for kept in _grouping_sets(levels, finest):
+        by = list(kept) + fixed
+        if len(kept) == len(levels) + 1:
+            part = finest_cells
+        elif by:
+            part = finest_cells.groupby(by, dropna=False, sort=False)[columns].sum().reset_index()
+        else:
+            part = finest_cells[columns].sum().to_frame().T
+        rolled = [level for level in [finest] + levels if level not in kept]
+        part = part.assign(**{col: ALL for col in rolled + (labels if finest in rolled else [])})
+        parts.append(part[keys + labels + columns])
+    cells = pd.concat(parts, ignore_index=True)
+    counts = [f'{m} count' for m in measures]
+    cells[counts] = cells[counts].astype(np.int64)
+    return AggregationCube([finest] + levels, fixed, measures, cells, labels)
+
+
+def _ecosystem_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """Long (territory x ecosystem x scenario) table of the areas and uptakes of df"""
+    ids = df[[TERRITORY] + LEVELS].assign(**{ROW: np.arange(len(df))})
+    frames = []
+    for scenario in SCENARIOS:
+        for eco, (label, area_col) in ECOSYSTEMS.items():
+            frames.append(ids.assign(ecosystem=label, scenario=scenario, area_km2=df[area_col],
+                                     uptake_tC=df[uptake_column(eco, scenario)]))
+        frames.append(ids.assign(ecosystem=BCP, scenario=scenario, area_km2=np.nan,
+                                 uptake_tC=df['BCP Seq (tC)']))
+    return pd.concat(frames, ignore_index=True)
+
+
+@traced()
+def summary_cubes(df: pd.DataFrame) -> Dict[str, AggregationCube]:
+    """
+    This function builds the cubes the summary tables are answered from.
+    - df : Country-level BCW data with the per capita values (output of per_capita)
+
+    Returns the 'ecosystems' cube (areas and uptakes over Continent x Groups x ecosystem x
+    scenario) and the 'indicators' cube (INDICATORS over Continent x Groups).
+    """
+    ecosystems = build_cube(_ecosystem_frame(df), ['area_km2', 'uptake_tC'], fixed=['ecosystem', 'scenario'])
+    indicators = build_cube(df, [col for col in INDICATORS if col in df.columns])
+    return {'ecosystems': ecosystems, 'indicators': indicators}
+
+
+def uptake_table(cube: AggregationCube, level: str, scenario: str = 'central') -> pd.DataFrame:
+    """
+    This function returns the uptakes (MtC) of every ecosystem, of the BCEs and of the BCP, and the
+    total sequestration, for every value of a level ('Continent' or 'Groups')
+    """
+    cells = cube.slice([level, 'ecosystem'], scenario=scenario)
+    cells = cells[cells[level].notna()]
+    table = cells.pivot(index=level, columns='ecosystem', values='uptake_tC') / 1e6
+    labels = [label for label, _ in ECOSYSTEMS.values()]
+    out = table[labels].add_suffix(' (MtC)')
+    out['BCEs (total)'] = table[labels].sum(axis=1)
+    out['BCP (MtC)'] = table[BCP]
+    out['Total BCseq (GtC)'] = out['BCEs (total)'] + out['BCP (MtC)']
+    out = out.round(2).sort_values('Total BCseq (GtC)', ascending=False)
+    out.columns.name = None
+    return out.reset_index()
+
+
+def continental_uptakes(cube: AggregationCube, scenario: str = 'central') -> pd.DataFrame:
+    return uptake_table(cube, 'Continent', scenario)
+
+
+def grouping_uptakes(cube: AggregationCube, scenario: str = 'central') -> pd.DataFrame:
+    """Uptakes by development group, with the share of every group in the BCE uptakes (%)"""
+    table = uptake_table(cube, 'Groups', scenario)
+    table['BCEs(%)'] = (table['BCEs (total)'] / table['BCEs (total)'].sum() * 100).round(0)
+    return table
+
+
+def sequestration_by_continent(cube: AggregationCube, scenario: str = 'central') -> pd.DataFrame:
+    """Sequestration (MtC) of the carbon pumps and of every BCE, by continent"""
+    cells = cube.slice(['Continent', 'ecosystem'], scenario=scenario)
+    cells = cells[cells['Continent'].notna()]
+    table = cells.pivot(index='Continent', columns='ecosystem', values='uptake_tC') / 1e6
+    table = table[[BCP] + [label for label, _ in ECOSYSTEMS.values()]].rename(columns={BCP: 'Carbon Pumps'})
+    table.columns.name = None
+    return table.sort_index().reset_index()
+
+
+def top_uptakers(cube: AggregationCube, df: pd.DataFrame, n: int = 10, scenario: str = 'central') -> pd.DataFrame:
+    """
+    This function returns the n territories with the largest BCE uptakes, ranked from the
+    territory cells of the cube, with their population, EEZ and BCW
+    """
+    cells = cube.slice([ROW, 'ecosystem'], scenario=scenario)
+    cells = cells[cells['ecosystem'] != BCP]
+    bce = cells.groupby(cells[ROW].astype(np.int64), sort=False)[['area_km2', 'uptake_tC']].sum()
+    top = bce['uptake_tC'].nlargest(n).index
+    rows = df.iloc[top]
+    return pd.DataFrame({
+        'ISO': rows['ISO'].to_numpy(), 'Groups': rows['Groups'].to_numpy(), 'Population': rows['Population'].to_numpy(),
+        'EEZ': rows['Area_EEZ_KM2'].to_numpy(), 'Area_EEZ_KM2_per_capita': rows['Area_EEZ_KM2_per_capita'].to_numpy(),
+        'Total_BCE_area_km2': bce.loc[top, 'area_km2'].to_numpy(),
+        **{col: rows[col].to_numpy() for col in ['tot_uptake (tC)', 'BCP Seq (tC)', 'Total BCseq', 'cBCW', 'oBCW',
+                                                 'Total BCW', 'Total BCW_per_capita']},
+    })
+
+
+def data_summary(cube: AggregationCube) -> pd.DataFrame:
+    """
+    This function returns the mean, median and standard deviation of the INDICATORS for all the
+    countries and for every development group. Means and deviations are rolled up from the
+    cube; medians, which cannot be rolled up, are read from its territory cells.
+    """
+    territories = cube.slice([ROW, 'Groups'])
+    groups = [('All-Countries', cube.stats(), territories)]
+    by_group = cube.stats(['Groups'])
+    for group in sorted(by_group.index.dropna()):
+        groups.append((group, by_group.loc[[group]], territories[territories['Groups'] == group]))
+
+    rows = []
+    for name, stats, cells in groups:
+        count = len(cells)
+        for stat in ['mean', 'median', 'std']:
+            row = {'Groups': name, 'No.': count, 'Stat': stat}
+            for col in cube.measures:
+                label, scale = INDICATORS[col]
+                if stat == 'median':
+                    values = cells[col].where(cells[f'{col} count'] > 0)
+                    row[label] = values.median() * scale
+                else:
+                    row[label] = stats[(col, stat)].iloc[0] * scale
+            rows.append(row)
+    return pd.DataFrame(rows).round(2)
+
+
+@traced()
+def summary_tables(df: pd.DataFrame, top_n: int = 10) -> Dict[str, pd.DataFrame]:
+    """
+    This function returns every summary table of data_source/summary/, answered from the cubes
+    of summary_cubes, and the long table of the ecosystem cube ('summary_cube').
+    - df : Country-level BCW data with the per capita values (output of per_capita)
+    - top_n : Number of territories of the BCE uptakers ranking
+    """
+    cubes = summary_cubes(df)
+    ecosystems = cubes['ecosystems']
+    return {
+        'continental_uptakes': continental_uptakes(ecosystems),
+        'sequestration_by_continent': sequestration_by_continent(ecosystems),
+        'grouping_uptakes': grouping_uptakes(ecosystems),
+        'top_bce_uptakers': top_uptakers(ecosystems, df, top_n),
+        'data_summary': data_summary(cubes['indicators']),
+        'summary_cube': ecosystems.cells,
+    }